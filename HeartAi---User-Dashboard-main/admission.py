@@ -0,0 +1,123 @@
+# Admission control for the inference pipeline.
+# Only a bounded number of uploads run TensorFlow and matplotlib at the same time;
+# a bounded number more wait in line for at most a configured time. Anything
+# beyond that is turned away at once with 503 and Retry-After, so an overload
+# neither oversubscribes the CPU nor ties up every request thread, and cheap
+# endpoints (login, history, media) keep threads and cores to run on.
+
+import os
+import threading
+import time
+
+import metrics
+
+INFERENCE_QUEUE_DEPTH = metrics.Gauge(
+    'heartai_inference_queue_depth', 'Uploads waiting for an inference slot.')
+INFERENCE_QUEUE_WAIT = metrics.Histogram(
+    'heartai_inference_queue_wait_seconds', 'Time uploads waited for an inference slot.')
+INFERENCE_REJECTED = metrics.Counter(
+    'heartai_inference_rejected_total', 'Uploads turned away because inference was saturated.', ('reason',))
+
+
+class Overloaded(Exception):
+    """
+    Raised when an upload cannot get an inference slot. retry_after is the
+    suggested number of seconds before trying again.
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class InferenceGate:
+    """
+    A counting semaphore with a bounded, first-come-first-served waiting line.
+    """
+
+    def __init__(self, max_concurrent, max_queued, max_wait_seconds):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_wait_seconds = max_wait_seconds
+        self._condition = threading.Condition()
+        self._running = 0
+        self._waiting = []
+        # Moving average of how long one inference takes, for Retry-After
+        self._average_seconds = 2.0
+
+    def check(self):
+        """
+        Raise Overloaded if acquire() would turn an upload away right now
+        because the line is full. Cheap, so uploads call it before their body
+        is read and an overloaded server does not receive multi-MB files only
+        to reject them.
+        """
+        with self._condition:
+            if (self._running >= self.max_concurrent or self._waiting) and len(self._waiting) >= self.max_queued:
+                INFERENCE_REJECTED.inc(reason='queue_full')
+                raise Overloaded('queue_full', self._retry_after_locked())
+
+    def acquire(self):
+        """
+        Take an inference slot, waiting in line if all are busy.
+        Raises Overloaded if the line is full or the wait takes too long.
+        """
+        with self._condition:
+            if self._running < self.max_concurrent and not self._waiting:
+                self._running += 1
+                return
+            if len(self._waiting) >= self.max_queued:
+                INFERENCE_REJECTED.inc(reason='queue_full')
+                raise Overloaded('queue_full', self._retry_after_locked())
+
+            ticket = object()
+            self._waiting.append(ticket)
+            INFERENCE_QUEUE_DEPTH.inc()
+            started = time.monotonic()
+            deadline = started + self.max_wait_seconds
+            try:
+                while self._waiting[0] is not ticket or self._running >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        INFERENCE_REJECTED.inc(reason='timeout')
+                        raise Overloaded('timeout', self._retry_after_locked())
+                    self._condition.wait(remaining)
+                self._running += 1
+            finally:
+                self._waiting.remove(ticket)
+                INFERENCE_QUEUE_DEPTH.dec()
+                INFERENCE_QUEUE_WAIT.observe(time.monotonic() - started)
+                # The next in line may be able to go now
+                self._condition.notify_all()
+
+    def _retry_after_locked(self):
+        rounds = (len(self._waiting) + self._running) / max(1, self.max_concurrent)
+        return max(1, int(round(rounds * self._average_seconds)))
+
+    def release(self, elapsed_seconds=None):
+        """
+        Give the slot back. elapsed_seconds, the time the slot was held,
+        keeps the Retry-After estimate current.
+        """
+        with self._condition:
+            self._running -= 1
+            if elapsed_seconds is not None:
+                self._average_seconds = 0.8 * self._average_seconds + 0.2 * elapsed_seconds
+            self._condition.notify_all()
+
+
+def _default_concurrency():
+    # Leave a core for the cheap endpoints when there is more than one
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+# Limits per process (gunicorn worker):
+#   HEARTAI_INFERENCE_CONCURRENCY   uploads running inference at once (default: cores - 1)
+#   HEARTAI_INFERENCE_QUEUE         uploads allowed to wait for a slot (default 4)
+#   HEARTAI_INFERENCE_MAX_WAIT      seconds an upload may wait before a 503 (default 30)
+inference_gate = InferenceGate(
+    max_concurrent=int(os.environ.get('HEARTAI_INFERENCE_CONCURRENCY', _default_concurrency())),
+    max_queued=int(os.environ.get('HEARTAI_INFERENCE_QUEUE', 4)),
+    max_wait_seconds=float(os.environ.get('HEARTAI_INFERENCE_MAX_WAIT', 30)),
+)
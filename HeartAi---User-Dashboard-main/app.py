@@ -3,7 +3,8 @@
 # Import the os module for file system operations
 # Import the sqlite3 module for database interaction
 
-from flask import Flask, request, jsonify, send_file, make_response
+from flask import Flask, Request, request, jsonify, send_file, make_response, g
+from werkzeug.exceptions import HTTPException
 from flask_cors import CORS
 import os
 import sqlite3
@@ -14,7 +15,13 @@ import sqlite3
 
 import uuid
 import time
-from heartai import create_inference_and_spectrogram_file
+import storage
+import maintenance
+import metrics
+import admission
+import response_cache
+import media_urls
+from heartai import create_inference_and_spectrogram_file, create_session_inference, SESSION_SITES
 
 # Initialize Flask application
 # Enable CORS for the application
@@ -62,11 +69,12 @@ def find_data_folder():
 
 try:
     # Call the function to find the data folder
+    # The HEARTAI_DATA_FOLDER environment variable takes precedence
     # Print the path of the found data folder
     # Handle FileNotFoundError exception
-    # Print error message if data folder not found
 
-    DATA_FOLDER = find_data_folder()
+    DATA_FOLDER = os.environ.get('HEARTAI_DATA_FOLDER') or find_data_folder()
+    os.makedirs(DATA_FOLDER, exist_ok=True)
     print(f"DATA_FOLDER set to: {DATA_FOLDER}")
 except FileNotFoundError as e:
     print(e)
@@ -87,6 +95,99 @@ except FileNotFoundError as e:
 
 MASTER_DB = os.path.join(DATA_FOLDER, 'master.db')
 
+def connect_db():
+    # Open a connection to the master database
+    # Statement latency and write lock waits are recorded for /metrics
+    return sqlite3.connect(MASTER_DB, factory=metrics.InstrumentedConnection)
+
+# Largest recording accepted by /upload, in bytes (HEARTAI_MAX_UPLOAD_BYTES, default 64 MiB)
+# Requests announcing a larger body are refused before any of it is read
+MAX_UPLOAD_BYTES = int(os.environ.get('HEARTAI_MAX_UPLOAD_BYTES', 64 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 64 * 1024
+
+class UploadRequest(Request):
+    # Uploaded files are streamed chunk by chunk into the recording store while
+    # the request body is parsed, instead of being spooled to a temporary file
+    # first. Oversized and non-audio files are refused as soon as that shows.
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return storage.IncomingFile(DATA_FOLDER, MAX_UPLOAD_BYTES)
+
+app.request_class = UploadRequest
+
+# Serialized history responses, keyed by user, history version and parameters
+# (HEARTAI_RESPONSE_CACHE_ENTRIES entries each, default 1024)
+RESPONSE_CACHE_ENTRIES = int(os.environ.get('HEARTAI_RESPONSE_CACHE_ENTRIES', 1024))
+HISTORY_LIST_CACHE = response_cache.ResponseCache('history_list', RESPONSE_CACHE_ENTRIES)
+HISTORY_DETAIL_CACHE = response_cache.ResponseCache('history_detail', RESPONSE_CACHE_ENTRIES)
+
+# Key for the signed media URLs handed out by /history/<id>
+# URLs stay valid for at least HEARTAI_MEDIA_URL_TTL seconds (default 3600); the
+# expiry is rounded up to HEARTAI_MEDIA_URL_BUCKET seconds (default 300) so a
+# record keeps the same URL for that long and caches can reuse the files
+MEDIA_SECRET = media_urls.load_secret(DATA_FOLDER)
+MEDIA_URL_TTL = int(os.environ.get('HEARTAI_MEDIA_URL_TTL', 3600))
+MEDIA_URL_BUCKET = int(os.environ.get('HEARTAI_MEDIA_URL_BUCKET', 300))
+
+def cached_json_response(cache, key, build):
+    # Serve a JSON response from the cache, building it with build() on a miss
+    # build() returns the data and a dict of extra response headers
+    # The ETag is derived from the key, so it changes with the history version
+    # A client that already has this version gets 304 Not Modified without a body
+    entry = cache.get(key)
+    if entry is None:
+        data, headers = build()
+        entry = (app.json.dumps(data), response_cache.make_etag(key), headers)
+        cache.put(key, entry)
+    body, etag, headers = entry
+    if response_cache.etag_matches(request.headers.get('If-None-Match'), etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(body)
+        response.mimetype = 'application/json'
+    response.headers.extend(headers)
+    response.headers['ETag'] = etag
+    # Clients may keep the response but must revalidate it before use
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Requests of every server process count as activity for the maintenance worker
+maintenance.set_activity_file(os.path.join(DATA_FOLDER, '.activity'))
+
+# Let the background maintenance worker know when requests are running,
+# so it only vacuums the database while the backend is quiet
+# Remember when the request started for the latency metrics
+@app.before_request
+def track_request_start():
+    maintenance.request_started()
+    g.request_started = time.perf_counter()
+
+# Record request count, latency and bytes served per route
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        metrics.HTTP_LATENCY.observe(time.perf_counter() - started, route=route)
+    metrics.HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    if response.content_length:
+        metrics.HTTP_RESPONSE_BYTES.inc(response.content_length, route=route)
+    return response
+
+@app.teardown_request
+def track_request_end(exception=None):
+    maintenance.request_finished()
+
+# Background maintenance totals, read when /metrics is scraped
+metrics.FunctionMetric(
+    'heartai_maintenance_reclaimed_bytes_total', 'Bytes reclaimed by background maintenance.',
+    lambda: maintenance.stats['file_bytes_reclaimed'] + maintenance.stats['db_bytes_reclaimed'],
+    kind='counter'
+)
+metrics.FunctionMetric(
+    'heartai_maintenance_files_removed_total', 'Orphaned files removed by background maintenance.',
+    lambda: maintenance.stats['files_removed'], kind='counter'
+)
+
 def validate_credentials(username, password_md5):
     # Function to validate user credentials
     # Takes username and MD5-hashed password as input
@@ -94,7 +195,7 @@ def validate_credentials(username, password_md5):
     # Raises exception if credentials are invalid or database error occurs
 
     try:
-        with sqlite3.connect(MASTER_DB) as con:
+        with connect_db() as con:
             # Create a database cursor object
             # Execute SQL query to fetch user role
             # Query parameters are username and password hash
@@ -143,16 +244,17 @@ def create_user():
 # Ensure directory creation doesn't fail if it exists
 
 
-        # Create a unique folder for the user
+        # Create a unique folder name for the user
+        # Recordings are kept in the content-addressed store, so no directory
+        # is created on disk for the user
         folder_name = str(uuid.uuid4())
-        os.makedirs(os.path.join(DATA_FOLDER, folder_name), exist_ok=True)
 # Establish a connection to the SQLite database
 # Create a cursor object for database operations
 # Execute an SQL statement to insert new user data
 # Begin database transaction to add new user
 
 
-        with sqlite3.connect(MASTER_DB) as con:
+        with connect_db() as con:
             cur = con.cursor()
             cur.execute(
                 # SQL query to insert a new user into the database
@@ -225,6 +327,12 @@ def login():
 
         return jsonify({'error': 'Failed to log in'}), 500
 
+def overloaded_response(e):
+    # 503 with a Retry-After estimate for an upload turned away by admission control
+    response = jsonify({'error': 'Server busy, please retry later', 'retry_after': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     # Function docstring: API endpoint for audio upload and analysis
@@ -233,6 +341,10 @@ def upload_file():
     # Try block for processing the uploaded audio file
 
     try:
+        # Turn the upload away before its body is read when inference is
+        # saturated; reading the form below receives and stores the whole file
+        admission.inference_gate.check()
+
         # Get username from the form data
         # Get MD5-hashed password from the form data
         # Get patient name from the form data
@@ -259,69 +371,180 @@ def upload_file():
         if not file:
             return jsonify({'error': 'No file data provided'}), 400
 
-        # Save the uploaded file
-        # Get the current epoch timestamp
-        # Generate a unique UUID for the filename
-        # Create the user's folder path
-        # Create the directory if it doesn't exist
-
-        epoch = int(time.time())
-        folder_name = str(uuid.uuid4())
-        user_folder = os.path.join(DATA_FOLDER, folder_name)
-        os.makedirs(user_folder, exist_ok=True)
-# Construct the filename using epoch timestamp
-# Create the full file path
-# Save the uploaded file to the designated path
-# Save the uploaded audio file
+        # Wait for a free inference slot before doing any work
+        # Turn the upload away at once when inference is saturated
+        # so the request thread is free for cheap endpoints again
+
+        admission.inference_gate.acquire()
+        slot_started = time.monotonic()
+        try:
+            return process_upload(username, patient_name, file)
+        finally:
+            admission.inference_gate.release(time.monotonic() - slot_started)
+    # Refuse files that are too large or are not WAV/FLAC recordings
+    # These are detected while the body streams in, before any analysis
+    # Handle any exceptions during file upload
+    # Log the exception details for debugging purposes
+    # Return an error message to the client
 
+    except admission.Overloaded as e:
+        return overloaded_response(e)
+    except storage.UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except storage.InvalidAudio as e:
+        return jsonify({'error': str(e)}), 400
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
+    except Exception as e:
+        print(f"Error during file upload: {e}")
+        return jsonify({'error': 'Failed to process the file'}), 500
 
-        file_name = f"{epoch}.wav"
-        file_path = os.path.join(user_folder, file_name)
-        file.save(file_path)
+def process_upload(username, patient_name, file):
+    # Store, analyze and record one uploaded file
+    # Runs while holding an inference slot
+    # Errors are handled by upload_file
+    # Save the uploaded file
+    # Get the current epoch timestamp
+    # Write the file into the content-addressed store
+    # The stored path is derived from the SHA-256 of the recording
+
+    epoch = int(time.time())
+    # The upload was already streamed into the store while the request was parsed
+    stored_path, _, _ = file.stream.commit()
+    file_path = storage.resolve(DATA_FOLDER, stored_path)
 # Begin audio file analysis
 # Call the audio analysis function
 # Process the uploaded audio file
 # Perform HeartAI inference and spectrogram generation
 
 
-        # Perform analysis on the file
-        inference_result = create_inference_and_spectrogram_file(file_path)
-
-        # Get the relative path of the uploaded file
-        # Prepare to store file information in the database
-        # Establish a database connection
-        # Begin database transaction to update file information
+    # Perform analysis on the file
+    # Record the time spent in each pipeline stage
+    timings = {}
+    scores = {}
+    metrics.INFERENCE_IN_PROGRESS.inc()
+    try:
+        inference_result = create_inference_and_spectrogram_file(file_path, timings, scores)
+    finally:
+        metrics.INFERENCE_IN_PROGRESS.dec()
+    metrics.observe_stage_timings(timings)
 
-        # Store relative paths
-        relative_file_path = os.path.relpath(file_path, DATA_FOLDER)
+    # Store the stored path of the uploaded file
+    # Establish a database connection
+    # Begin database transaction to update file information
 
-        with sqlite3.connect(MASTER_DB) as con:
-            # Create a database cursor object
-            # Execute SQL query to insert analysis data
-            # Insert analysis results into the database
-            # Add a new entry to the analysis history table
+    with connect_db() as con:
+        # Create a database cursor object
+        # Execute SQL query to insert analysis data
+        # Insert analysis results into the database
+        # Add a new entry to the analysis history table
+
+        cur = con.cursor()
+        cur.execute(
+            "INSERT INTO analysis_history (username, epoch, file_path, inference, patient_name, inference_score, modified_epoch) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (username, epoch, stored_path, inference_result, patient_name, scores.get('score'), int(time.time()))
+        # Commit changes to the database
+        # Return analysis results with HTTP status code 200
+        # Send the analysis results to the client
+        # Complete the file upload and analysis process
+
+        )
+        response_cache.bump_version(cur, username)
+        con.commit()
+
+    return jsonify({'epoch': epoch, 'inference': inference_result}), 200
+
+@app.route('/upload_session', methods=['POST'])
+def upload_session():
+    # API endpoint for the recordings of one visit, scored together
+    # One file per auscultation site, in form fields named AV, MV, PV and TV
+    # Takes the same credentials and patient name as /upload
+    # The limit covers one recording per site; each file still gets MAX_UPLOAD_BYTES
+
+    request.max_content_length = len(SESSION_SITES) * MAX_UPLOAD_BYTES + 64 * 1024
+    try:
+        # Before the body is read, as for /upload
+        admission.inference_gate.check()
 
-            cur = con.cursor()
-            cur.execute(
-                "INSERT INTO analysis_history (username, epoch, file_path, inference, patient_name) VALUES (?, ?, ?, ?, ?)",
-                (username, epoch, relative_file_path, inference_result, patient_name)
-            # Commit changes to the database
-            # Return analysis results with HTTP status code 200
-            # Send the analysis results to the client
-            # Complete the file upload and analysis process
+        username = request.form.get('username')
+        password_md5 = request.form.get('password_md5')
+        patient_name = request.form.get('patient_name')
 
-            )
-            con.commit()
+        if not validate_credentials(username, password_md5):
+            return jsonify({'error': 'Invalid credentials'}), 401
 
-        return jsonify({'epoch': epoch, 'inference': inference_result}), 200
-    # Handle any exceptions during file upload
-    # Log the exception details for debugging purposes
-    # Return an error message to the client
-    # Return error message with HTTP status code 500
+        unknown_sites = sorted(set(request.files) - set(SESSION_SITES))
+        if unknown_sites:
+            return jsonify({'error': f"Unknown auscultation sites: {', '.join(unknown_sites)}"}), 400
+        site_files = {site: request.files[site] for site in SESSION_SITES if site in request.files}
+        if not site_files:
+            return jsonify({'error': 'No file data provided'}), 400
 
+        # A whole session takes one inference slot, as a single upload does
+        admission.inference_gate.acquire()
+        slot_started = time.monotonic()
+        try:
+            return process_session(username, patient_name, site_files)
+        finally:
+            admission.inference_gate.release(time.monotonic() - slot_started)
+    except admission.Overloaded as e:
+        return overloaded_response(e)
+    except storage.UploadTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except storage.InvalidAudio as e:
+        return jsonify({'error': str(e)}), 400
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
     except Exception as e:
-        print(f"Error during file upload: {e}")
-        return jsonify({'error': 'Failed to process the file'}), 500
+        print(f"Error during session upload: {e}")
+        return jsonify({'error': 'Failed to process the session'}), 500
+
+def process_session(username, patient_name, site_files):
+    # Store and analyze the recordings of one visit
+    # The session and one analysis_history row per site are written in one
+    # transaction, so the history never shows part of a session
+    # Runs while holding an inference slot; errors are handled by upload_session
+
+    epoch = int(time.time())
+    stored_paths = {site: file.stream.commit()[0] for site, file in site_files.items()}
+    timings = {}
+    metrics.INFERENCE_IN_PROGRESS.inc()
+    try:
+        site_results, session_result = create_session_inference(
+            {site: storage.resolve(DATA_FOLDER, stored_path) for site, stored_path in stored_paths.items()}, timings)
+    finally:
+        metrics.INFERENCE_IN_PROGRESS.dec()
+    for result in site_results.values():
+        metrics.observe_stage_timings(result['timings'])
+    metrics.observe_stage_timings({'predict': timings['predict']})
+
+    with connect_db() as con:
+        cur = con.cursor()
+        cur.execute(
+            "INSERT INTO analysis_session (username, epoch, patient_name, inference, inference_score, site) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (username, epoch, patient_name, session_result['label'], session_result['score'], session_result['site'])
+        )
+        session_id = cur.lastrowid
+        cur.executemany(
+            "INSERT INTO analysis_history (username, epoch, file_path, inference, patient_name, inference_score, "
+            "modified_epoch, session_id, site) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(username, epoch, stored_paths[site], result['label'], patient_name, result['score'], int(time.time()),
+              session_id, site) for site, result in site_results.items()]
+        )
+        response_cache.bump_version(cur, username)
+        con.commit()
+
+    return jsonify({
+        'session_id': session_id,
+        'epoch': epoch,
+        'inference': session_result['label'],
+        'score': session_result['score'],
+        'site': session_result['site'],
+        'sites': {site: {'inference': result['label'], 'score': result['score']}
+                  for site, result in site_results.items()},
+    }), 200
 
 # Define a Flask route for accessing analysis history
 # Route handles GET requests for history data
@@ -347,18 +570,52 @@ def access_history():
         # Construct SQL query to fetch analysis history
         # Execute the query to retrieve analysis history
 
-        with sqlite3.connect(MASTER_DB) as con:
+        # The history version is read before the records, so a response is
+        # never cached under a version newer than its contents
+
+        with connect_db() as con:
             cur = con.cursor()
-            query = "SELECT id, patient_name, epoch FROM analysis_history WHERE username=? ORDER BY epoch DESC"
-            rows = cur.execute(query, (username,)).fetchall()
+            version = response_cache.get_version(cur, username)
+            params = tuple(sorted(
+                (name, value) for name, value in request.args.items(multi=True)
+                if name not in ('username', 'password_md5')
+            ))
+
+            def build():
+                # Optional paging, ordering and search, done in SQL:
+                #   limit, offset   one page of records
+                #   sort            'date' (newest first, default) or 'patient_name'
+                #   search          case-insensitive part of the patient name
+                # X-Total-Count tells the client how many records match in total
+                where = "username=?"
+                where_params = [username]
+                search = request.args.get('search', '')
+                if search:
+                    escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                    where += " AND patient_name LIKE ? ESCAPE '\\'"
+                    where_params.append(f"%{escaped}%")
+                if request.args.get('sort') == 'patient_name':
+                    order = "patient_name COLLATE NOCASE, epoch DESC"
+                else:
+                    order = "epoch DESC"
+                query = f"SELECT id, patient_name, epoch FROM analysis_history WHERE {where} ORDER BY {order}, id DESC"
+                limit = request.args.get('limit', type=int)
+                query_params = list(where_params)
+                if limit is not None:
+                    query += " LIMIT ? OFFSET ?"
+                    query_params += [max(0, limit), max(0, request.args.get('offset', 0, type=int))]
+                rows = cur.execute(query, query_params).fetchall()
+                total = cur.execute(f"SELECT COUNT(*) FROM analysis_history WHERE {where}", where_params).fetchone()[0]
 # Transform query results into desired JSON format
 # Return the analysis history data
 # Return the formatted data with HTTP status code 200
 # Handle any exceptions that occur during processing
 
 
-        result = [{"id": row[0], "patient_name": row[1], "epoch": row[2]} for row in rows]
-        return jsonify(result), 200
+                result = [{"id": row[0], "patient_name": row[1], "epoch": row[2]} for row in rows]
+                return result, {'X-Total-Count': str(total)}
+
+            return cached_json_response(HISTORY_LIST_CACHE, (username, version, params), build)
     except Exception as e:
         # Log the exception details for debugging
         # Return an error message with HTTP status code 500
@@ -389,18 +646,22 @@ def view_history(record_id):
         # Verify user authorization for the requested record
         # Access control check for the requested record
 
-        if not validate_credentials(username, password_md5):
+        role = validate_credentials(username, password_md5)
+        if not role:
             return jsonify({'error': 'Invalid credentials'}), 401
 
         # Check if the user is authorized to access the record
         # Establish a database connection
         # Create a database cursor object
-        # Construct SQL query to fetch the record details
-        # Execute the query to retrieve the specific record
+        # Look up the record owner and the owner's history version together
+        # Only the owner can change a record, and every change bumps that version
 
-        with sqlite3.connect(MASTER_DB) as con:
+        with connect_db() as con:
             cur = con.cursor()
-            query = "SELECT patient_name, file_path, inference, doctor_notes, username FROM analysis_history WHERE id=?"
+            query = (
+                "SELECT h.username, COALESCE(v.version, 0) FROM analysis_history h "
+                "LEFT JOIN history_versions v ON v.username = h.username WHERE h.id=?"
+            )
             row = cur.execute(query, (record_id,)).fetchone()
 # Check if a record with the given ID exists
 # Extract the username associated with the record
@@ -408,42 +669,62 @@ def view_history(record_id):
 # Determine if the user has access to the record
 
 
-        if row:
-            record_username = row[4]
-            user_role = validate_credentials(username, password_md5)[0]
+            if row:
+                record_username, version = row
+                user_role = role[0]
 # Check if the user is authorized to access this record
 # Access control check: user must own the record or be a doctor
 # Return an error if access is denied
 # Handle unauthorized access attempts
 
 
-            # Allow access if the user owns the record or is a doctor
-            if username != record_username and user_role != 'doctor':
-                return jsonify({'error': 'Unauthorized access'}), 403
+                # Allow access if the user owns the record or is a doctor
+                if username != record_username and user_role != 'doctor':
+                    return jsonify({'error': 'Unauthorized access'}), 403
 # Return the record details as a JSON response
 # Include the patient's name in the response
 # Include the relative file path in the response
 # Construct the JSON response for the requested record
 
 
-            return jsonify({
-                "patient_name": row[0],
-                "file_path": row[1],  # Relative path
-                # Include the inference results in the response
-                # Include doctor's notes in the response
-                # Return the JSON response with HTTP status code 200
-                # Handle cases where no matching record is found
-
-                "inference": row[2],
-                "doctor_notes": row[3]
-            }), 200
-        else:
-            # Return a "Record not found" error
-            # Handle any exceptions that might occur
-            # Log the error details for debugging
-            # Return a generic error message
+                # Signed audio and spectrogram URLs, so the client needs no credentials to fetch them
+                # Their expiry is part of the cache key, so a cached response never holds stale URLs
+                expires = media_urls.expiry(MEDIA_URL_TTL, MEDIA_URL_BUCKET)
+
+                def build():
+                    query = (
+                        "SELECT h.patient_name, h.file_path, h.inference, h.doctor_notes, h.site, h.session_id, "
+                        "s.inference FROM analysis_history h LEFT JOIN analysis_session s ON s.id = h.session_id "
+                        "WHERE h.id=?"
+                    )
+                    details = cur.execute(query, (record_id,)).fetchone()
+                    return {
+                        "patient_name": details[0],
+                        "file_path": details[1],  # Relative path
+                        # Include the inference results in the response
+                        # Include doctor's notes in the response
+                        # Return the JSON response with HTTP status code 200
+                        # Handle cases where no matching record is found
+
+                        "inference": details[2],
+                        "doctor_notes": details[3],
+                        # Auscultation site, session and session result of records from /upload_session
+                        "site": details[4],
+                        "session_id": details[5],
+                        "session_inference": details[6],
+                        "audio_url": media_urls.signed_url(MEDIA_SECRET, details[1], 'audio', expires),
+                        "image_url": media_urls.signed_url(MEDIA_SECRET, details[1], 'image', expires)
+                    }, {}
+
+                cache_key = (record_username, version, record_id, expires)
+                return cached_json_response(HISTORY_DETAIL_CACHE, cache_key, build)
+            else:
+                # Return a "Record not found" error
+                # Handle any exceptions that might occur
+                # Log the error details for debugging
+                # Return a generic error message
 
-            return jsonify({'error': 'Record not found'}), 404
+                return jsonify({'error': 'Record not found'}), 404
     except Exception as e:
         print(f"Error retrieving history details: {e}")
         return jsonify({'error': 'Failed to retrieve history details'}), 500
@@ -483,7 +764,7 @@ def update_notes(record_id):
         if user_role != 'doctor':
             return jsonify({'error': 'Unauthorized: Only doctors can update notes'}), 403
 
-        with sqlite3.connect(MASTER_DB) as con:
+        with connect_db() as con:
             # Create a database cursor object
             # Query to check if the record exists
             # Fetch the username associated with the record ID
@@ -525,9 +806,10 @@ def update_notes(record_id):
                 # Execute the update query
                 # Commit changes to the database
 
-                "UPDATE analysis_history SET doctor_notes=? WHERE id=?",
-                (doctor_notes, record_id)
+                "UPDATE analysis_history SET doctor_notes=?, modified_epoch=? WHERE id=?",
+                (doctor_notes, int(time.time()), record_id)
             )
+            response_cache.bump_version(cur, record_username)
             con.commit()
 # Return a success message to the client
 # Return success status code
@@ -577,7 +859,7 @@ def delete_record(record_id):
 # Verify record existence and ownership
 
 
-        with sqlite3.connect(MASTER_DB) as con:
+        with connect_db() as con:
             cur = con.cursor()
             # Check if the record exists and belongs to the user
             # Execute the query to check record existence and ownership
@@ -585,7 +867,7 @@ def delete_record(record_id):
             # Check if a matching record was found
             # Handle cases where the record does not exist
 
-            cur.execute("SELECT username, file_path FROM analysis_history WHERE id=?", (record_id,))
+            cur.execute("SELECT username, session_id FROM analysis_history WHERE id=?", (record_id,))
             row = cur.fetchone()
 
             if not row:
@@ -596,7 +878,7 @@ def delete_record(record_id):
 
                 return jsonify({'error': 'Record not found'}), 404
 
-            record_username, file_path = row
+            record_username, session_id = row
             if record_username != username:
                 # Return an error if the user is not authorized to delete the record
                 # Handle unauthorized deletion attempts
@@ -607,31 +889,19 @@ def delete_record(record_id):
 
             # Delete the record
             cur.execute("DELETE FROM analysis_history WHERE id=?", (record_id,))
-            # Commit the changes to the database
-            # Prepare to delete the associated files from the file system
-            # Construct the absolute path of the file to be deleted
-            # Get the full file path for deletion
-
+            # A session goes with the last of its site records
+            if session_id is not None:
+                cur.execute(
+                    "DELETE FROM analysis_session WHERE id=? AND NOT EXISTS "
+                    "(SELECT 1 FROM analysis_history WHERE session_id=?)", (session_id, session_id)
+                )
+            response_cache.bump_version(cur, record_username)
             con.commit()
 
-            # Optionally delete the files from the file system
-            full_file_path = os.path.abspath(os.path.join(DATA_FOLDER, file_path))
-            # Check if the file exists before attempting deletion
-            # Delete the audio file from the file system
-            # Construct the path to the spectrogram image
-            # Prepare to delete the associated spectrogram image
-
-            if os.path.exists(full_file_path):
-                os.remove(full_file_path)
-            # Also remove the spectrogram image
-            image_path = full_file_path.replace('.wav', '.png')
-            # Check if the spectrogram image exists
-            # Delete the spectrogram image from the file system
-            # Return a success message to the client
-            # Return HTTP status code 200 on successful deletion
-
-            if os.path.exists(image_path):
-                os.remove(image_path)
+            # The recording, spectrogram and inference files are left to the
+            # maintenance worker. Identical uploads share one stored recording,
+            # and a new upload of it can arrive at any moment; maintenance checks
+            # again right before removing a file that no record references it.
 
         return jsonify({'message': 'Record deleted successfully.'}), 200
     # Handle any exceptions during record deletion
@@ -667,7 +937,7 @@ def get_audio(record_id):
         # Construct SQL query to fetch file path and username
         # Execute the query to retrieve the file path and username
 
-        with sqlite3.connect(MASTER_DB) as con:
+        with connect_db() as con:
             cur = con.cursor()
             query = "SELECT file_path, username FROM analysis_history WHERE id=?"
             row = cur.execute(query, (record_id,)).fetchone()
@@ -694,7 +964,7 @@ def get_audio(record_id):
             # Create a Flask response to send the audio file
             # Set CORS headers to allow access from any origin
 
-            full_file_path = os.path.abspath(os.path.join(DATA_FOLDER, file_path))
+            full_file_path = storage.resolve(DATA_FOLDER, file_path, 'audio')
             if os.path.exists(full_file_path):
                 response = make_response(send_file(full_file_path, mimetype='audio/wav'))
                 response.headers['Access-Control-Allow-Origin'] = '*'
@@ -747,7 +1017,7 @@ def get_image(record_id):
 
             return jsonify({'error': 'Invalid credentials'}), 401
 
-        with sqlite3.connect(MASTER_DB) as con:
+        with connect_db() as con:
             cur = con.cursor()
             # Construct SQL query to fetch file path and username
             # Execute the query to retrieve the file path and username
@@ -774,14 +1044,12 @@ def get_image(record_id):
 
                 return jsonify({'error': 'Unauthorized access'}), 403
 
-            # Replace .wav with .png to get the image path
-            image_relative_path = file_path.replace('.wav', '.png')
-            # Construct the full path to the spectrogram image
+            # Resolve the spectrogram stored next to the recording
             # Check if the image file exists
             # Create a Flask response to send the image file
             # Set CORS headers to allow access from any origin
 
-            full_image_path = os.path.abspath(os.path.join(DATA_FOLDER, image_relative_path))
+            full_image_path = storage.resolve(DATA_FOLDER, file_path, 'image')
             if os.path.exists(full_image_path):
                 response = make_response(send_file(full_image_path, mimetype='image/png'))
                 response.headers['Access-Control-Allow-Origin'] = '*'
@@ -810,7 +1078,50 @@ def get_image(record_id):
 
         return jsonify({'error': 'Failed to serve image file.'}), 500
 
-if __name__ == '__main__':
+@app.route('/media/<path:media_path>', methods=['GET'])
+def get_media(media_path):
+    # Serve a recording or spectrogram through a signed URL from /history/<id>
+    # Only the signature and expiry are checked, there is no database lookup
+    # Stored files never change, so the response may be cached until the URL expires,
+    # by the browser as well as by a reverse proxy in front of the backend
+    expires = request.args.get('expires', type=int)
+    signature = request.args.get('signature', '')
+    if expires is None or not media_urls.verify(MEDIA_SECRET, media_path, expires, signature):
+        return jsonify({'error': 'Invalid or expired media URL'}), 403
+
+    _, extension = os.path.splitext(media_path)
+    if extension not in media_urls.MEDIA_KINDS:
+        return jsonify({'error': 'File not found'}), 404
+    kind, mimetype = media_urls.MEDIA_KINDS[extension]
+    try:
+        full_path = storage.resolve(DATA_FOLDER, media_path, kind)
+    except ValueError:
+        return jsonify({'error': 'File not found'}), 404
+    if not os.path.exists(full_path):
+        print(f"Media file not found at: {full_path}")
+        return jsonify({'error': 'File not found'}), 404
+
+    max_age = max(0, expires - int(time.time()))
+    response = make_response(send_file(full_path, mimetype=mimetype, conditional=True))
+    response.headers['Cache-Control'] = f'public, max-age={max_age}, immutable'
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Expose runtime metrics in the Prometheus text format
+    # In multi-worker mode the snapshots of all workers are merged
+    response = make_response(metrics.render(metrics.collect()))
+    response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return response
+
+def init_database():
+    """
+    Create or migrate master.db. Every step checks what is already there, so it
+    is safe to run on each start. It runs when this module is imported (see
+    below): for `flask run` and `python app.py`, and in the gunicorn master
+    before the workers are forked.
+    """
     if not os.path.exists(MASTER_DB):
         # Handle database initialization
         # Establish database connection
@@ -820,6 +1131,8 @@ if __name__ == '__main__':
         # Initialize the database if it doesn't exist
         with sqlite3.connect(MASTER_DB) as con:
             cur = con.cursor()
+            # Free pages are given back by the maintenance worker
+            cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
             cur.execute(
                 # SQL statement to create the credentials table
                 # Define table schema for user credentials
@@ -847,6 +1160,10 @@ if __name__ == '__main__':
                     inference TEXT NOT NULL,
                     patient_name TEXT NOT NULL,
                     doctor_notes TEXT,
+                    inference_score REAL,
+                    modified_epoch INTEGER,
+                    session_id INTEGER,
+                    site TEXT,
                     FOREIGN KEY (username) REFERENCES credentials (username)
                 )"""
             )
@@ -870,4 +1187,65 @@ if __name__ == '__main__':
             if 'doctor_notes' not in columns:
                 cur.execute("ALTER TABLE analysis_history ADD COLUMN doctor_notes TEXT")
                 con.commit()
+            # Model score and last change time, used by the analytics export
+            if 'inference_score' not in columns:
+                cur.execute("ALTER TABLE analysis_history ADD COLUMN inference_score REAL")
+                con.commit()
+            if 'modified_epoch' not in columns:
+                cur.execute("ALTER TABLE analysis_history ADD COLUMN modified_epoch INTEGER")
+                cur.execute("UPDATE analysis_history SET modified_epoch = epoch")
+                con.commit()
+            # Session and auscultation site of records from /upload_session
+            if 'session_id' not in columns:
+                cur.execute("ALTER TABLE analysis_history ADD COLUMN session_id INTEGER")
+                cur.execute("ALTER TABLE analysis_history ADD COLUMN site TEXT")
+                con.commit()
+            # Switch older databases to incremental vacuum (one full VACUUM)
+            maintenance.enable_incremental_vacuum(con)
+
+    # Per-user history versions for the response cache
+    # Multi-site sessions and the result aggregated over their sites
+    # Index for the incremental analytics export
+    with sqlite3.connect(MASTER_DB) as con:
+        con.execute(response_cache.CREATE_TABLE_SQL)
+        con.execute(
+            """CREATE TABLE IF NOT EXISTS analysis_session (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                epoch INTEGER NOT NULL,
+                patient_name TEXT NOT NULL,
+                inference TEXT NOT NULL,
+                inference_score REAL,
+                site TEXT,
+                FOREIGN KEY (username) REFERENCES credentials (username)
+            )"""
+        )
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS idx_analysis_history_session ON analysis_history (session_id)"
+        )
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS idx_analysis_history_modified ON analysis_history (modified_epoch, id)"
+        )
+        # One page of a user's history is read from this index
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS idx_analysis_history_user_epoch ON analysis_history (username, epoch)"
+        )
+
+    # Readers never block the writer with several worker processes
+    with sqlite3.connect(MASTER_DB) as con:
+        con.execute("PRAGMA journal_mode = WAL")
+
+# Bring the database up to date however the app is started, so a database from
+# an older version never meets queries for tables and columns it does not have yet
+init_database()
+
+# Start the orphaned media and database space cleanup in the process that serves
+# requests, however it was started (flask run, python app.py). The lock file
+# lets only one process run it. Under gunicorn the master only imports the app
+# and each worker tries after it was forked (gunicorn.conf.py, post_fork), since
+# a thread started before the fork would not survive it.
+if os.environ.get('HEARTAI_START_MAINTENANCE', '1') != '0':
+    maintenance.start_worker(DATA_FOLDER, MASTER_DB, lock_path=os.path.join(DATA_FOLDER, '.maintenance.lock'))
+
+if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080)
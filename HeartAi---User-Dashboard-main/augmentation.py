@@ -0,0 +1,112 @@
+# On-the-fly augmentation of spectrogram batches for training.
+# Works on whole batches of shape (batch, frequency, time, channels) scaled to
+# [0, 1], as produced by the input pipelines in train_model.py. Each operation is
+# applied to every example of the batch at once with vectorized TensorFlow ops:
+#   time shift    circular shift along the time axis
+#   gain          level change in dB
+#   noise         additive white noise at a random SNR within a range
+#   masking       SpecAugment-style frequency and time masks
+# Gain and noise assume the [0, 1] range maps linearly to [-top_db, 0] dB, as for
+# the feature store; on rendered PNGs they are an approximation.
+# Random numbers come from stateless ops seeded per batch from one seed, so a run
+# with the same seed and data order sees the same augmentations.
+
+import json
+
+import tensorflow as tf
+
+DEFAULT_POLICY = {
+    'time_shift': 0.1,             # largest shift, as a fraction of the time axis (0 disables)
+    'gain_db': 6.0,                # largest level change in either direction (0 disables)
+    'noise_probability': 0.5,      # share of examples that get noise (0 disables)
+    'noise_snr_db': [10.0, 30.0],  # range the signal-to-noise ratio is drawn from
+    'freq_masks': 2,               # frequency masks per example
+    'freq_mask_width': 12,         # widest frequency mask, in bins
+    'time_masks': 2,               # time masks per example
+    'time_mask_width': 16,         # widest time mask, in frames
+    'top_db': 80.0,                # dB range represented by [0, 1]
+}
+
+
+def load_policy(path=None):
+    """
+    The default policy, updated with the values in a JSON file if one is given.
+    """
+    policy = dict(DEFAULT_POLICY)
+    if path:
+        with open(path) as policy_file:
+            overrides = json.load(policy_file)
+        unknown = set(overrides) - set(DEFAULT_POLICY)
+        if unknown:
+            raise ValueError(f"Unknown augmentation settings: {', '.join(sorted(unknown))}")
+        policy.update(overrides)
+    return policy
+
+
+def _seed(batch_seed, stream):
+    return tf.stack([batch_seed, tf.constant(stream, tf.int64)])
+
+
+def _masks(batch_seed, stream, batch_size, count, max_width, length):
+    # (batch, length) boolean: True inside any of count random bands per example
+    widths = tf.random.stateless_uniform((batch_size, count, 1), _seed(batch_seed, stream),
+                                         minval=0, maxval=max_width + 1, dtype=tf.int32)
+    starts = tf.cast(tf.random.stateless_uniform((batch_size, count, 1), _seed(batch_seed, stream + 1))
+                     * tf.cast(tf.maximum(length - widths, 1), tf.float32), tf.int32)
+    positions = tf.range(length)[None, None, :]
+    return tf.reduce_any((positions >= starts) & (positions < starts + widths), axis=1)
+
+
+def augment_batch(images, batch_seed, policy=DEFAULT_POLICY):
+    """
+    Augment one batch of spectrograms. batch_seed is an int64 scalar.
+    """
+    batch_size = tf.shape(images)[0]
+    frequencies = tf.shape(images)[1]
+    frames = tf.shape(images)[2]
+    top_db = policy['top_db']
+
+    if policy['time_shift']:
+        max_shift = tf.cast(tf.cast(frames, tf.float32) * policy['time_shift'], tf.int32)
+        shifts = tf.random.stateless_uniform((batch_size, 1), _seed(batch_seed, 1), minval=-max_shift,
+                                             maxval=max_shift + 1, dtype=tf.int32)
+        indices = tf.math.floormod(tf.range(frames)[None, :] - shifts, frames)
+        images = tf.gather(images, indices, axis=2, batch_dims=1)
+
+    if policy['gain_db']:
+        gains = tf.random.stateless_uniform((batch_size, 1, 1, 1), _seed(batch_seed, 2),
+                                            minval=-policy['gain_db'], maxval=policy['gain_db'])
+        images = tf.clip_by_value(images + gains / top_db, 0.0, 1.0)
+
+    if policy['noise_probability']:
+        low, high = policy['noise_snr_db']
+        power = tf.pow(10.0, (images * top_db - top_db) / 10.0)
+        signal_power = tf.reduce_mean(power, axis=[1, 2, 3], keepdims=True)
+        snr_db = tf.random.stateless_uniform((batch_size, 1, 1, 1), _seed(batch_seed, 3), minval=low, maxval=high)
+        noise_power = signal_power / tf.pow(10.0, snr_db / 10.0)
+        # White noise has exponentially distributed power in every bin
+        uniform = tf.random.stateless_uniform(tf.shape(images), _seed(batch_seed, 4), minval=1e-7, maxval=1.0)
+        noisy_power = power - noise_power * tf.math.log(uniform)
+        noisy = tf.clip_by_value((10.0 * tf.math.log(noisy_power) / tf.math.log(10.0) + top_db) / top_db, 0.0, 1.0)
+        apply = tf.random.stateless_uniform((batch_size, 1, 1, 1), _seed(batch_seed, 5)) < policy['noise_probability']
+        images = tf.where(apply, noisy, images)
+
+    # Masked bands are set to the floor of the range (-top_db)
+    if policy['freq_masks']:
+        masked = _masks(batch_seed, 6, batch_size, policy['freq_masks'], policy['freq_mask_width'], frequencies)
+        images = tf.where(masked[:, :, None, None], tf.zeros_like(images), images)
+    if policy['time_masks']:
+        masked = _masks(batch_seed, 8, batch_size, policy['time_masks'], policy['time_mask_width'], frames)
+        images = tf.where(masked[:, None, :, None], tf.zeros_like(images), images)
+
+    return images
+
+
+def augment_dataset(dataset, policy=DEFAULT_POLICY, seed=None):
+    """
+    Apply augment_batch to a batched (images, labels) dataset.
+    """
+    seeds = tf.data.Dataset.random(seed=seed)
+    dataset = tf.data.Dataset.zip((dataset, seeds))
+    return dataset.map(lambda batch, batch_seed: (augment_batch(batch[0], batch_seed, policy), batch[1]),
+                       num_parallel_calls=tf.data.AUTOTUNE)
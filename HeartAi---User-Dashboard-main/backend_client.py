@@ -0,0 +1,151 @@
+# HTTP client for the HeartAI backend, used by the Streamlit app.
+# One pooled requests.Session keeps connections to the backend alive between
+# calls, so a page rerun does not pay a TCP handshake per request. Idempotent
+# requests (GET) are retried with exponential backoff on connection errors and
+# 502/503/504; uploads and other POSTs are never retried automatically.
+# History responses are revalidated with their ETag, so an unchanged history
+# costs a 304 without a body.
+#
+# Settings (environment variables):
+#   HEARTAI_BACKEND_URL              backend address (default http://127.0.0.1:8080)
+#   HEARTAI_BACKEND_CONNECT_TIMEOUT  seconds to establish a connection (default 3.05)
+#   HEARTAI_BACKEND_READ_TIMEOUT     seconds to wait for a response (default 30)
+#   HEARTAI_BACKEND_UPLOAD_TIMEOUT   seconds to wait for an analysis (default 300)
+#   HEARTAI_BACKEND_RETRIES          retries of idempotent requests (default 3)
+
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_BACKEND_URL = "http://127.0.0.1:8080"
+ETAG_CACHE_ENTRIES = 256
+
+
+class BackendClient:
+    def __init__(self, base_url=DEFAULT_BACKEND_URL, connect_timeout=3.05, read_timeout=30,
+                 upload_timeout=300, retries=3, pool_size=10, etag_cache_entries=ETAG_CACHE_ENTRIES):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.upload_timeout = (connect_timeout, upload_timeout)
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Last 200 response per URL, returned again when the backend answers 304
+        # (etag_cache_entries=0 turns revalidation off and always fetches the body)
+        self.etag_cache_entries = etag_cache_entries
+        self._etag_cache = OrderedDict()
+        self._etag_lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            base_url=os.environ.get('HEARTAI_BACKEND_URL', DEFAULT_BACKEND_URL),
+            connect_timeout=float(os.environ.get('HEARTAI_BACKEND_CONNECT_TIMEOUT', 3.05)),
+            read_timeout=float(os.environ.get('HEARTAI_BACKEND_READ_TIMEOUT', 30)),
+            upload_timeout=float(os.environ.get('HEARTAI_BACKEND_UPLOAD_TIMEOUT', 300)),
+            retries=int(os.environ.get('HEARTAI_BACKEND_RETRIES', 3)),
+        )
+
+    def _url(self, path):
+        return f"{self.base_url}{path}"
+
+    def _get_revalidated(self, path, params):
+        """
+        GET with If-None-Match. On 304 the previously received response is
+        returned, so callers always see a 200 with a body.
+        """
+        key = path + '?' + urlencode(sorted(params.items()))
+        with self._etag_lock:
+            cached = self._etag_cache.get(key)
+        headers = {'If-None-Match': cached.headers['ETag']} if cached is not None else {}
+        response = self.session.get(self._url(path), params=params, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and cached is not None:
+            with self._etag_lock:
+                self._etag_cache.move_to_end(key)
+            return cached
+        if response.status_code == 200 and 'ETag' in response.headers and self.etag_cache_entries > 0:
+            with self._etag_lock:
+                self._etag_cache[key] = response
+                self._etag_cache.move_to_end(key)
+                while len(self._etag_cache) > self.etag_cache_entries:
+                    self._etag_cache.popitem(last=False)
+        return response
+
+    # Endpoints ------------------------------------------------------------
+
+    def login(self, username, password_md5):
+        return self.session.post(self._url('/login'), json={"username": username, "password_md5": password_md5},
+                                 timeout=self.timeout)
+
+    def create_user(self, username, password_md5, role):
+        return self.session.post(self._url('/createuser'),
+                                 json={"username": username, "password_md5": password_md5, "role": role},
+                                 timeout=self.timeout)
+
+    def upload(self, username, password_md5, patient_name, file_name, file_object):
+        return self.session.post(
+            self._url('/upload'),
+            files={"file": (file_name, file_object)},
+            data={"username": username, "password_md5": password_md5, "patient_name": patient_name},
+            timeout=self.upload_timeout,
+        )
+
+    def upload_session(self, username, password_md5, patient_name, site_files):
+        """
+        Upload the recordings of one visit for scoring together. site_files maps
+        an auscultation site ('AV', 'MV', 'PV', 'TV') to (file_name, file_object).
+        """
+        return self.session.post(
+            self._url('/upload_session'),
+            files=dict(site_files),
+            data={"username": username, "password_md5": password_md5, "patient_name": patient_name},
+            timeout=self.upload_timeout,
+        )
+
+    def access_history(self, username, password_md5, limit=None, offset=None, sort=None, search=None):
+        """
+        The user's records, newest first or by patient name (sort='patient_name'),
+        optionally one page (limit, offset) and filtered by patient name (search).
+        The X-Total-Count response header holds the number of matching records.
+        """
+        params = {"username": username, "password_md5": password_md5}
+        for name, value in (('limit', limit), ('offset', offset), ('sort', sort), ('search', search)):
+            if value not in (None, ''):
+                params[name] = value
+        return self._get_revalidated('/accesshistory', params)
+
+    def history_details(self, record_id, username, password_md5):
+        return self._get_revalidated(f'/history/{record_id}', {"username": username, "password_md5": password_md5})
+
+    def update_notes(self, record_id, username, password_md5, doctor_notes):
+        return self.session.post(
+            self._url(f'/update_notes/{record_id}'),
+            json={"username": username, "password_md5": password_md5, "doctor_notes": doctor_notes},
+            timeout=self.timeout,
+        )
+
+    def delete_record(self, record_id, username, password_md5):
+        return self.session.post(self._url(f'/delete_record/{record_id}'),
+                                 json={"username": username, "password_md5": password_md5},
+                                 timeout=self.timeout)
+
+    def media_url(self, signed_path):
+        """
+        Absolute URL of a record's audio or spectrogram, from the signed path in
+        its history details (audio_url, image_url). Fetched by the browser.
+        """
+        return self._url(signed_path)
@@ -0,0 +1,313 @@
+# Dataset manifest: one SQLite file describing every recording and rendered
+# spectrogram of the training data, so training and preprocessing tools agree on
+# what the dataset contains and do not each walk the directories.
+# One row per file, with the path relative to the application folder, the
+# folder it came from, its label, the patient id and
+# valve position parsed from names like 13918_AV, the duration and sample rate
+# of recordings, and the size, mtime and SHA-256 of the content.
+# Recordings are indexed where they were recorded into, dataset/, and take the
+# label of the rendered image with the same name in dataset/Absent or
+# dataset/Present. Only a checkout without recordings in dataset/ falls back to
+# the train/ and test/ copies made by the old separate_dataset.py, each
+# recording name indexed once.
+# Train/test splits and cross-validation folds are stored in the same file
+# (splits table, written by helper_tools/separate_dataset.py) as a fold number
+# per file, so no recording is copied. All files of a patient share a fold.
+
+import os
+import re
+import time
+import random
+import sqlite3
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_PATH = os.path.join(BASE_DIR, 'dataset_manifest.db')
+CLASS_NAMES = ['Absent', 'Present']  # 'Absent' is label 0, 'Present' is label 1
+IMAGE_FOLDER = 'dataset'
+AUDIO_FOLDER = 'dataset'
+FALLBACK_AUDIO_FOLDERS = ['train', 'test']
+
+# Patient id and auscultation site, e.g. 13918_AV.wav or Grayscale_49952_MV_1.wav.png
+NAME_PATTERN = re.compile(r'(\d+)_(AV|MV|PV|TV|Phc)')
+
+CREATE_TABLE_SQL = """CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    label INTEGER,
+    patient_id TEXT,
+    valve TEXT,
+    duration REAL,
+    sample_rate INTEGER,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+)"""
+
+CREATE_INDEXES_SQL = [
+    "CREATE INDEX IF NOT EXISTS idx_files_kind_folder ON files(kind, folder)",
+    "CREATE INDEX IF NOT EXISTS idx_files_patient ON files(patient_id)",
+]
+
+CREATE_SPLITS_SQL = [
+    """CREATE TABLE IF NOT EXISTS splits (
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    fold INTEGER NOT NULL,
+    PRIMARY KEY (name, path)
+)""",
+    """CREATE TABLE IF NOT EXISTS split_runs (
+    name TEXT PRIMARY KEY,
+    folds INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+)""",
+]
+
+COLUMNS = ('path', 'folder', 'kind', 'label', 'patient_id', 'valve', 'duration', 'sample_rate',
+           'size', 'mtime_ns', 'sha256')
+
+
+def parse_name(file_name):
+    """
+    Return (patient_id, valve) parsed from a file name, or (None, None).
+    """
+    match = NAME_PATTERN.search(file_name)
+    return (match.group(1), match.group(2)) if match else (None, None)
+
+
+def recording_name(image_name):
+    """
+    Name of the recording a rendered image belongs to:
+    Grayscale_13918_AV.wav.png -> 13918_AV.wav
+    """
+    if image_name.startswith('Grayscale_'):
+        image_name = image_name[len('Grayscale_'):]
+    return image_name[:-len('.png')] if image_name.endswith('.png') else image_name
+
+
+def group_key(path, patient_id=None):
+    """
+    Key grouping the files of one patient: the patient id, parsed from the file
+    name if not given, or the recording name for files without one.
+    """
+    name = path.replace(os.sep, '/').rsplit('/', 1)[-1]
+    if patient_id is None:
+        patient_id = parse_name(name)[0]
+    return patient_id or recording_name(name)
+
+
+def connect(manifest_path=MANIFEST_PATH):
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(f"No dataset manifest at {manifest_path}; build it with helper_tools/build_manifest.py")
+    con = sqlite3.connect(manifest_path)
+    con.row_factory = sqlite3.Row
+    return con
+
+
+def query(manifest_path=MANIFEST_PATH, kind=None, folders=None, labelled=False, split=None, split_folds=None):
+    """
+    Manifest rows as dicts, ordered by path, with 'path' made absolute.
+    With a split name, only the files in that split are returned, each with its
+    'fold', optionally limited to the folds in split_folds.
+    """
+    conditions = []
+    params = []
+    join = ""
+    if split:
+        join = " JOIN splits ON splits.path = files.path AND splits.name = ?"
+        params.append(split)
+        if split_folds is not None:
+            conditions.append(f"splits.fold IN ({', '.join('?' * len(split_folds))})")
+            params.extend(split_folds)
+    if kind:
+        conditions.append("kind = ?")
+        params.append(kind)
+    if folders:
+        conditions.append(f"folder IN ({', '.join('?' * len(folders))})")
+        params.extend(folders)
+    if labelled:
+        conditions.append("label IS NOT NULL")
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    root = os.path.dirname(os.path.abspath(manifest_path))
+    con = connect(manifest_path)
+    try:
+        columns = "files.*, splits.fold" if split else "files.*"
+        rows = con.execute(f"SELECT {columns} FROM files{join}{where} ORDER BY files.path", params).fetchall()
+    finally:
+        con.close()
+    entries = []
+    for row in rows:
+        entry = dict(row)
+        entry['path'] = os.path.join(root, *entry['path'].split('/'))
+        entries.append(entry)
+    return entries
+
+
+def split_exists(manifest_path=MANIFEST_PATH, name='default'):
+    """
+    Whether the manifest holds a split of this name.
+    """
+    if not os.path.exists(manifest_path):
+        return False
+    con = connect(manifest_path)
+    try:
+        return con.execute("SELECT 1 FROM split_runs WHERE name = ?", (name,)).fetchone() is not None
+    except sqlite3.OperationalError:
+        # No split was ever written to this manifest
+        return False
+    finally:
+        con.close()
+
+
+def _scan(root, folder, extension):
+    # (relative path, stat) of the files with the extension below root/folder
+    found = []
+    for dir_path, _, files in os.walk(os.path.join(root, folder)):
+        for file_name in files:
+            if file_name.endswith(extension):
+                full_path = os.path.join(dir_path, file_name)
+                found.append((os.path.relpath(full_path, root).replace(os.sep, '/'), os.stat(full_path)))
+    return found
+
+
+def _describe(root, relative_path, kind):
+    full_path = os.path.join(root, *relative_path.split('/'))
+    digest = hashlib.sha256()
+    with open(full_path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(chunk)
+    duration = sample_rate = None
+    if kind == 'audio':
+        import soundfile
+        info = soundfile.info(full_path)
+        duration, sample_rate = info.duration, info.samplerate
+    return digest.hexdigest(), duration, sample_rate
+
+
+def _scan_recordings(root, audio_folders):
+    # (folder, relative path, stat) of the recordings; without audio_folders,
+    # those in dataset/, or else one copy of each from train/ and test/
+    if audio_folders:
+        return [(folder, path, stat) for folder in audio_folders for path, stat in _scan(root, folder, '.wav')]
+    found = [(AUDIO_FOLDER, path, stat) for path, stat in _scan(root, AUDIO_FOLDER, '.wav')]
+    if found:
+        return found
+    names = set()
+    for folder in FALLBACK_AUDIO_FOLDERS:
+        for path, stat in sorted(_scan(root, folder, '.wav')):
+            name = path.rsplit('/', 1)[-1]
+            if name not in names:
+                names.add(name)
+                found.append((folder, path, stat))
+    return found
+
+
+def build(manifest_path=MANIFEST_PATH, image_folder=IMAGE_FOLDER, audio_folders=None, workers=8):
+    """
+    Create or update the manifest. Recordings are read from audio_folders, by
+    default from the original ones (see above). Files whose size and mtime are
+    unchanged keep their stored hash and audio details; removed files are dropped.
+    Returns a dict with counts of the files described and reused.
+    """
+    started = time.perf_counter()
+    root = os.path.dirname(os.path.abspath(manifest_path))
+    scanned = []
+    labels = {}
+    for label, class_name in enumerate(CLASS_NAMES):
+        for relative_path, stat in _scan(root, f"{image_folder}/{class_name}", '.png'):
+            scanned.append((relative_path, image_folder, 'image', label, stat))
+            labels[recording_name(relative_path.rsplit('/', 1)[-1])] = label
+    for folder, relative_path, stat in _scan_recordings(root, audio_folders):
+        scanned.append((relative_path, folder, 'audio', labels.get(relative_path.rsplit('/', 1)[-1]), stat))
+
+    con = sqlite3.connect(manifest_path)
+    try:
+        con.execute(CREATE_TABLE_SQL)
+        for statement in CREATE_INDEXES_SQL:
+            con.execute(statement)
+        known = {row[0]: row[1:] for row in con.execute(
+            "SELECT path, size, mtime_ns, sha256, duration, sample_rate FROM files")}
+
+        to_describe = [(path, kind) for path, _, kind, _, stat in scanned
+                       if known.get(path, (None, None))[:2] != (stat.st_size, stat.st_mtime_ns)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            described = dict(zip((path for path, _ in to_describe),
+                                 pool.map(lambda item: _describe(root, *item), to_describe)))
+
+        rows = []
+        for path, folder, kind, label, stat in scanned:
+            sha256, duration, sample_rate = described[path] if path in described else known[path][2:]
+            patient_id, valve = parse_name(path.rsplit('/', 1)[-1])
+            rows.append((path, folder, kind, label, patient_id, valve, duration, sample_rate,
+                         stat.st_size, stat.st_mtime_ns, sha256))
+
+        with con:
+            con.execute("DELETE FROM files")
+            con.executemany(f"INSERT INTO files ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+    finally:
+        con.close()
+    return {'files': len(rows), 'described': len(described), 'reused': len(rows) - len(described),
+            'removed': len(set(known) - {row[0] for row in rows}), 'seconds': time.perf_counter() - started}
+
+
+def assign_folds(groups, folds, seed=0):
+    """
+    Assign groups to folds, stratified by label.
+    groups maps a group key to (label, file count); returns key -> fold.
+    Groups are taken largest first, in an order shuffled by the seed, and each
+    goes to the fold holding the fewest files of its label so far.
+    """
+    keys = sorted(groups)
+    random.Random(seed).shuffle(keys)
+    keys.sort(key=lambda key: -groups[key][1])
+    files_per_label = {}
+    files_per_fold = [0] * folds
+    assignment = {}
+    for key in keys:
+        label, count = groups[key]
+        label_counts = files_per_label.setdefault(label, [0] * folds)
+        fold = min(range(folds), key=lambda candidate: (label_counts[candidate], files_per_fold[candidate]))
+        label_counts[fold] += count
+        files_per_fold[fold] += count
+        assignment[key] = fold
+    return assignment
+
+
+def split(manifest_path=MANIFEST_PATH, name='default', folds=5, seed=0):
+    """
+    Write a patient-grouped, label-stratified split of every file in the
+    manifest into folds, replacing an earlier split of the same name.
+    Files without a patient id are grouped with the other files of the same
+    recording. A group takes the Present label if any of its files has it.
+    Returns the number of files assigned.
+    """
+    if folds < 2:
+        raise ValueError("A split needs at least 2 folds")
+    con = connect(manifest_path)
+    try:
+        files = con.execute("SELECT path, label, patient_id FROM files").fetchall()
+        group_of = {}
+        groups = {}
+        for path, label, patient_id in files:
+            key = group_key(path, patient_id)
+            group_of[path] = key
+            group_label, count = groups.get(key, (None, 0))
+            if label is not None:
+                group_label = label if group_label is None else max(group_label, label)
+            groups[key] = (group_label, count + 1)
+        assignment = assign_folds(groups, folds, seed)
+
+        for statement in CREATE_SPLITS_SQL:
+            con.execute(statement)
+        with con:
+            con.execute("DELETE FROM splits WHERE name = ?", (name,))
+            con.executemany("INSERT INTO splits (name, path, fold) VALUES (?, ?, ?)",
+                            [(name, path, assignment[key]) for path, key in group_of.items()])
+            con.execute("INSERT OR REPLACE INTO split_runs (name, folds, seed, created_at) "
+                        "VALUES (?, ?, ?, datetime('now'))", (name, folds, seed))
+    finally:
+        con.close()
+    return len(group_of)
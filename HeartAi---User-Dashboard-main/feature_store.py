@@ -0,0 +1,223 @@
+# Precomputed mel spectrogram features for training and evaluation.
+# Mel dB arrays are computed once from the recordings with the same parameters as
+# heartai.extract_features and stored as float32 in one flat file:
+#   features/features-<build>.f32   all arrays, each stored (n_mels, frames) as the
+#                                   model reads it, one after another
+#   features/index.json             per recording: source, label, offset (in frames),
+#                                   shape, source size and mtime, feature config hash
+# Readers map the data file with np.memmap; the array of a recording is a plain
+# contiguous slice of it, so reading it copies nothing. A rebuild copies the arrays of unchanged recordings from the previous
+# data file and only recomputes recordings whose file or feature config changed.
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+FORMAT_VERSION = 2
+INDEX_FILE = 'index.json'
+
+# Same parameters as heartai.extract_features
+DEFAULT_CONFIG = {
+    'sample_rate': None,  # keep the recording's own sample rate
+    'n_mels': 128,
+    'fmax': 8000,
+    'n_fft': 2048,
+    'hop_length': 512,
+    'top_db': 80.0,
+}
+
+
+def config_hash(config):
+    """
+    Short hash identifying a feature configuration.
+    """
+    payload = json.dumps({'format': FORMAT_VERSION, 'config': config}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def compute_mel_db(path, config=DEFAULT_CONFIG):
+    """
+    Mel spectrogram of a recording in dB relative to its maximum, as a float32
+    array of shape (n_mels, frames).
+    """
+    import librosa
+    audio, sr = librosa.load(path, sr=config['sample_rate'])
+    spectrogram = librosa.feature.melspectrogram(y=audio, sr=sr, n_mels=config['n_mels'], fmax=config['fmax'],
+                                                 n_fft=config['n_fft'], hop_length=config['hop_length'])
+    spectrogram_db = librosa.power_to_db(spectrogram, ref=np.max, top_db=config['top_db'])
+    return np.ascontiguousarray(spectrogram_db, dtype=np.float32)
+
+
+def load_index(store_dir):
+    try:
+        with open(os.path.join(store_dir, INDEX_FILE)) as index_file:
+            return json.load(index_file)
+    except FileNotFoundError:
+        return None
+
+
+class FeatureStore:
+    """
+    Read-only view of a built feature store.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = load_index(store_dir)
+        if self.index is None:
+            raise FileNotFoundError(f"No feature store in {store_dir}; build it with helper_tools/build_feature_store.py")
+        self.config = self.index['config']
+        self.entries = self.index['entries']
+        self.n_mels = self.config['n_mels']
+        total_frames = self.index['total_frames']
+        if total_frames:
+            self.data = np.memmap(os.path.join(store_dir, self.index['data_file']), dtype=np.float32, mode='r',
+                                  shape=(total_frames * self.n_mels,))
+        else:
+            self.data = np.zeros(0, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def labels(self):
+        return np.array([entry['label'] for entry in self.entries], dtype=np.int64)
+
+    @property
+    def sources(self):
+        return [entry['source'] for entry in self.entries]
+
+    def features(self, position):
+        """
+        Mel dB array of one recording, shape (n_mels, frames). A contiguous view
+        into the memory-mapped file: nothing is copied until the values are used.
+        """
+        entry = self.entries[position]
+        start = entry['offset'] * self.n_mels
+        return self.data[start:start + entry['frames'] * self.n_mels].reshape(self.n_mels, entry['frames'])
+
+    def close(self):
+        """
+        Drop the store's mapping of the data file. The file is unmapped once no
+        array returned by features() is referenced any more.
+        """
+        del self.data
+
+    def positions(self, sources):
+        """
+        Positions of the given recordings (absolute paths) in the store.
+        """
+        by_source = {entry['source']: position for position, entry in enumerate(self.entries)}
+        return [by_source[os.path.abspath(source)] for source in sources]
+
+
+def _source_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _computed_in_order(pool, paths, config, window):
+    """
+    Yield the arrays of paths in order. At most window recordings are submitted
+    to the pool at a time, and a new one only when the oldest was taken, so the
+    arrays held in memory stay bounded however far the workers run ahead.
+    """
+    paths = iter(paths)
+    pending = deque(pool.submit(compute_mel_db, path, config) for path in itertools.islice(paths, window))
+    while pending:
+        array = pending.popleft().result()
+        for path in itertools.islice(paths, 1):
+            pending.append(pool.submit(compute_mel_db, path, config))
+        yield array
+
+
+def build(store_dir, sources, labels, config=DEFAULT_CONFIG, workers=None):
+    """
+    Create or update the feature store for the given recordings and labels
+    (-1 for unlabeled). Returns a dict with the number of reused and computed arrays.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    current_hash = config_hash(config)
+    previous = load_index(store_dir)
+    previous_store = None
+    previous_entries = {}
+    if previous is not None and previous.get('format') == FORMAT_VERSION:
+        previous_store = FeatureStore(store_dir)
+        previous_entries = {entry['source']: (position, entry) for position, entry in enumerate(previous['entries'])}
+
+    sources = [os.path.abspath(source) for source in sources]
+    reusable = {}
+    to_compute = []
+    stats = {}
+    for source in sources:
+        size, mtime_ns = stats[source] = _source_stat(source)
+        found = previous_entries.get(source)
+        if found and found[1]['config_hash'] == current_hash and found[1]['size'] == size \
+                and found[1]['mtime_ns'] == mtime_ns:
+            reusable[source] = found[0]
+        else:
+            to_compute.append(source)
+
+    build_id = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+    data_file = f"features-{build_id}.f32"
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir, suffix='.part')
+    entries = []
+    offset = 0
+    started = time.perf_counter()
+    try:
+        workers = workers or os.cpu_count() or 1
+        with os.fdopen(fd, 'wb') as data, ProcessPoolExecutor(max_workers=workers) as pool:
+            # Results come back in source order and are written as they arrive;
+            # with two recordings in flight per worker, at most that many arrays
+            # are held in memory at a time
+            computed = _computed_in_order(pool, to_compute, config, 2 * workers)
+            computed_count = 0
+            for source, label in zip(sources, labels):
+                if source in reusable:
+                    array = previous_store.features(reusable[source])
+                else:
+                    array = next(computed)
+                    computed_count += 1
+                    if computed_count % 100 == 0:
+                        print(f"  computed {computed_count}/{len(to_compute)}")
+                data.write(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+                size, mtime_ns = stats[source]
+                frames = int(array.shape[1])
+                entries.append({
+                    'source': source, 'label': int(label), 'offset': offset, 'frames': frames,
+                    'shape': [config['n_mels'], frames], 'size': size, 'mtime_ns': mtime_ns,
+                    'config_hash': current_hash,
+                })
+                offset += frames
+                del array
+        os.replace(tmp_path, os.path.join(store_dir, data_file))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    index = {'format': FORMAT_VERSION, 'config': config, 'config_hash': current_hash, 'data_file': data_file,
+             'total_frames': offset, 'entries': entries}
+    fd, tmp_index = tempfile.mkstemp(dir=store_dir, suffix='.part')
+    with os.fdopen(fd, 'w') as index_file:
+        json.dump(index, index_file, indent=1)
+    os.replace(tmp_index, os.path.join(store_dir, INDEX_FILE))
+
+    # The previous data file is no longer referenced, whatever its format
+    if previous_store is not None:
+        previous_store.close()
+    if previous is not None and previous.get('data_file') not in (None, data_file):
+        try:
+            os.remove(os.path.join(store_dir, previous['data_file']))
+        except OSError:
+            pass
+
+    return {'reused': len(reusable), 'computed': len(to_compute), 'frames': offset,
+            'seconds': time.perf_counter() - started}
@@ -0,0 +1,80 @@
+# Production server configuration: gunicorn -c gunicorn.conf.py app:app
+# A pre-forking WSGI server replaces the single-process Flask development server.
+# The application (Flask, librosa, matplotlib) is imported once in the master
+# process before the workers are forked. TensorFlow and the model are not: their
+# thread pools and locks do not survive a fork, so every worker starts TensorFlow
+# and loads the model itself after it was forked (post_fork below).
+#
+# Settings (environment variables):
+#   HEARTAI_BIND                  address to listen on (default 0.0.0.0:8080)
+#   HEARTAI_WORKERS               worker processes (default: number of cores)
+#   HEARTAI_THREADS               request threads per worker (default 4)
+#   HEARTAI_TIMEOUT               seconds before a stuck worker is restarted (default 120)
+#   HEARTAI_TF_INTRA_OP_THREADS   TensorFlow threads per op in each worker
+#                                 (default: cores divided by workers)
+#   HEARTAI_TF_INTER_OP_THREADS   TensorFlow ops run in parallel in each worker (default 1)
+#   HEARTAI_INFERENCE_CONCURRENCY uploads running inference at once in each worker (default 1)
+#   HEARTAI_INFERENCE_QUEUE       uploads waiting for inference in each worker
+#                                 (default: threads - 2, so a thread stays free for
+#                                 login, history and media requests)
+#   HEARTAI_INFERENCE_MAX_WAIT    seconds an upload may wait before a 503 (default 30)
+#   HEARTAI_PRELOAD_MODEL         0 here: the model is loaded in each worker after the
+#                                 fork (loading it in the master is unsafe)
+#   HEARTAI_START_MAINTENANCE     0 here: the maintenance thread is started in a worker
+#                                 after the fork, not in the master on import
+#   HEARTAI_METRICS_DIR           folder where workers share their /metrics snapshots
+#                                 (default: a fresh folder under the system temp folder)
+
+import gc
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('HEARTAI_BIND', '0.0.0.0:8080')
+workers = int(os.environ.get('HEARTAI_WORKERS', os.cpu_count() or 1))
+threads = int(os.environ.get('HEARTAI_THREADS', 4))
+worker_class = 'gthread'
+timeout = int(os.environ.get('HEARTAI_TIMEOUT', 120))
+preload_app = True
+
+# Keep TensorFlow and the maintenance thread out of the master; workers load the
+# model and start maintenance in post_fork.
+os.environ.setdefault('HEARTAI_PRELOAD_MODEL', '0')
+os.environ['HEARTAI_START_MAINTENANCE'] = '0'
+
+# TensorFlow reads its thread limits when the runtime starts in each worker;
+# the workers inherit these settings from the master's environment.
+os.environ.setdefault('HEARTAI_TF_INTRA_OP_THREADS', str(max(1, (os.cpu_count() or 1) // workers)))
+os.environ.setdefault('HEARTAI_TF_INTER_OP_THREADS', '1')
+
+# Bound inference per worker so that uploads never hold every request thread.
+os.environ.setdefault('HEARTAI_INFERENCE_CONCURRENCY', '1')
+os.environ.setdefault('HEARTAI_INFERENCE_QUEUE', str(max(0, threads - int(os.environ['HEARTAI_INFERENCE_CONCURRENCY']) - 1)))
+
+# Each worker writes its metrics here so /metrics, served by any one worker,
+# reports the totals of all of them.
+os.environ.setdefault('HEARTAI_METRICS_DIR', os.path.join(tempfile.gettempdir(), f"heartai-metrics-{os.getpid()}"))
+
+
+def on_starting(server):
+    # Runs once in the master, after the app was preloaded (which also created or
+    # migrated the database) and before any worker is forked.
+    # Snapshots of a previous run would be merged into the totals
+    shutil.rmtree(os.environ['HEARTAI_METRICS_DIR'], ignore_errors=True)
+    # Move everything allocated so far out of the garbage collector's reach, so
+    # collections in the workers don't write to (and un-share) those pages.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    import heartai
+    import maintenance
+    import metrics
+    # Start TensorFlow and load the model in this worker, before it takes requests
+    heartai.load_heart_model()
+    metrics.start_snapshot_writer()
+    # One worker runs the background maintenance; the lock moves to another
+    # worker if that one is restarted.
+    maintenance.start_worker(app.DATA_FOLDER, app.MASTER_DB,
+                             lock_path=os.path.join(app.DATA_FOLDER, '.maintenance.lock'))
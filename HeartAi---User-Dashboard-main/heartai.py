@@ -1,7 +1,7 @@
 # Import necessary libraries for audio processing and machine learning.
 # NumPy for numerical operations.
 # Librosa for audio analysis.
-# TensorFlow and Keras for model loading and prediction.
+# TensorFlow and Keras for model loading and prediction (imported when first used).
 # Use a non-interactive matplotlib backend (Agg) to avoid GUI issues.
 
 import matplotlib
@@ -9,8 +9,6 @@ matplotlib.use('Agg')  # Set non-interactive backend before importing pyplot
 import numpy as np
 import librosa
 import librosa.display  # Added to enable spectrogram plotting with librosa
-import tensorflow as tf
-from tensorflow.keras.models import load_model
 # Import libraries for plotting, image manipulation, and file operations.
 # Matplotlib for plotting.
 # PIL (Pillow) for image handling.
@@ -19,6 +17,11 @@ from tensorflow.keras.models import load_model
 import matplotlib.pyplot as plt
 from PIL import Image
 import os
+import tempfile
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 # Define the base directory for the project, model path, and spectrogram directory.
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -26,11 +29,59 @@ MODEL_PATH = os.path.join(BASE_DIR, 'models', 'heart_model.h5')
 SPECTROGRAM_DIR = os.path.join(BASE_DIR, 'spectrograms')
 os.makedirs(SPECTROGRAM_DIR, exist_ok=True)
 
-# Load the pre-trained heart disease prediction model and print the expected input shape.
-model = load_model(MODEL_PATH)
-print("Expected input shape for the model:", model.input_shape)
+# Limit TensorFlow's thread pools before the runtime starts. With several server
+# workers on one machine each worker gets a share of the cores, e.g.
+# HEARTAI_TF_INTRA_OP_THREADS=2 HEARTAI_TF_INTER_OP_THREADS=1.
+# Called by load_heart_model, so this happens in the process that runs the model.
+def configure_tensorflow_threads():
+    import tensorflow as tf
+    intra_op_threads = os.environ.get('HEARTAI_TF_INTRA_OP_THREADS')
+    inter_op_threads = os.environ.get('HEARTAI_TF_INTER_OP_THREADS')
+    try:
+        if intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(int(intra_op_threads))
+        if inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(int(inter_op_threads))
+    except RuntimeError as e:
+        # The runtime was already started by the calling program
+        print("TensorFlow thread settings not applied:", e)
+
+model = None
+_model_lock = threading.Lock()
+
+def load_heart_model():
+    """
+    Load the pre-trained heart disease prediction model once per process and
+    print the expected input shape.
+    """
+    global model
+    with _model_lock:
+        if model is None:
+            configure_tensorflow_threads()
+            from tensorflow.keras.models import load_model
+            model = load_model(MODEL_PATH)
+            print("Expected input shape for the model:", model.input_shape)
+    return model
+
+# The model is loaded at import time, so the first request does not wait for it.
+# HEARTAI_PRELOAD_MODEL=0 defers loading to the first call of load_heart_model(),
+# which a pre-forking server needs: TensorFlow's thread pools and locks do not
+# survive a fork, so the model must be loaded in each worker after it was forked.
+# Processes started by a multiprocessing pool (the session feature workers below,
+# the evaluation tool) only compute spectrograms and never import TensorFlow.
+if multiprocessing.current_process().name == 'MainProcess' and os.environ.get('HEARTAI_PRELOAD_MODEL', '1') != '0':
+    load_heart_model()
 
-def extract_features(input_Wave_Path, output_Image_Path):
+def _temp_path_beside(path):
+    """
+    Reserve a temporary file in the same directory as path, so that the final
+    os.replace is an atomic rename and readers never see a partial file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.part')
+    os.close(fd)
+    return tmp_path
+
+def extract_features(input_Wave_Path, output_Image_Path, timings=None):
     """
     Convert a .wav audio file into a mel spectrogram image, then preprocess it.
     Steps:
@@ -39,41 +90,138 @@ def extract_features(input_Wave_Path, output_Image_Path):
     - Plot and save the spectrogram as an image.
     - Resize image to 128x128, convert to grayscale, normalize pixel values.
     - Add batch and channel dimensions for model input.
+    If a timings dict is given, the seconds spent in each step are stored in it.
     """
+    if timings is None:
+        timings = {}
     try:
+        started = time.perf_counter()
         audio, sr = librosa.load(input_Wave_Path, sr=None)
+        timings['load'] = time.perf_counter() - started
+
+        started = time.perf_counter()
         spectrogram = librosa.feature.melspectrogram(y=audio, sr=sr, n_mels=128, fmax=8000)
         spectrogram_db = librosa.power_to_db(spectrogram, ref=np.max)
+        timings['melspectrogram'] = time.perf_counter() - started
 
+        started = time.perf_counter()
         plt.figure(figsize=(5, 5))
         librosa.display.specshow(spectrogram_db, sr=sr, hop_length=512, cmap='viridis')
         plt.axis('off')
-        plt.savefig(output_Image_Path, bbox_inches='tight', pad_inches=0)
+        tmp_Image_Path = _temp_path_beside(output_Image_Path)
+        plt.savefig(tmp_Image_Path, format='png', bbox_inches='tight', pad_inches=0)
         plt.close()
+        os.replace(tmp_Image_Path, output_Image_Path)
+        timings['render'] = time.perf_counter() - started
 
+        started = time.perf_counter()
         target_size = (128, 128)
         image = Image.open(output_Image_Path).convert('L').resize(target_size)
         image = np.array(image) / 255.0
         image = np.expand_dims(image, axis=-1)  # Channel dimension
         image = np.expand_dims(image, axis=0)   # Batch dimension
+        timings['preprocess'] = time.perf_counter() - started
         return image
     except Exception as e:
         print("Error in extract_features:", e)
         raise
 
-def create_inference_and_spectrogram_file(input_Wave_Path):
+def create_inference_and_spectrogram_file(input_Wave_Path, timings=None, scores=None):
     """
     Generate a spectrogram from the input .wav, run the model to predict 'Present' or 'Absent',
     and write the result to a .txt file.
+    If a timings dict is given, the seconds spent in each stage are stored in it.
+    If a scores dict is given, the model output is stored in it under 'score'.
     """
+    if timings is None:
+        timings = {}
     try:
         image_Path = input_Wave_Path.replace(".wav", ".png")
-        features = extract_features(input_Wave_Path, image_Path)
-        prediction = model.predict(features)[0][0]
+        features = extract_features(input_Wave_Path, image_Path, timings)
+        started = time.perf_counter()
+        prediction = load_heart_model().predict(features, verbose=0)[0][0]
+        timings['predict'] = time.perf_counter() - started
+        if scores is not None:
+            scores['score'] = float(prediction)
         label = 'Present' if prediction > 0.5 else 'Absent'
-        with open(input_Wave_Path.replace(".wav", ".txt"), "w") as inference_Result_File:
-            inference_Result_File.write(label)
+        _write_result(input_Wave_Path, label)
         return label
     except Exception as e:
         print("Error in create_inference_and_spectrogram_file:", e)
         raise
+
+def _write_result(input_Wave_Path, label):
+    # The label goes into a .txt file beside the recording
+    result_Path = input_Wave_Path.replace(".wav", ".txt")
+    tmp_Result_Path = _temp_path_beside(result_Path)
+    with open(tmp_Result_Path, "w") as inference_Result_File:
+        inference_Result_File.write(label)
+    os.replace(tmp_Result_Path, result_Path)
+
+# Auscultation sites recorded in one visit
+SESSION_SITES = ('AV', 'MV', 'PV', 'TV')
+
+# Worker processes computing the spectrograms of a session in parallel
+# (HEARTAI_SESSION_WORKERS, default one per site up to the number of cores;
+# 0 or 1 computes them one after another in this process). The pool is started
+# on the first session, so pre-forked server workers each get their own.
+SESSION_WORKERS = int(os.environ.get('HEARTAI_SESSION_WORKERS', min(len(SESSION_SITES), os.cpu_count() or 1)))
+_session_pool = None
+_session_pool_lock = threading.Lock()
+
+def _session_executor():
+    global _session_pool
+    with _session_pool_lock:
+        if _session_pool is None:
+            # Spawned, not forked: forking a process that runs TensorFlow is unsafe
+            _session_pool = ProcessPoolExecutor(max_workers=SESSION_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+    return _session_pool
+
+def _site_features(input_Wave_Path):
+    timings = {}
+    features = extract_features(input_Wave_Path, input_Wave_Path.replace(".wav", ".png"), timings)
+    return features, timings
+
+def create_session_inference(site_Wave_Paths, timings=None):
+    """
+    Score the recordings of one visit together, one .wav per auscultation site.
+    site_Wave_Paths maps a site ('AV', 'MV', 'PV', 'TV') to a recording.
+    The spectrograms are computed in parallel worker processes, the model scores
+    all sites in one batch, and each site's label is written to its .txt file.
+    Returns (site_results, session_result): a dict per site with 'label',
+    'score' and the seconds spent in each feature stage ('timings'), and for
+    the visit the highest site score with its label and site, since a murmur
+    heard at any site counts.
+    If a timings dict is given, the seconds spent in the 'features' (all sites,
+    wall clock) and 'predict' stages are stored in it.
+    """
+    if timings is None:
+        timings = {}
+    try:
+        sites = list(site_Wave_Paths)
+        paths = [site_Wave_Paths[site] for site in sites]
+        started = time.perf_counter()
+        if SESSION_WORKERS > 1 and len(paths) > 1:
+            extracted = list(_session_executor().map(_site_features, paths))
+        else:
+            extracted = [_site_features(path) for path in paths]
+        timings['features'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        batch = np.concatenate([features for features, _ in extracted])
+        predictions = load_heart_model().predict(batch, batch_size=len(batch), verbose=0)[:, 0]
+        timings['predict'] = time.perf_counter() - started
+
+        site_results = {}
+        for site, path, (_, site_timings), prediction in zip(sites, paths, extracted, predictions):
+            label = 'Present' if prediction > 0.5 else 'Absent'
+            _write_result(path, label)
+            site_results[site] = {'label': label, 'score': float(prediction), 'timings': site_timings}
+        top_site = max(sites, key=lambda site: site_results[site]['score'])
+        session_result = {'label': site_results[top_site]['label'], 'score': site_results[top_site]['score'],
+                          'site': top_site}
+        return site_results, session_result
+    except Exception as e:
+        print("Error in create_session_inference:", e)
+        raise
@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.abspath(os.path.join(BASE_DIR, '..'))
+DATASET_DIR = os.path.join(APP_DIR, 'dataset')
+FALLBACK_DIRS = [os.path.join(APP_DIR, 'train'), os.path.join(APP_DIR, 'test')]
+
+# Microbenchmarks for the stages of the inference pipeline in heartai.py:
+#   load            librosa.load of the recording
+#   melspectrogram  mel spectrogram and conversion to dB
+#   render          specshow render and PNG save
+#   preprocess      PIL reload, grayscale, resize to 128x128 and normalize
+#   predict         model.predict (skipped if the model file is missing)
+# Each stage is timed over several repeats for every combination of clip length
+# and sample rate, and the medians can be compared against a stored baseline.
+
+sys.path.insert(0, APP_DIR)
+# The model is loaded on demand below, so a missing model only skips "predict"
+os.environ.setdefault('HEARTAI_PRELOAD_MODEL', '0')
+
+STAGES = ('load', 'melspectrogram', 'render', 'preprocess', 'predict')
+
+
+def find_recordings(folder):
+    recordings = []
+    for root, _, files in os.walk(folder):
+        recordings.extend(os.path.join(root, f) for f in files if f.endswith('.wav'))
+    return sorted(recordings)
+
+
+def write_clip(path, audio, sr):
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sr)
+        wav_file.writeframes((np.clip(audio, -1, 1) * 32767).astype('<i2').tobytes())
+
+
+def prepare_clips(recordings, lengths, sample_rates, work_dir):
+    """
+    Cut every recording to each clip length (repeating short recordings) and
+    resample it to each sample rate. Returns {(seconds, sr): [paths]}.
+    """
+    import librosa
+    clips = {}
+    for index, recording in enumerate(recordings):
+        audio, native_sr = librosa.load(recording, sr=None)
+        for sr in sample_rates:
+            target_sr = native_sr if sr == 'native' else int(sr)
+            resampled = audio if target_sr == native_sr else librosa.resample(audio, orig_sr=native_sr, target_sr=target_sr)
+            for seconds in lengths:
+                samples = int(seconds * target_sr)
+                clip = np.tile(resampled, samples // len(resampled) + 1)[:samples]
+                path = os.path.join(work_dir, f"clip_{index}_{seconds}s_{target_sr}hz.wav")
+                write_clip(path, clip, target_sr)
+                clips.setdefault((seconds, target_sr), []).append(path)
+    return clips
+
+
+def summarize(values):
+    ordered = sorted(values)
+    return {
+        'median': float(np.median(ordered)),
+        'mean': float(np.mean(ordered)),
+        'min': ordered[0],
+        'p95': ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        'runs': len(ordered),
+    }
+
+
+def run_case(heartai, model, paths, repeats, warmup):
+    samples = {stage: [] for stage in STAGES}
+    for repeat in range(warmup + repeats):
+        for path in paths:
+            timings = {}
+            features = heartai.extract_features(path, path.replace('.wav', '.png'), timings)
+            if model is not None:
+                started = time.perf_counter()
+                model.predict(features, verbose=0)
+                timings['predict'] = time.perf_counter() - started
+            if repeat >= warmup:
+                for stage, seconds in timings.items():
+                    samples[stage].append(seconds)
+    return {stage: summarize(values) for stage, values in samples.items() if values}
+
+
+def package_version(name):
+    try:
+        return __import__(name).__version__
+    except (ImportError, AttributeError):
+        return None
+
+
+def environment():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=APP_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'git_revision': revision,
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'packages': {name: package_version(name) for name in
+                     ('numpy', 'librosa', 'matplotlib', 'PIL', 'tensorflow')},
+        'threads': {name: os.environ.get(name) for name in
+                    ('HEARTAI_TF_INTRA_OP_THREADS', 'HEARTAI_TF_INTER_OP_THREADS', 'OMP_NUM_THREADS')},
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Return the (case, stage, baseline, current) medians that got slower than
+    the baseline by more than threshold (a fraction).
+    """
+    regressions = []
+    for case, stages in results['cases'].items():
+        for stage, summary in stages.items():
+            previous = baseline.get('cases', {}).get(case, {}).get(stage)
+            if previous and summary['median'] > previous['median'] * (1 + threshold):
+                regressions.append((case, stage, previous['median'], summary['median']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the heartai inference pipeline.")
+    parser.add_argument('--recordings', help="Folder of .wav recordings (default: dataset/, else train/ and test/)")
+    parser.add_argument('--files', type=int, default=3, help="Recordings used per case")
+    parser.add_argument('--lengths', default='5,10,20', help="Clip lengths in seconds")
+    parser.add_argument('--sample-rates', default='native,8000,22050', help="Sample rates, 'native' keeps the file's")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="Earlier results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Allowed slowdown, as a fraction")
+    parser.add_argument('--save-baseline', help="Also write the results to this baseline file")
+    args = parser.parse_args()
+
+    if args.recordings:
+        recordings = find_recordings(args.recordings)
+    else:
+        recordings = find_recordings(DATASET_DIR)
+        for folder in FALLBACK_DIRS:
+            if not recordings:
+                recordings = find_recordings(folder)
+    if not recordings:
+        sys.exit("No .wav recordings found")
+    recordings = recordings[:args.files]
+
+    import heartai
+    model = heartai.load_heart_model() if os.path.exists(heartai.MODEL_PATH) else None
+    if model is None:
+        print(f"Model not found at {heartai.MODEL_PATH}; skipping the predict stage")
+
+    lengths = [float(value) for value in args.lengths.split(',')]
+    sample_rates = args.sample_rates.split(',')
+    work_dir = tempfile.mkdtemp(prefix='heartai-bench-')
+    try:
+        clips = prepare_clips(recordings, lengths, sample_rates, work_dir)
+        results = {'environment': environment(), 'recordings': recordings, 'cases': {}}
+        for (seconds, sr), paths in sorted(clips.items()):
+            case = f"{seconds:g}s@{sr}Hz"
+            results['cases'][case] = run_case(heartai, model, paths, args.repeats, args.warmup)
+            medians = ' '.join(f"{stage}={summary['median'] * 1000:.1f}ms"
+                               for stage, summary in results['cases'][case].items())
+            print(f"{case:<14} {medians}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {args.output}")
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for case, stage, previous, current in regressions:
+            print(f"REGRESSION {case} {stage}: {previous * 1000:.1f}ms -> {current * 1000:.1f}ms "
+                  f"(+{(current / previous - 1):.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No stage is more than {args.threshold:.0%} slower than the baseline")
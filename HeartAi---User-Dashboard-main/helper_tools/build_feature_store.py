@@ -0,0 +1,44 @@
+import os
+import sys
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, '..'))
+
+import feature_store
+import dataset_manifest
+
+APP_DIR = os.path.abspath(os.path.join(BASE_DIR, '..'))
+STORE_DIR = os.path.join(APP_DIR, 'features')
+
+# Builds or updates the mel feature store (see feature_store.py) from the WAV
+# recordings listed in the dataset manifest (helper_tools/build_manifest.py),
+# with their labels from the manifest. Recordings without a label are stored
+# with label -1. Run it again after adding recordings or changing feature
+# parameters; unchanged recordings are copied from the previous build instead
+# of being recomputed.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute mel dB features of the recordings into a memory-mapped store.")
+    parser.add_argument('--manifest', default=dataset_manifest.MANIFEST_PATH,
+                        help="Dataset manifest built by helper_tools/build_manifest.py")
+    parser.add_argument('--folders', default=None, help="Only recordings from these manifest folders, e.g. dataset")
+    parser.add_argument('--output', default=STORE_DIR, help="Feature store folder")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument('--n-mels', type=int, default=feature_store.DEFAULT_CONFIG['n_mels'])
+    parser.add_argument('--hop-length', type=int, default=feature_store.DEFAULT_CONFIG['hop_length'])
+    parser.add_argument('--n-fft', type=int, default=feature_store.DEFAULT_CONFIG['n_fft'])
+    parser.add_argument('--fmax', type=int, default=feature_store.DEFAULT_CONFIG['fmax'])
+    args = parser.parse_args()
+
+    config = dict(feature_store.DEFAULT_CONFIG, n_mels=args.n_mels, hop_length=args.hop_length,
+                  n_fft=args.n_fft, fmax=args.fmax)
+    entries = dataset_manifest.query(args.manifest, kind='audio',
+                                     folders=args.folders.split(',') if args.folders else None)
+    recordings = [entry['path'] for entry in entries]
+    labels = [entry['label'] if entry['label'] is not None else -1 for entry in entries]
+    print(f"{len(recordings)} recordings, {sum(label >= 0 for label in labels)} labelled")
+    result = feature_store.build(args.output, recordings, labels, config, args.workers)
+    print(f"Feature store {args.output}: {result['computed']} computed, {result['reused']} reused, "
+          f"{result['frames']} frames in {result['seconds']:.1f} s")
@@ -0,0 +1,39 @@
+import os
+import sys
+import sqlite3
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, '..'))
+
+import dataset_manifest
+
+# Builds or refreshes dataset_manifest.db, the index of rendered images in
+# dataset/Absent and dataset/Present and of the recordings in dataset/ that the
+# training and preprocessing tools read (see dataset_manifest.py for checkouts
+# that only have the train/ and test/ copies).
+# Run it again after adding or removing files; unchanged files are not re-read.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index the dataset into a SQLite manifest.")
+    parser.add_argument('--manifest', default=dataset_manifest.MANIFEST_PATH,
+                        help="Manifest file; paths in it are relative to its folder")
+    parser.add_argument('--workers', type=int, default=8, help="Threads hashing files")
+    args = parser.parse_args()
+
+    result = dataset_manifest.build(args.manifest, workers=args.workers)
+    print(f"{result['files']} files in {args.manifest}: {result['described']} read, {result['reused']} unchanged, "
+          f"{result['removed']} removed, in {result['seconds']:.1f} s")
+
+    con = sqlite3.connect(args.manifest)
+    try:
+        summary = con.execute(
+            "SELECT folder, kind, label, COUNT(*), COUNT(DISTINCT patient_id), ROUND(SUM(duration) / 60, 1) "
+            "FROM files GROUP BY folder, kind, label ORDER BY folder, kind, label").fetchall()
+    finally:
+        con.close()
+    print(f"{'folder':<10} {'kind':<6} {'label':<8} {'files':>6} {'patients':>9} {'minutes':>8}")
+    for folder, kind, label, files, patients, minutes in summary:
+        label_name = dataset_manifest.CLASS_NAMES[label] if label is not None else 'unknown'
+        print(f"{folder:<10} {kind:<6} {label_name:<8} {files:>6} {patients:>9} {minutes if minutes else '':>8}")
@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import hashlib
+import argparse
+import statistics
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, '..'))
+
+from backend_client import BackendClient
+
+# Compares request latency from the Streamlit side with a new connection per call
+# (plain requests.get / requests.post, as the app used to do) against the pooled
+# keep-alive BackendClient, for the calls one page render makes. Both send the
+# same requests and download the full body: the client's ETag cache is turned
+# off, so the saving is that of connection reuse alone. The saving of ETag
+# revalidation (a 304 without a body for an unchanged history) is reported
+# separately, against the pooled client without it.
+
+
+def timed(call, repeats):
+    latencies = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        response = call()
+        _ = response.content
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def report(name, latencies):
+    ordered = sorted(latencies)
+    p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+    print(f"{name:<42} mean {statistics.mean(ordered) * 1000:7.2f} ms   "
+          f"p50 {statistics.median(ordered) * 1000:7.2f} ms   p95 {p95 * 1000:7.2f} ms")
+    return statistics.mean(ordered)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the latency saved by connection reuse.")
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    username = f"latency-{int(time.time())}"
+    password_md5 = hashlib.md5(username.encode()).hexdigest()
+    requests.post(f"{args.url}/createuser", json={"username": username, "password_md5": password_md5, "role": "doctor"})
+    params = {"username": username, "password_md5": password_md5}
+    client = BackendClient(args.url, etag_cache_entries=0)
+    revalidating_client = BackendClient(args.url)
+
+    cases = [
+        ('login', lambda: requests.post(f"{args.url}/login", json=params),
+         lambda: client.login(username, password_md5)),
+        ('accesshistory', lambda: requests.get(f"{args.url}/accesshistory", params=params),
+         lambda: client.access_history(username, password_md5)),
+    ]
+    pooled_means = {}
+    for name, unpooled, pooled in cases:
+        before = report(f"{name} (new connection per call)", timed(unpooled, args.repeats))
+        after = report(f"{name} (pooled keep-alive client)", timed(pooled, args.repeats))
+        print(f"{'':<42} saved {(before - after) * 1000:.2f} ms per call ({1 - after / before:.0%})")
+        pooled_means[name] = after
+
+    # Same pooled connection, with and without If-None-Match
+    revalidated = report("accesshistory (pooled, ETag revalidation)",
+                         timed(lambda: revalidating_client.access_history(username, password_md5), args.repeats))
+    pooled_mean = pooled_means['accesshistory']
+    print(f"{'':<42} saved {(pooled_mean - revalidated) * 1000:.2f} ms per call over the pooled client "
+          f"({1 - revalidated / pooled_mean:.0%})")
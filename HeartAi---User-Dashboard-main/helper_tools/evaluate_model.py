@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.abspath(os.path.join(BASE_DIR, '..'))
+
+sys.path.insert(0, APP_DIR)
+# Feature workers must not each load the model; the main process loads it once
+os.environ.setdefault('HEARTAI_PRELOAD_MODEL', '0')
+
+import dataset_manifest
+from benchmark_pipeline import environment, summarize
+
+# Evaluates a trained model on the test split (fold 0 of the manifest split
+# 'default', see helper_tools/separate_dataset.py) with the production feature
+# path: every recording goes through heartai.extract_features (mel spectrogram,
+# PNG render, grayscale 128x128) in a pool of worker processes, and the main
+# process scores the features in large batches while the workers prepare the
+# next ones.
+# Accuracy and speed come from the same run: the report holds accuracy,
+# sensitivity, specificity, ROC-AUC and the confusion matrix next to end-to-end
+# clips/sec and the time spent in each stage.
+#
+# A model trained with train_model.py --features expects the mel arrays of the
+# feature store, not rendered spectrograms. With --features the recordings are
+# scored from the store (helper_tools/build_feature_store.py) through the same
+# input pipeline as in training; nothing is recomputed, so the stage times only
+# cover reading the arrays and prediction.
+
+FEATURE_STAGES = ('load', 'melspectrogram', 'render', 'preprocess')
+
+
+def _init_worker(work_dir):
+    global heartai, worker_dir
+    import heartai
+    worker_dir = tempfile.mkdtemp(dir=work_dir)
+
+
+def extract(path):
+    """
+    Production features of one recording, with the time spent in each stage.
+    """
+    timings = {}
+    image_path = os.path.join(worker_dir, os.path.basename(path).replace('.wav', '.png'))
+    try:
+        features = heartai.extract_features(path, image_path, timings)
+    finally:
+        if os.path.exists(image_path):
+            os.remove(image_path)
+    return features, timings
+
+
+def roc_auc(labels, scores):
+    """
+    Area under the ROC curve (the probability that a random positive scores
+    higher than a random negative, ties counting half). None if a class is missing.
+    """
+    from scipy.stats import rankdata
+    labels = np.asarray(labels)
+    positives = int(labels.sum())
+    negatives = len(labels) - positives
+    if not positives or not negatives:
+        return None
+    ranks = rankdata(scores)
+    return float((ranks[labels == 1].sum() - positives * (positives + 1) / 2) / (positives * negatives))
+
+
+def classification_metrics(labels, scores, threshold=0.5):
+    labels = np.asarray(labels)
+    predicted = (np.asarray(scores) > threshold).astype(int)
+    tp = int(((predicted == 1) & (labels == 1)).sum())
+    tn = int(((predicted == 0) & (labels == 0)).sum())
+    fp = int(((predicted == 1) & (labels == 0)).sum())
+    fn = int(((predicted == 0) & (labels == 1)).sum())
+    return {
+        'accuracy': (tp + tn) / len(labels) if len(labels) else None,
+        'sensitivity': tp / (tp + fn) if tp + fn else None,
+        'specificity': tn / (tn + fp) if tn + fp else None,
+        'roc_auc': roc_auc(labels, scores),
+        'confusion_matrix': {'true_positive': tp, 'false_negative': fn, 'false_positive': fp, 'true_negative': tn},
+        'threshold': threshold,
+    }
+
+
+def evaluate(model_path, recordings, labels, batch_size=64, workers=None):
+    import tensorflow as tf
+    model = tf.keras.models.load_model(model_path)
+    # Warm up so the first batch does not carry graph tracing time
+    model.predict(np.zeros((1,) + tuple(model.input_shape[1:]), dtype=np.float32), verbose=0)
+
+    work_dir = tempfile.mkdtemp(prefix='heartai-eval-')
+    stage_times = {stage: [] for stage in FEATURE_STAGES}
+    predict_times = []
+    scores = []
+    batch = []
+    started = time.perf_counter()
+
+    def predict_batch():
+        batch_started = time.perf_counter()
+        predictions = model.predict(np.concatenate(batch), batch_size=len(batch), verbose=0)
+        predict_times.append(time.perf_counter() - batch_started)
+        scores.extend(float(value) for value in predictions[:, 0])
+        batch.clear()
+
+    try:
+        # Spawned workers, since forking after TensorFlow has started is unsafe
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers or os.cpu_count(), initializer=_init_worker, initargs=(work_dir,)) as pool:
+            for done, (features, timings) in enumerate(pool.imap(extract, recordings, chunksize=2), 1):
+                for stage in FEATURE_STAGES:
+                    stage_times[stage].append(timings[stage])
+                batch.append(features)
+                if len(batch) == batch_size:
+                    predict_batch()
+                if done % 50 == 0:
+                    print(f"  {done}/{len(recordings)} clips, {done / (time.perf_counter() - started):.1f} clips/s")
+            if batch:
+                predict_batch()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    elapsed = time.perf_counter() - started
+
+    stages = {stage: summarize(values) for stage, values in stage_times.items()}
+    stages['predict_batch'] = summarize(predict_times)
+    return {
+        'model': model_path,
+        'clips': len(recordings),
+        'batch_size': batch_size,
+        'metrics': classification_metrics(labels, scores),
+        'throughput': {'seconds': elapsed, 'clips_per_second': len(recordings) / elapsed},
+        'stages': stages,
+        'stage_totals_seconds': {stage: float(sum(values)) for stage, values in stage_times.items()},
+        'predictions': [{'recording': path, 'label': label, 'score': score}
+                        for path, label, score in zip(recordings, labels, scores)],
+    }
+
+
+def evaluate_features(model_path, features_dir, recordings, labels, batch_size=64):
+    """
+    Score recordings with their arrays from a feature store, for a model trained
+    on the store. Returns the same report as evaluate().
+    """
+    import tensorflow as tf
+    import feature_store
+    import train_model
+    model = tf.keras.models.load_model(model_path)
+    model.predict(np.zeros((1,) + tuple(model.input_shape[1:]), dtype=np.float32), verbose=0)
+
+    store = feature_store.FeatureStore(features_dir)
+    dataset = train_model.make_feature_dataset(store, store.positions(recordings), batch_size,
+                                               tuple(model.input_shape[1:3]), shuffle=False)
+    read_times = []
+    predict_times = []
+    scores = []
+    started = time.perf_counter()
+    read_started = started
+    for images, _ in dataset:
+        batch_started = time.perf_counter()
+        read_times.append(batch_started - read_started)
+        predictions = model.predict(images, batch_size=len(images), verbose=0)
+        predict_times.append(time.perf_counter() - batch_started)
+        scores.extend(float(value) for value in predictions[:, 0])
+        read_started = time.perf_counter()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'model': model_path,
+        'features': features_dir,
+        'clips': len(recordings),
+        'batch_size': batch_size,
+        'metrics': classification_metrics(labels, scores),
+        'throughput': {'seconds': elapsed, 'clips_per_second': len(recordings) / elapsed},
+        'stages': {'read_batch': summarize(read_times), 'predict_batch': summarize(predict_times)},
+        'stage_totals_seconds': {'read_batch': float(sum(read_times)), 'predict_batch': float(sum(predict_times))},
+        'predictions': [{'recording': path, 'label': label, 'score': score}
+                        for path, label, score in zip(recordings, labels, scores)],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate the model on the test split.")
+    parser.add_argument('--model', default=os.path.join(APP_DIR, 'models', 'heart_model.h5'))
+    parser.add_argument('--manifest', default=dataset_manifest.MANIFEST_PATH,
+                        help="Dataset manifest built by helper_tools/build_manifest.py")
+    parser.add_argument('--folders', default=None, help="Evaluate the recordings of these manifest folders, e.g. dataset")
+    parser.add_argument('--split', default=None,
+                        help="Evaluate a fold of this manifest split (helper_tools/separate_dataset.py) "
+                             "(default: the split 'default')")
+    parser.add_argument('--fold', type=int, default=0, help="Fold of --split evaluated")
+    parser.add_argument('--batch-size', type=int, default=64, help="Clips per model.predict call")
+    parser.add_argument('--workers', type=int, default=None, help="Feature worker processes (default: all cores)")
+    parser.add_argument('--features', default=None,
+                        help="Score the arrays of this feature store instead of rendering spectrograms "
+                             "(for models trained with train_model.py --features)")
+    parser.add_argument('--output', default='evaluation_results.json')
+    args = parser.parse_args()
+    if not os.path.exists(args.manifest):
+        sys.exit(f"No dataset manifest at {args.manifest}; build it with helper_tools/build_manifest.py")
+    if args.split and args.folders:
+        parser.error("--split and --folders select the recordings in different ways; give one")
+    if not args.split and not args.folders:
+        args.split = 'default'
+        if not dataset_manifest.split_exists(args.manifest, args.split):
+            sys.exit(f"The manifest {args.manifest} has no split '{args.split}'; write it with "
+                     f"helper_tools/separate_dataset.py, or pass --folders")
+
+    if args.split:
+        entries = dataset_manifest.query(args.manifest, kind='audio', labelled=True, split=args.split,
+                                         split_folds=[args.fold])
+        selection = f"fold {args.fold} of the split {args.split}"
+    else:
+        entries = dataset_manifest.query(args.manifest, kind='audio', folders=args.folders.split(','),
+                                         labelled=True)
+        selection = f"the folders {args.folders}"
+    recordings = [entry['path'] for entry in entries]
+    labels = [entry['label'] for entry in entries]
+    if not recordings:
+        sys.exit(f"No labelled recordings in {selection} of {args.manifest}")
+    if args.features:
+        import feature_store
+        stored = set(feature_store.FeatureStore(args.features).sources)
+        missing = [path for path in recordings if os.path.abspath(path) not in stored]
+        if missing:
+            sys.exit(f"{len(missing)} recordings of {selection} are not in the feature store {args.features}; "
+                     f"rebuild it with helper_tools/build_feature_store.py")
+    print(f"Evaluating {args.model} on {len(recordings)} labelled recordings")
+
+    if args.features:
+        results = evaluate_features(args.model, args.features, recordings, labels, args.batch_size)
+    else:
+        results = evaluate(args.model, recordings, labels, args.batch_size, args.workers)
+    results['environment'] = environment()
+
+    metrics = results['metrics']
+    matrix = metrics['confusion_matrix']
+
+    def percent(value):
+        return 'n/a' if value is None else f"{value:.1%}"
+
+    print(f"Accuracy {percent(metrics['accuracy'])}   sensitivity {percent(metrics['sensitivity'])}   "
+          f"specificity {percent(metrics['specificity'])}   ROC-AUC "
+          f"{'n/a' if metrics['roc_auc'] is None else format(metrics['roc_auc'], '.3f')}")
+    print("Confusion matrix (rows: actual Present/Absent, columns: predicted Present/Absent)")
+    print(f"  {matrix['true_positive']:6d} {matrix['false_negative']:6d}")
+    print(f"  {matrix['false_positive']:6d} {matrix['true_negative']:6d}")
+    print(f"{results['clips']} clips in {results['throughput']['seconds']:.1f} s, "
+          f"{results['throughput']['clips_per_second']:.1f} clips/s")
+    for stage, summary in results['stages'].items():
+        print(f"  {stage:<15} median {summary['median'] * 1000:8.1f} ms")
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {args.output}")
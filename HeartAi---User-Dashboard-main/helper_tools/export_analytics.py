@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, '..', 'data')
+EXPORT_DIR = os.path.join(BASE_DIR, '..', 'analytics')
+STATE_FILE = '_export_state.json'
+
+# Incremental export of analysis_history to Parquet for analytics queries.
+# Rows are read through a read-only connection (in WAL mode readers never block
+# the backend's writes) and appended as new files to month partitions:
+#   analytics/month=2026-10/part-<run>.parquet
+# A high-water mark on (modified_epoch, id) is kept in analytics/_export_state.json,
+# so each run only exports rows added or changed since the previous one. A changed
+# row is exported again; readers keep the copy with the highest modified_epoch
+# per id. Deleted records are not removed from earlier exports.
+#
+# Example query with DuckDB, positive rate per doctor per week:
+#   SELECT username, date_trunc('week', to_timestamp(epoch)) AS week,
+#          avg(CASE WHEN inference = 'Present' THEN 1 ELSE 0 END) AS positive_rate
+#   FROM (SELECT * FROM 'analytics/*/*.parquet'
+#         QUALIFY row_number() OVER (PARTITION BY id ORDER BY modified_epoch DESC) = 1)
+#   WHERE role = 'doctor' GROUP BY ALL
+
+COLUMNS = ('id', 'username', 'role', 'epoch', 'modified_epoch', 'patient_name',
+           'inference', 'inference_score', 'doctor_notes')
+
+EXPORT_QUERY = """
+    SELECT h.id, h.username, c.role, h.epoch, COALESCE(h.modified_epoch, h.epoch) AS modified,
+           h.patient_name, h.inference, h.inference_score, h.doctor_notes
+    FROM analysis_history h LEFT JOIN credentials c ON c.username = h.username
+    WHERE (COALESCE(h.modified_epoch, h.epoch), h.id) > (?, ?)
+      AND COALESCE(h.modified_epoch, h.epoch) < ?
+    ORDER BY modified, h.id
+"""
+
+
+def load_state(export_dir):
+    try:
+        with open(os.path.join(export_dir, STATE_FILE)) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {'modified_epoch': -1, 'id': -1, 'rows_exported': 0}
+
+
+def save_state(export_dir, state):
+    # Written last and atomically, so an interrupted run is simply repeated
+    fd, tmp_path = tempfile.mkstemp(dir=export_dir, suffix='.part')
+    with os.fdopen(fd, 'w') as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(tmp_path, os.path.join(export_dir, STATE_FILE))
+
+
+def month_of(epoch):
+    return time.strftime('%Y-%m', time.gmtime(epoch))
+
+
+def write_partitions(export_dir, rows, run_id):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([
+        ('id', pa.int64()), ('username', pa.string()), ('role', pa.string()),
+        ('epoch', pa.int64()), ('modified_epoch', pa.int64()), ('patient_name', pa.string()),
+        ('inference', pa.string()), ('inference_score', pa.float64()), ('doctor_notes', pa.string()),
+    ])
+    by_month = {}
+    for row in rows:
+        # Partitioned by the month of the analysis, not of the change
+        by_month.setdefault(month_of(row[3]), []).append(row)
+    for month, month_rows in sorted(by_month.items()):
+        partition_dir = os.path.join(export_dir, f"month={month}")
+        os.makedirs(partition_dir, exist_ok=True)
+        table = pa.Table.from_pydict(
+            {name: [row[index] for row in month_rows] for index, name in enumerate(COLUMNS)}, schema=schema)
+        final_path = os.path.join(partition_dir, f"part-{run_id}.parquet")
+        tmp_path = final_path + '.part'
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, final_path)
+        print(f"  {month}: {len(month_rows)} rows -> {final_path}")
+
+
+def export(data_folder, export_dir, batch_size=10000, settle_seconds=60):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        sys.exit("The analytics export needs pyarrow: pip install pyarrow")
+    os.makedirs(export_dir, exist_ok=True)
+    state = load_state(export_dir)
+    master_db = os.path.abspath(os.path.join(data_folder, 'master.db'))
+    # Rows stamped in the last moments may belong to transactions that have not
+    # committed yet; they are left for the next run so none is skipped
+    upper_bound = int(time.time()) - settle_seconds
+    run_id = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+    exported = 0
+    con = sqlite3.connect(f"file:{master_db}?mode=ro", uri=True)
+    try:
+        cur = con.execute(EXPORT_QUERY, (state['modified_epoch'], state['id'], upper_bound))
+        batch_number = 0
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            write_partitions(export_dir, rows, f"{run_id}-{batch_number:04d}")
+            batch_number += 1
+            exported += len(rows)
+            state = {'modified_epoch': rows[-1][4], 'id': rows[-1][0],
+                     'rows_exported': state['rows_exported'] + len(rows)}
+            save_state(export_dir, state)
+    finally:
+        con.close()
+    print(f"Exported {exported} new or changed rows, high-water mark {state['modified_epoch']}/{state['id']}")
+    return exported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Append new and changed analysis_history rows to Parquet.")
+    parser.add_argument('--data-folder', default=DATA_DIR, help="Folder containing master.db")
+    parser.add_argument('--output', default=EXPORT_DIR, help="Folder of the Parquet export")
+    parser.add_argument('--batch-size', type=int, default=10000, help="Rows per Parquet file")
+    parser.add_argument('--settle-seconds', type=int, default=60,
+                        help="Leave rows changed within this many seconds for the next run")
+    args = parser.parse_args()
+    export(args.data_folder, args.output, args.batch_size, args.settle_seconds)
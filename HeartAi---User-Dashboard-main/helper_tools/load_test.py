@@ -0,0 +1,371 @@
+import os
+import sys
+import json
+import time
+import wave
+import random
+import hashlib
+import argparse
+import platform
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CLIPS_DIR = os.path.join(BASE_DIR, '..', 'loadtest_clips')
+
+# End-to-end load generator for the backend.
+# 1. Synthesizes PCG-like heart sound clips (S1/S2 beats, optional murmur, noise)
+#    of varying lengths and sample rates, once, before any request is sent.
+# 2. Creates doctor and patient accounts through /createuser and seeds records.
+# 3. Drives a weighted mix of endpoints at a target request rate (open loop) or
+#    with a fixed number of concurrent clients (closed loop).
+# 4. Writes throughput, p50/p95/p99 latency and error rates per route to JSON,
+#    so runs against different versions can be compared.
+
+DEFAULT_MIX = 'login=15,upload=5,accesshistory=30,history=30,get_audio=10,get_image=10'
+SAMPLE_RATES = (4000, 8000, 22050)
+
+
+# Synthetic heart sounds ---------------------------------------------------
+
+def _beat(sr, frequency, duration, rng):
+    # A short decaying tone burst with a little jitter, like S1 or S2
+    t = np.arange(int(sr * duration)) / sr
+    envelope = np.exp(-((t - duration / 3) ** 2) / (2 * (duration / 6) ** 2))
+    tone = np.sin(2 * np.pi * frequency * (1 + 0.05 * rng.standard_normal()) * t)
+    return envelope * tone
+
+
+def synthesize_pcg(sr, seconds, heart_rate, murmur, rng):
+    """
+    Return a float32 phonocardiogram-like signal in [-1, 1].
+    """
+    signal = np.zeros(int(sr * seconds), dtype=np.float64)
+    beat_interval = 60.0 / heart_rate
+    systole = 0.3 * beat_interval
+    start = rng.uniform(0, beat_interval)
+    while start < seconds:
+        for offset, frequency, duration, amplitude in ((0, 60, 0.12, 1.0), (systole, 110, 0.09, 0.7)):
+            beat_start = int((start + offset) * sr)
+            beat = amplitude * _beat(sr, frequency, duration, rng)
+            end = min(len(signal), beat_start + len(beat))
+            if beat_start < end:
+                signal[beat_start:end] += beat[:end - beat_start]
+        if murmur:
+            # Band-limited noise between S1 and S2
+            murmur_start = int((start + 0.12) * sr)
+            murmur_end = min(len(signal), int((start + systole) * sr))
+            if murmur_start < murmur_end:
+                noise = rng.standard_normal(murmur_end - murmur_start)
+                noise = np.convolve(noise, np.ones(8) / 8, mode='same')
+                signal[murmur_start:murmur_end] += 0.25 * noise
+        # Beat-to-beat variability
+        start += beat_interval * (1 + 0.03 * rng.standard_normal())
+    signal += 0.02 * rng.standard_normal(len(signal))
+    signal /= max(1e-9, np.max(np.abs(signal)))
+    return (0.9 * signal).astype(np.float32)
+
+
+def write_wav(path, signal, sr):
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sr)
+        wav_file.writeframes((signal * 32767).astype('<i2').tobytes())
+
+
+def synthesize_clips(output_dir, count, min_seconds, max_seconds, flac_fraction, seed):
+    """
+    Generate count clips into output_dir (skipping ones already there) and
+    return their paths. A fraction of them is written as FLAC if the optional
+    soundfile package is installed.
+    """
+    try:
+        import soundfile
+    except ImportError:
+        soundfile = None
+        if flac_fraction > 0:
+            print("soundfile is not installed; generating WAV clips only")
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for index in range(count):
+        sr = int(rng.choice(SAMPLE_RATES))
+        seconds = float(rng.uniform(min_seconds, max_seconds))
+        heart_rate = float(rng.uniform(55, 130))
+        murmur = bool(rng.random() < 0.3)
+        as_flac = soundfile is not None and rng.random() < flac_fraction
+        extension = 'flac' if as_flac else 'wav'
+        path = os.path.join(output_dir, f"clip_{seed}_{index:04d}_{sr}hz_{seconds:.0f}s.{extension}")
+        if not os.path.exists(path):
+            signal = synthesize_pcg(sr, seconds, heart_rate, murmur, rng)
+            if as_flac:
+                soundfile.write(path, signal, sr, format='FLAC')
+            else:
+                write_wav(path, signal, sr)
+        paths.append(path)
+    return paths
+
+
+# Workload -------------------------------------------------------------------
+
+class Recorder:
+    """
+    Thread-safe collection of (route, seconds, status) samples.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, route, seconds, status):
+        with self.lock:
+            self.samples.setdefault(route, []).append((seconds, status))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Workload:
+    def __init__(self, url, clips, users, recorder, timeout):
+        self.url = url
+        self.clips = clips
+        self.users = users
+        self.recorder = recorder
+        self.timeout = timeout
+        self.records = {user['username']: [] for user in users}
+        self.records_lock = threading.Lock()
+        self.local = threading.local()
+
+    def session(self):
+        # One keep-alive session per client thread
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def call(self, route, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.session().request(method, f"{self.url}{path}", timeout=self.timeout, **kwargs)
+            # Read the whole body so media downloads are part of the latency
+            _ = response.content
+            status = response.status_code
+        except requests.RequestException:
+            response = None
+            status = 'error'
+        self.recorder.record(route, time.perf_counter() - started, status)
+        return response
+
+    def auth(self, user):
+        return {"username": user['username'], "password_md5": user['password_md5']}
+
+    def pick_record(self, user):
+        with self.records_lock:
+            ids = self.records[user['username']]
+            return random.choice(ids) if ids else None
+
+    def login(self, user):
+        self.call('/login', 'POST', '/login', json=self.auth(user))
+
+    def upload(self, user):
+        clip = random.choice(self.clips)
+        with open(clip, 'rb') as clip_file:
+            response = self.call('/upload', 'POST', '/upload',
+                                 files={"file": (os.path.basename(clip), clip_file)},
+                                 data=dict(self.auth(user), patient_name=f"patient-{random.randint(1, 50)}"))
+        if response is not None and response.status_code == 200:
+            self.refresh_records(user)
+
+    def refresh_records(self, user):
+        response = self.call('/accesshistory', 'GET', '/accesshistory', params=self.auth(user))
+        if response is not None and response.status_code == 200:
+            with self.records_lock:
+                self.records[user['username']] = [record['id'] for record in response.json()]
+
+    def accesshistory(self, user):
+        self.refresh_records(user)
+
+    def history(self, user):
+        record_id = self.pick_record(user)
+        if record_id is not None:
+            self.call('/history/<id>', 'GET', f"/history/{record_id}", params=self.auth(user))
+
+    def get_audio(self, user):
+        record_id = self.pick_record(user)
+        if record_id is not None:
+            self.call('/get_audio/<id>', 'GET', f"/get_audio/{record_id}", params=self.auth(user))
+
+    def get_image(self, user):
+        record_id = self.pick_record(user)
+        if record_id is not None:
+            self.call('/get_image/<id>', 'GET', f"/get_image/{record_id}", params=self.auth(user))
+
+    def run_operation(self, operation):
+        getattr(self, operation)(random.choice(self.users))
+
+
+def parse_mix(mix):
+    operations, weights = [], []
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if not hasattr(Workload, name.strip()):
+            raise ValueError(f"Unknown operation in mix: {name}")
+        operations.append(name.strip())
+        weights.append(float(weight))
+    return operations, weights
+
+
+def create_users(url, count, run_id):
+    users = []
+    for index in range(count):
+        role = 'doctor' if index % 2 == 0 else 'patient'
+        username = f"load-{run_id}-{role}-{index}"
+        password_md5 = hashlib.md5(username.encode()).hexdigest()
+        response = requests.post(f"{url}/createuser",
+                                 json={"username": username, "password_md5": password_md5, "role": role})
+        if response.status_code not in (200, 400):
+            raise RuntimeError(f"Failed to create user {username}: {response.status_code}")
+        users.append({"username": username, "password_md5": password_md5})
+    return users
+
+
+def run_closed_loop(workload, operations, weights, concurrency, duration):
+    deadline = time.time() + duration
+
+    def client():
+        while time.time() < deadline:
+            workload.run_operation(random.choices(operations, weights)[0])
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_open_loop(workload, operations, weights, rate, duration, max_in_flight):
+    # Requests are started on a Poisson schedule whatever the response times,
+    # so a slow server builds up a backlog instead of slowing the clients down
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        started = time.time()
+        next_start = started
+        while next_start < started + duration:
+            delay = next_start - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(workload.run_operation, random.choices(operations, weights)[0])
+            next_start += random.expovariate(rate)
+
+
+def summarize(recorder, wall_seconds):
+    routes = {}
+    for route, samples in sorted(recorder.samples.items()):
+        latencies = [seconds for seconds, status in samples if status != 'error' and status < 500]
+        errors = [status for _, status in samples if status == 'error' or status >= 400]
+        status_counts = {}
+        for _, status in samples:
+            status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+        routes[route] = {
+            'requests': len(samples),
+            'throughput_per_second': len(samples) / wall_seconds,
+            'error_rate': len(errors) / len(samples),
+            'status_counts': status_counts,
+            'latency_seconds': {
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'p50': percentile(latencies, 0.50),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+            },
+        }
+    return routes
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the HeartAI backend with synthetic heart sounds.")
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Weighted operations, e.g. " + DEFAULT_MIX)
+    parser.add_argument('--rate', type=float, help="Target requests per second (open loop)")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent clients (closed loop, if no --rate)")
+    parser.add_argument('--max-in-flight', type=int, default=64, help="Request threads in open-loop mode")
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--seed-uploads', type=int, default=2, help="Uploads per user before measuring")
+    parser.add_argument('--clips', type=int, default=20)
+    parser.add_argument('--clips-dir', default=CLIPS_DIR)
+    parser.add_argument('--min-seconds', type=float, default=5)
+    parser.add_argument('--max-seconds', type=float, default=30)
+    parser.add_argument('--flac-fraction', type=float, default=0.2)
+    parser.add_argument('--synthesize-only', action='store_true', help="Only generate the clips")
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='loadtest_results.json')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    clips = synthesize_clips(args.clips_dir, args.clips, args.min_seconds, args.max_seconds,
+                             args.flac_fraction, args.seed)
+    print(f"{len(clips)} clips ready in {args.clips_dir}")
+    if args.synthesize_only:
+        sys.exit(0)
+
+    operations, weights = parse_mix(args.mix)
+    run_id = f"{int(time.time())}"
+    users = create_users(args.url, args.users, run_id)
+    seeding = Workload(args.url, clips, users, Recorder(), args.timeout)
+    for user in users:
+        for _ in range(args.seed_uploads):
+            seeding.upload(user)
+
+    recorder = Recorder()
+    workload = Workload(args.url, clips, users, recorder, args.timeout)
+    workload.records = seeding.records
+    started = time.perf_counter()
+    if args.rate:
+        run_open_loop(workload, operations, weights, args.rate, args.duration, args.max_in_flight)
+    else:
+        run_closed_loop(workload, operations, weights, args.concurrency, args.duration)
+    wall_seconds = time.perf_counter() - started
+
+    report = {
+        'metadata': {
+            'url': args.url,
+            'git_revision': git_revision(),
+            'started_epoch': int(time.time() - wall_seconds),
+            'wall_seconds': wall_seconds,
+            'mode': 'open_loop' if args.rate else 'closed_loop',
+            'rate': args.rate,
+            'concurrency': None if args.rate else args.concurrency,
+            'mix': args.mix,
+            'users': args.users,
+            'clips': len(clips),
+            'python': platform.python_version(),
+            'host': platform.node(),
+        },
+        'routes': summarize(recorder, wall_seconds),
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    print(f"{'route':<16} {'requests':>8} {'req/s':>8} {'errors':>7} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}")
+    for route, summary in report['routes'].items():
+        latency = summary['latency_seconds']
+        print(f"{route:<16} {summary['requests']:>8} {summary['throughput_per_second']:>8.2f} "
+              f"{summary['error_rate']:>7.1%} {latency['p50'] or 0:>8.3f} {latency['p95'] or 0:>8.3f} "
+              f"{latency['p99'] or 0:>8.3f}")
+    print(f"Results written to {args.output}")
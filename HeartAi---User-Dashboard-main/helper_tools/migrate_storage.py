@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BASE_DIR, '..'))
+
+import storage
+import response_cache
+
+DATA_DIR = os.path.join(BASE_DIR, '..', 'data')
+
+# Migrates recordings from the legacy one-folder-per-upload layout
+# (data/<uuid>/<epoch>.wav|.png|.txt) into the content-addressed store.
+# The migration is online: files are copied into the store first, each row is
+# switched to the new stored path with a compare-and-swap UPDATE, and the legacy
+# files are only removed after a grace period, so requests that already read the
+# old path can still finish serving it.
+
+
+def legacy_rows(con, batch_size):
+    rows = con.execute("SELECT id, file_path FROM analysis_history ORDER BY id").fetchall()
+    batch = []
+    for record_id, file_path in rows:
+        if storage.is_content_addressed(file_path):
+            continue
+        batch.append((record_id, file_path))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_into_store(data_folder, file_path):
+    """
+    Copy a legacy recording and its derived files into the store.
+    Returns the new stored path, or None if the recording is missing.
+    """
+    audio_path = storage.resolve(data_folder, file_path, 'audio')
+    if not os.path.exists(audio_path):
+        return None
+    stored_path, _, _ = storage.save_file(data_folder, audio_path, 'audio')
+    for kind in ('image', 'inference'):
+        derived_path = storage.resolve(data_folder, file_path, kind)
+        target_path = storage.resolve(data_folder, stored_path, kind)
+        if os.path.exists(derived_path) and not os.path.exists(target_path):
+            storage.copy_file_to(data_folder, derived_path, stored_path, kind)
+    return stored_path
+
+
+def remove_legacy(data_folder, con, file_path):
+    """
+    Remove the legacy files of a recording once no row references them,
+    then remove its uuid folder if it is empty. Returns the bytes freed.
+    """
+    still_used = con.execute(
+        "SELECT COUNT(*) FROM analysis_history WHERE file_path=?", (file_path,)
+    ).fetchone()[0]
+    if still_used:
+        return 0
+    freed = storage.remove_recording(data_folder, file_path)
+    storage.prune_empty_dirs(data_folder, file_path)
+    return freed
+
+
+def migrate(data_folder, batch_size=50, grace_seconds=5.0, dry_run=False):
+    master_db = os.path.join(data_folder, 'master.db')
+    migrated = missing = freed = 0
+    with sqlite3.connect(master_db, timeout=30) as con:
+        con.execute(response_cache.CREATE_TABLE_SQL)
+        for batch in legacy_rows(con, batch_size):
+            switched = []
+            for record_id, file_path in batch:
+                if dry_run:
+                    print(f"Would migrate record {record_id}: {file_path}")
+                    continue
+                stored_path = copy_into_store(data_folder, file_path)
+                if stored_path is None:
+                    print(f"Record {record_id}: recording not found at {file_path}, skipped")
+                    missing += 1
+                    continue
+                # Only switch the row if nobody changed it in the meantime
+                cur = con.execute(
+                    "UPDATE analysis_history SET file_path=? WHERE id=? AND file_path=?",
+                    (stored_path, record_id, file_path)
+                )
+                if cur.rowcount:
+                    # The record's file_path changed, so cached history responses are stale
+                    username = con.execute("SELECT username FROM analysis_history WHERE id=?", (record_id,)).fetchone()[0]
+                    response_cache.bump_version(con, username)
+                    switched.append(file_path)
+                    migrated += 1
+            con.commit()
+
+            if switched:
+                time.sleep(grace_seconds)
+                for file_path in set(switched):
+                    freed += remove_legacy(data_folder, con, file_path)
+    print(f"Migrated {migrated} records, {missing} missing, {freed} bytes of legacy files removed")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move legacy uploads into the content-addressed store.")
+    parser.add_argument('--data-folder', default=DATA_DIR)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--grace-seconds', type=float, default=5.0,
+                        help="Delay before legacy files of a migrated batch are removed")
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    migrate(os.path.abspath(args.data_folder), args.batch_size, args.grace_seconds, args.dry_run)
@@ -1,24 +1,51 @@
 import os
-import shutil
-import random
+import sys
+import sqlite3
+import argparse
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATASET_DIR = os.path.join(BASE_DIR, '..', 'dataset')
-TRAIN_DIR = os.path.join(BASE_DIR, '..', 'train')
-TEST_DIR = os.path.join(BASE_DIR, '..', 'test')
-os.makedirs(TRAIN_DIR, exist_ok=True)
-os.makedirs(TEST_DIR, exist_ok=True)
-
-def separate_dataset(test_ratio=0.2):
-    files = [f for f in os.listdir(DATASET_DIR) if f.endswith('.wav')]
-    random.shuffle(files)
-    split_point = int(len(files) * (1 - test_ratio))
-    train_files = files[:split_point]
-    test_files = files[split_point:]
-    
-    for file in train_files:
-        shutil.copy(os.path.join(DATASET_DIR, file), TRAIN_DIR)
-    for file in test_files:
-        shutil.copy(os.path.join(DATASET_DIR, file), TEST_DIR)
-
-separate_dataset()
+sys.path.insert(0, os.path.join(BASE_DIR, '..'))
+
+import dataset_manifest
+
+# Splits the dataset into folds for testing and cross-validation without
+# copying any file: the fold of every file is written to the splits table of
+# the dataset manifest (run helper_tools/build_manifest.py first, and this
+# again after the manifest is rebuilt with new files). All recordings and
+# images of a patient land in the same fold, so a patient never appears on
+# both sides, and each fold holds about the same share of Absent and Present
+# files. The same seed always gives the same split.
+#
+# Fold 0 can serve as the test set of a plain train/test split
+# (--folds 5 holds out 20%); for k-fold cross-validation, train with
+#   python train_model.py --split default --fold K
+# for every K. The tools read the folds from the manifest, so no fold is
+# materialized as a folder.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Split the dataset into patient-grouped, stratified folds.")
+    parser.add_argument('--manifest', default=dataset_manifest.MANIFEST_PATH,
+                        help="Dataset manifest built by helper_tools/build_manifest.py")
+    parser.add_argument('--name', default='default', help="Name of the split, used by --split in the other tools")
+    parser.add_argument('--folds', type=int, default=5, help="Number of folds (fold 0 is a 1/FOLDS test set)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    assigned = dataset_manifest.split(args.manifest, args.name, args.folds, args.seed)
+    print(f"Split '{args.name}': {assigned} files in {args.folds} folds (seed {args.seed})")
+
+    con = sqlite3.connect(args.manifest)
+    try:
+        summary = con.execute(
+            "SELECT splits.fold, files.kind, files.label, COUNT(*), COUNT(DISTINCT files.patient_id) "
+            "FROM splits JOIN files ON files.path = splits.path WHERE splits.name = ? "
+            "GROUP BY splits.fold, files.kind, files.label ORDER BY splits.fold, files.kind, files.label",
+            (args.name,)).fetchall()
+    finally:
+        con.close()
+    print(f"{'fold':>4} {'kind':<6} {'label':<8} {'files':>6} {'patients':>9}")
+    for fold, kind, label, files, patients in summary:
+        label_name = dataset_manifest.CLASS_NAMES[label] if label is not None else 'unknown'
+        print(f"{fold:>4} {kind:<6} {label_name:<8} {files:>6} {patients:>9}")
+
@@ -1,32 +1,160 @@
 import os
-import numpy as np
-import librosa
-import librosa.display
-import matplotlib.pyplot as plt
-
-BASE_DIR = '/content/HeartSoundAnalysis'
-SOURCE_DIR = os.path.join(BASE_DIR, 'dataset')
-DEST_DIR = os.path.join(BASE_DIR, 'spectrograms')
-os.makedirs(DEST_DIR, exist_ok=True)
-
-def generate_spectrograms():
-    for file in os.listdir(SOURCE_DIR):
-        if file.endswith('.wav'):
-            audio_path = os.path.join(SOURCE_DIR, file)
-            
-            # Load the audio file
-            y, sr = librosa.load(audio_path, sr=None)
-            
-            # Generate the Mel spectrogram
-            spectrogram = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=128, fmax=8000)
-            spectrogram_db = librosa.power_to_db(spectrogram, ref=np.max)
-            
-            # Plot the spectrogram and save as a .png file
-            plt.figure(figsize=(5, 5))
-            librosa.display.specshow(spectrogram_db, sr=sr, hop_length=512, x_axis='time', y_axis='mel')
-            plt.axis('off')  # Hide axes for a cleaner image
-            save_path = os.path.join(DEST_DIR, file.replace('.wav', '.png'))
-            plt.savefig(save_path, bbox_inches='tight', pad_inches=0)
-            plt.close()
-
-generate_spectrograms()
+import sys
+import time
+import argparse
+import tempfile
+from multiprocessing import Pool
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.abspath(os.path.join(BASE_DIR, '..'))
+DEST_DIR = os.path.join(APP_DIR, 'spectrograms')
+sys.path.insert(0, APP_DIR)
+
+import dataset_manifest
+
+# Renders mel spectrogram PNGs for the recordings in the dataset manifest (or
+# every WAV under --source), with the same parameters and figure geometry as
+# heartai.extract_features (5x5 inch figure, viridis, no axes, tight bounding
+# box), so training images look like the ones the model sees at inference
+# time. Each image is named after its recording plus .png (13918_AV.wav ->
+# 13918_AV.wav.png), like the images already in spectrograms/ and the names
+# dataset_manifest parses; with --source the folders below it are mirrored in
+# the destination. Files are rendered by a pool of worker processes, and a PNG
+# that is newer than its WAV is skipped unless --force is given.
+
+
+def image_path(dest_dir, relative_audio_path):
+    return os.path.normpath(os.path.join(dest_dir, relative_audio_path + '.png'))
+
+
+def is_up_to_date(audio_path, save_path):
+    return os.path.exists(save_path) and os.path.getmtime(save_path) >= os.path.getmtime(audio_path)
+
+
+def find_jobs(source_dir, dest_dir, force=False):
+    """
+    Return (jobs, skipped): (wav, png) pairs to render, and the number of
+    recordings whose PNG is already up to date.
+    """
+    jobs = []
+    skipped = 0
+    for root, _, files in os.walk(source_dir):
+        relative_root = os.path.relpath(root, source_dir)
+        for file_name in sorted(files):
+            if not file_name.endswith('.wav'):
+                continue
+            audio_path = os.path.join(root, file_name)
+            save_path = image_path(dest_dir, os.path.join(relative_root, file_name))
+            if not force and is_up_to_date(audio_path, save_path):
+                skipped += 1
+                continue
+            jobs.append((audio_path, save_path))
+    return jobs, skipped
+
+
+def manifest_jobs(manifest_path, dest_dir, force=False):
+    """
+    Like find_jobs, for the recordings listed in the dataset manifest. Their
+    images go straight into dest_dir, one per recording name, as in the
+    existing spectrograms/ folder.
+    """
+    jobs = []
+    skipped = 0
+    seen = set()
+    for entry in dataset_manifest.query(manifest_path, kind='audio'):
+        audio_path = entry['path']
+        save_path = image_path(dest_dir, os.path.basename(audio_path))
+        if save_path in seen:
+            continue
+        seen.add(save_path)
+        if not force and is_up_to_date(audio_path, save_path):
+            skipped += 1
+            continue
+        jobs.append((audio_path, save_path))
+    return jobs, skipped
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def render_spectrogram(job):
+    import numpy as np
+    import librosa
+    import librosa.display
+    import matplotlib.pyplot as plt
+
+    audio_path, save_path = job
+    tmp_path = None
+    try:
+        # Load the audio file
+        y, sr = librosa.load(audio_path, sr=None)
+
+        # Generate the Mel spectrogram
+        spectrogram = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=128, fmax=8000)
+        spectrogram_db = librosa.power_to_db(spectrogram, ref=np.max)
+
+        # Plot the spectrogram and save as a .png file, written under a temporary
+        # name first so an interrupted run never leaves a truncated image behind
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        plt.figure(figsize=(5, 5))
+        librosa.display.specshow(spectrogram_db, sr=sr, hop_length=512, cmap='viridis')
+        plt.axis('off')  # Hide axes for a cleaner image
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(save_path), suffix='.part')
+        os.close(fd)
+        plt.savefig(tmp_path, format='png', bbox_inches='tight', pad_inches=0)
+        plt.close()
+        os.replace(tmp_path, save_path)
+        return audio_path, None
+    except Exception as e:
+        plt.close('all')
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return audio_path, str(e)
+
+
+def generate_spectrograms(source_dir=None, dest_dir=DEST_DIR, workers=None, force=False,
+                          manifest_path=dataset_manifest.MANIFEST_PATH):
+    if source_dir:
+        jobs, skipped = find_jobs(source_dir, dest_dir, force)
+    else:
+        jobs, skipped = manifest_jobs(manifest_path, dest_dir, force)
+    workers = workers or os.cpu_count() or 1
+    print(f"{len(jobs)} spectrograms to render, {skipped} up to date, {workers} workers")
+    if not jobs:
+        return 0, 0
+
+    started = time.perf_counter()
+    last_report = started
+    done = 0
+    failed = 0
+    with Pool(processes=min(workers, len(jobs)), initializer=_init_worker) as pool:
+        for audio_path, error in pool.imap_unordered(render_spectrogram, jobs, chunksize=4):
+            done += 1
+            if error:
+                failed += 1
+                print(f"Error rendering {audio_path}: {error}")
+            now = time.perf_counter()
+            if now - last_report >= 5 or done == len(jobs):
+                rate = done / (now - started)
+                remaining = (len(jobs) - done) / rate if rate else 0
+                print(f"  {done}/{len(jobs)} rendered, {rate:.1f} files/s, about {remaining:.0f} s left")
+                last_report = now
+
+    elapsed = time.perf_counter() - started
+    print(f"Rendered {done - failed} spectrograms in {elapsed:.1f} s ({done / elapsed:.1f} files/s), {failed} failed")
+    return done - failed, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render mel spectrogram PNGs for WAV recordings.")
+    parser.add_argument('--manifest', default=dataset_manifest.MANIFEST_PATH,
+                        help="Dataset manifest built by helper_tools/build_manifest.py")
+    parser.add_argument('--source', default=None, help="Search this folder for .wav files instead of using the manifest")
+    parser.add_argument('--dest', default=DEST_DIR, help="Folder for the .png files")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument('--force', action='store_true', help="Render again even if the PNG is up to date")
+    args = parser.parse_args()
+    _, failures = generate_spectrograms(args.source, args.dest, args.workers, args.force, args.manifest)
+    sys.exit(1 if failures else 0)
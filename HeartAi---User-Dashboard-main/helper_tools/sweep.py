@@ -0,0 +1,235 @@
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import itertools
+import statistics
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.abspath(os.path.join(BASE_DIR, '..'))
+sys.path.insert(0, APP_DIR)
+
+import dataset_manifest
+
+# Hyperparameter sweep for the CNN in train_model.py. Trials run in parallel
+# worker processes, each with a capped number of TensorFlow threads, and all
+# read the same feature store (helper_tools/build_feature_store.py), so the
+# features are computed once and shared through the page cache. Every trial uses
+# the same validation data: a fold of a patient-grouped manifest split
+# (helper_tools/separate_dataset.py; the split 'default' when there is one), or
+# else a random share of the patients. A trial is pruned when its validation
+# loss after an epoch is worse than the median other trials reported for that epoch.
+# The results table lists validation accuracy next to parameter count, model
+# file size and single-clip inference latency.
+#
+# Search space file (JSON): lists of candidate values per parameter, e.g.
+#   {"filters": [[16, 32], [32, 64]], "dense_units": [32, 64, 128],
+#    "dropout": [0.3, 0.5], "learning_rate": [0.001, 0.0003], "input_size": [96, 128]}
+
+DEFAULT_SPACE = {
+    'filters': [[16, 32], [32, 64], [64, 128]],
+    'dense_units': [32, 64, 128],
+    'dropout': [0.25, 0.5],
+    'learning_rate': [0.001, 0.0003],
+    'input_size': [96, 128],
+}
+
+COLUMNS = ('trial', 'filters', 'dense_units', 'dropout', 'learning_rate', 'input_size', 'status', 'epochs',
+           'val_accuracy', 'val_loss', 'parameters', 'model_bytes', 'latency_ms', 'train_seconds')
+
+
+def trial_configs(space, trials, seed):
+    """
+    All combinations of the search space, or a random sample of them if there
+    are more than trials.
+    """
+    names = sorted(space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if trials and trials < len(grid):
+        grid = random.Random(seed).sample(grid, trials)
+    return grid
+
+
+def _init_worker(threads_per_trial, reported, lock):
+    global intermediate_values, intermediate_lock
+    intermediate_values = reported
+    intermediate_lock = lock
+    # Cap the threads of this trial before TensorFlow starts
+    os.environ['OMP_NUM_THREADS'] = str(threads_per_trial)
+    import train_model
+    train_model.configure_threads(threads_per_trial, 1)
+
+
+def should_prune(epoch, value, min_reports):
+    """
+    Record this trial's validation loss for the epoch and tell whether it is
+    worse than the median of what the other trials reported so far.
+    """
+    with intermediate_lock:
+        others = list(intermediate_values.get(epoch, []))
+        intermediate_values[epoch] = others + [value]
+    return len(others) >= min_reports and value > statistics.median(others)
+
+
+def run_trial(number, config, features_dir, epochs, batch_size, validation_split, seed, prune_after, min_reports,
+              manifest_path=dataset_manifest.MANIFEST_PATH, split=None, fold=0):
+    import numpy as np
+    import tensorflow as tf
+    import feature_store
+    import train_model
+
+    class MedianPruner(tf.keras.callbacks.Callback):
+        def __init__(self):
+            super().__init__()
+            self.pruned = False
+
+        def on_epoch_end(self, epoch, logs=None):
+            if should_prune(epoch, logs['val_loss'], min_reports) and epoch + 1 >= prune_after:
+                self.pruned = True
+                self.model.stop_training = True
+
+    tf.keras.utils.set_random_seed(seed)
+    target_size = (config['input_size'], config['input_size'])
+    store = feature_store.FeatureStore(features_dir)
+    positions = [position for position, label in enumerate(store.labels) if label >= 0]
+    # The same split and seed give every trial the same validation data
+    train_positions, validation_positions = train_model.split_feature_positions(
+        store, positions, validation_split, seed, manifest_path, split, fold)
+    train_data = train_model.make_feature_dataset(store, train_positions, batch_size, target_size, seed=seed)
+    validation_data = train_model.make_feature_dataset(store, validation_positions, batch_size, target_size,
+                                                       shuffle=False)
+
+    model = train_model.build_model(target_size + (1,), tuple(config['filters']), config['dense_units'],
+                                    config['dropout'], config['learning_rate'])
+    pruner = MedianPruner()
+    started = time.perf_counter()
+    history = model.fit(train_data, validation_data=validation_data, epochs=epochs, callbacks=[pruner], verbose=0)
+    train_seconds = time.perf_counter() - started
+
+    # Model size on disk and single-clip latency, as the backend would see them
+    fd, model_path = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    try:
+        model.save(model_path)
+        model_bytes = os.path.getsize(model_path)
+    finally:
+        os.remove(model_path)
+    sample = np.zeros((1,) + target_size + (1,), dtype=np.float32)
+    model.predict(sample, verbose=0)
+    latencies = []
+    for _ in range(20):
+        predict_started = time.perf_counter()
+        model.predict(sample, verbose=0)
+        latencies.append(time.perf_counter() - predict_started)
+
+    best_epoch = int(np.argmin(history.history['val_loss']))
+    return {
+        'trial': number,
+        'filters': '-'.join(str(value) for value in config['filters']),
+        'dense_units': config['dense_units'],
+        'dropout': config['dropout'],
+        'learning_rate': config['learning_rate'],
+        'input_size': config['input_size'],
+        'status': 'pruned' if pruner.pruned else 'complete',
+        'epochs': len(history.history['val_loss']),
+        'val_accuracy': round(float(history.history['val_accuracy'][best_epoch]), 4),
+        'val_loss': round(float(history.history['val_loss'][best_epoch]), 4),
+        'parameters': int(model.count_params()),
+        'model_bytes': model_bytes,
+        'latency_ms': round(statistics.median(latencies) * 1000, 2),
+        'train_seconds': round(train_seconds, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a parallel hyperparameter sweep for the heart sound CNN.")
+    parser.add_argument('--features', default=os.path.join(APP_DIR, 'features'),
+                        help="Feature store built by helper_tools/build_feature_store.py")
+    parser.add_argument('--space', help="JSON file with the search space (default: a built-in grid)")
+    parser.add_argument('--trials', type=int, default=16, help="Trials sampled from the grid (0: the whole grid)")
+    parser.add_argument('--parallel', type=int, default=None, help="Trials run at the same time")
+    parser.add_argument('--threads-per-trial', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--manifest', default=dataset_manifest.MANIFEST_PATH,
+                        help="Dataset manifest built by helper_tools/build_manifest.py")
+    parser.add_argument('--split', default=None,
+                        help="Validate on a fold of this manifest split (helper_tools/separate_dataset.py) "
+                             "(default: the split 'default' if the manifest has one)")
+    parser.add_argument('--fold', type=int, default=0, help="Fold of --split used for validation")
+    parser.add_argument('--validation-split', type=float, default=None,
+                        help="Fraction of the patients held out at random instead of a split (default 0.2)")
+    parser.add_argument('--prune-after', type=int, default=3, help="Earliest epoch after which a trial can be pruned")
+    parser.add_argument('--min-reports', type=int, default=3,
+                        help="Other trials needed at an epoch before comparing with their median")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='sweep_results.csv')
+    args = parser.parse_args()
+    if args.split and args.validation_split is not None:
+        parser.error("--split replaces --validation-split")
+    if args.split is None and args.validation_split is None and dataset_manifest.split_exists(args.manifest, 'default'):
+        args.split = 'default'
+    if args.split:
+        print(f"Validating on fold {args.fold} of the manifest split '{args.split}'")
+    else:
+        if args.validation_split is None:
+            args.validation_split = 0.2
+        if not args.validation_split:
+            parser.error("Trials need validation data: a --split or a --validation-split above 0")
+        print(f"Validating on a random {args.validation_split:.0%} of the patients")
+
+    if args.space:
+        with open(args.space) as space_file:
+            space = json.load(space_file)
+    else:
+        space = DEFAULT_SPACE
+    configs = trial_configs(space, args.trials, args.seed)
+    parallel = args.parallel or max(1, (os.cpu_count() or 1) // args.threads_per_trial)
+    print(f"{len(configs)} trials, {parallel} at a time with {args.threads_per_trial} threads each")
+
+    # Spawned workers start without TensorFlow, so each can size its own thread pools
+    context = multiprocessing.get_context('spawn')
+    results = []
+    started = time.perf_counter()
+    with context.Manager() as manager:
+        reported = manager.dict()
+        lock = manager.Lock()
+        with ProcessPoolExecutor(max_workers=parallel, mp_context=context, initializer=_init_worker,
+                                 initargs=(args.threads_per_trial, reported, lock)) as pool:
+            futures = {
+                pool.submit(run_trial, number, config, args.features, args.epochs, args.batch_size,
+                            args.validation_split, args.seed, args.prune_after, args.min_reports,
+                            args.manifest, args.split, args.fold): number
+                for number, config in enumerate(configs)
+            }
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Trial {futures[future]} failed: {e}")
+                    continue
+                results.append(result)
+                print(f"Trial {result['trial']:3d} {result['status']:<8} val_accuracy {result['val_accuracy']:.3f} "
+                      f"after {result['epochs']} epochs ({len(results)}/{len(configs)} done)")
+
+    results.sort(key=lambda result: (-result['val_accuracy'], result['val_loss']))
+    with open(args.output, 'w', newline='') as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(f"\nSweep finished in {time.perf_counter() - started:.0f} s; results in {args.output}")
+    header = f"{'trial':>5} {'filters':>8} {'dense':>5} {'drop':>5} {'lr':>7} {'size':>4} {'status':>8} " \
+             f"{'val_acc':>7} {'params':>9} {'MB':>6} {'ms':>6}"
+    print(header)
+    for result in results:
+        print(f"{result['trial']:>5} {result['filters']:>8} {result['dense_units']:>5} {result['dropout']:>5} "
+              f"{result['learning_rate']:>7} {result['input_size']:>4} {result['status']:>8} "
+              f"{result['val_accuracy']:>7.3f} {result['parameters']:>9} {result['model_bytes'] / 1e6:>6.2f} "
+              f"{result['latency_ms']:>6.2f}")
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.abspath(os.path.join(BASE_DIR, '..'))
+TEST_DIR = os.path.join(APP_DIR, 'test')
+
+# Load test for the production server: starts gunicorn with 1, 2, 4, ... workers on
+# a throw-away data folder, keeps a fixed number of clients per worker uploading
+# recordings for a while, and prints upload throughput and latency per worker count.
+
+
+def wait_for_server(url, timeout_seconds):
+    deadline = time.time() + timeout_seconds
+    while time.time() < deadline:
+        try:
+            requests.post(f"{url}/login", json={}, timeout=2)
+            return True
+        except requests.ConnectionError:
+            time.sleep(1)
+    return False
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def upload_clients(url, recordings, clients, duration_seconds):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration_seconds
+
+    def client(index):
+        session = requests.Session()
+        count = 0
+        while time.time() < deadline:
+            recording = recordings[(index + count) % len(recordings)]
+            count += 1
+            with open(recording, 'rb') as audio_file:
+                started = time.perf_counter()
+                try:
+                    response = session.post(
+                        f"{url}/upload",
+                        files={"file": (os.path.basename(recording), audio_file)},
+                        data={"username": "loadtest", "password_md5": "loadtest", "patient_name": "load"},
+                        timeout=300,
+                    )
+                    ok = response.status_code == 200
+                except requests.RequestException:
+                    ok = False
+                elapsed = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started
+    return {
+        'clients': clients,
+        'uploads': len(latencies),
+        'errors': errors[0],
+        'uploads_per_second': len(latencies) / wall_seconds,
+        'p50_seconds': percentile(latencies, 0.50),
+        'p95_seconds': percentile(latencies, 0.95),
+    }
+
+
+def run_with_workers(workers, args, recordings):
+    data_folder = tempfile.mkdtemp(prefix='heartai-loadtest-')
+    url = f"http://127.0.0.1:{args.port}"
+    env = dict(os.environ,
+               HEARTAI_WORKERS=str(workers),
+               HEARTAI_THREADS=str(args.threads),
+               HEARTAI_BIND=f"127.0.0.1:{args.port}",
+               HEARTAI_DATA_FOLDER=data_folder)
+    server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'app:app'], cwd=APP_DIR, env=env)
+    try:
+        if not wait_for_server(url, args.startup_timeout):
+            raise RuntimeError(f"Server with {workers} workers did not start")
+        requests.post(f"{url}/createuser",
+                      json={"username": "loadtest", "password_md5": "loadtest", "role": "doctor"})
+        # Warm up every worker before measuring
+        upload_clients(url, recordings, workers, args.warmup)
+        result = upload_clients(url, recordings, workers * args.clients_per_worker, args.duration)
+        result['workers'] = workers
+        return result
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+        shutil.rmtree(data_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure upload throughput against the number of gunicorn workers.")
+    parser.add_argument('--workers', default='1,2,4', help="Comma separated worker counts")
+    parser.add_argument('--threads', type=int, default=4, help="Threads per worker")
+    parser.add_argument('--clients-per-worker', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=60, help="Seconds measured per worker count")
+    parser.add_argument('--warmup', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--startup-timeout', type=float, default=180)
+    parser.add_argument('--recordings', default=TEST_DIR, help="Folder of .wav files to upload")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    recordings = sorted(os.path.join(args.recordings, f) for f in os.listdir(args.recordings) if f.endswith('.wav'))
+    if not recordings:
+        sys.exit(f"No .wav files found in {args.recordings}")
+
+    results = [run_with_workers(int(workers), args, recordings) for workers in args.workers.split(',')]
+
+    print(f"{'workers':>8} {'clients':>8} {'uploads/s':>10} {'p50 s':>8} {'p95 s':>8} {'errors':>7}")
+    for result in results:
+        print(f"{result['workers']:>8} {result['clients']:>8} {result['uploads_per_second']:>10.2f} "
+              f"{result['p50_seconds'] or 0:>8.2f} {result['p95_seconds'] or 0:>8.2f} {result['errors']:>7}")
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
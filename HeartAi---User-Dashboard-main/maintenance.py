@@ -0,0 +1,375 @@
+# Background maintenance for the data folder and master.db.
+# A daemon thread periodically looks for media files that no analysis_history row
+# references (failed uploads, leftovers of deleted records, empty folders), removes
+# them in small rate-limited batches, and during quiet periods gives free SQLite
+# pages back to the file system (incremental vacuum) and truncates the WAL.
+# Nothing here runs on a request thread.
+
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the development server is supported there
+    fcntl = None
+
+import storage
+
+# Only files with these extensions are ever considered for removal.
+MEDIA_EXTENSIONS = set(storage.KIND_EXTENSIONS.values())
+
+# Files younger than this are never removed: an upload writes its recording
+# before the analysis_history row is inserted.
+DEFAULT_MIN_AGE_SECONDS = 3600
+DEFAULT_INTERVAL_SECONDS = 600
+DEFAULT_QUIET_SECONDS = 30
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_BATCH_PAUSE_SECONDS = 1.0
+VACUUM_PAGES_PER_STEP = 256
+# A process touches the shared activity file at most this often
+ACTIVITY_MARK_INTERVAL_SECONDS = 1.0
+
+_activity_lock = threading.Lock()
+_last_activity = time.monotonic()
+_in_flight = 0
+
+# Activity shared by all server processes (see set_activity_file): the mtime of
+# this file is the time of the last request start or end in any process
+_activity_path = None
+_last_marked = 0.0
+
+_worker = None
+_worker_lock = threading.Lock()
+
+# Totals since the worker started, also used by the /metrics endpoint.
+stats = {
+    'runs': 0,
+    'files_removed': 0,
+    'folders_removed': 0,
+    'file_bytes_reclaimed': 0,
+    'db_bytes_reclaimed': 0,
+    'last_run_epoch': None,
+}
+
+
+def set_activity_file(path):
+    """
+    Share request activity between the processes of a multi-process server
+    through the mtime of a marker file, so the process running maintenance also
+    sees the requests of the others. Without it, is_quiet only knows about the
+    requests of its own process.
+    """
+    global _activity_path
+    open(path, 'a').close()
+    _activity_path = path
+
+
+def _note_activity():
+    # Update this process's activity; touch the shared marker if it was last
+    # touched more than ACTIVITY_MARK_INTERVAL_SECONDS ago, so a busy server
+    # pays one utime per second per process instead of one per request
+    global _last_activity, _last_marked
+    now = time.monotonic()
+    _last_activity = now
+    if _activity_path is None or now - _last_marked < ACTIVITY_MARK_INTERVAL_SECONDS:
+        return False
+    _last_marked = now
+    return True
+
+
+def _mark_shared_activity():
+    try:
+        os.utime(_activity_path)
+    except OSError:
+        pass
+
+
+def request_started():
+    """
+    Record that a request is being handled. Called before every request.
+    """
+    global _in_flight
+    with _activity_lock:
+        _in_flight += 1
+        mark = _note_activity()
+    if mark:
+        _mark_shared_activity()
+
+
+def request_finished():
+    """
+    Record that a request finished. Called after every request.
+    """
+    global _in_flight
+    with _activity_lock:
+        _in_flight = max(0, _in_flight - 1)
+        mark = _note_activity()
+    if mark:
+        _mark_shared_activity()
+
+
+def is_quiet(quiet_seconds):
+    """
+    True if no request is running in this process and none has started or
+    ended for quiet_seconds, in any server process when an activity file is set.
+    Requests of other processes are only seen when they start and end, which is
+    enough for the small, busy-tolerant vacuum steps this guards.
+    """
+    with _activity_lock:
+        if _in_flight > 0 or time.monotonic() - _last_activity < quiet_seconds:
+            return False
+    if _activity_path is None:
+        return True
+    try:
+        return time.time() - os.stat(_activity_path).st_mtime >= quiet_seconds + ACTIVITY_MARK_INTERVAL_SECONDS
+    except OSError:
+        return True
+
+
+def _referenced_roots(master_db):
+    # Stored path of each recording without its extension, so the .wav, .png
+    # and .txt files of a referenced recording all match.
+    with sqlite3.connect(master_db, timeout=5) as con:
+        rows = con.execute("SELECT DISTINCT file_path FROM analysis_history").fetchall()
+    return {os.path.splitext(storage.normalize_stored_path(row[0]))[0] for row in rows}
+
+
+def find_orphans(data_folder, master_db, min_age_seconds=DEFAULT_MIN_AGE_SECONDS):
+    """
+    Return (orphan_files, empty_folders) in the data folder.
+    Looks at the object store, the legacy data/<uuid>/ folders and the temporary
+    upload folder; anything else (databases, nested copies) is left alone.
+    """
+    referenced = _referenced_roots(master_db)
+    cutoff = time.time() - min_age_seconds
+    orphan_files = []
+    empty_folders = []
+
+    for root, dirs, files in os.walk(data_folder):
+        relative_root = os.path.relpath(root, data_folder).replace(os.sep, '/')
+        depth = 0 if relative_root == '.' else relative_root.count('/') + 1
+        in_store = relative_root == storage.OBJECTS_DIR or relative_root.startswith(storage.OBJECTS_DIR + '/')
+        in_tmp = relative_root == storage.TMP_DIR
+        in_legacy = depth == 1 and not in_store and not in_tmp
+
+        # Only descend into the layouts this application writes
+        if depth == 0:
+            continue
+        if not in_store:
+            dirs[:] = []
+
+        for file_name in files:
+            full_path = os.path.join(root, file_name)
+            try:
+                if os.path.getmtime(full_path) > cutoff:
+                    continue
+            except OSError:
+                continue
+            # Temporary files of interrupted writes: uploads in tmp/, spectrograms
+            # and results beside the recordings in the object store
+            if file_name.endswith('.part'):
+                if in_tmp or in_store:
+                    orphan_files.append(full_path)
+                continue
+            if in_tmp:
+                continue
+            stem, extension = os.path.splitext(file_name)
+            if extension not in MEDIA_EXTENSIONS or not (in_store or in_legacy):
+                continue
+            if f"{relative_root}/{stem}" not in referenced:
+                orphan_files.append(full_path)
+
+        if (in_store or in_legacy) and not dirs and not files:
+            empty_folders.append(root)
+
+    return orphan_files, empty_folders
+
+
+def _is_referenced(con, data_folder, full_path):
+    # Whether an analysis_history row references the recording a media file
+    # belongs to, read from the database at the time of the call
+    relative_root = os.path.splitext(os.path.relpath(full_path, data_folder).replace(os.sep, '/'))[0]
+    stem = relative_root.rsplit('/', 1)[-1]
+    rows = con.execute("SELECT file_path FROM analysis_history WHERE instr(file_path, ?) > 0", (stem,)).fetchall()
+    return any(os.path.splitext(storage.normalize_stored_path(row[0]))[0] == relative_root for row in rows)
+
+
+def sweep(orphan_files, empty_folders, batch_size=DEFAULT_BATCH_SIZE,
+          batch_pause_seconds=DEFAULT_BATCH_PAUSE_SECONDS, stop_event=None,
+          data_folder=None, master_db=None, min_age_seconds=DEFAULT_MIN_AGE_SECONDS):
+    """
+    Remove orphaned files in batches with a pause between batches, then the
+    empty folders. Returns (files_removed, folders_removed, bytes_reclaimed).
+    The list may be minutes old by the time a file comes up: a duplicate upload
+    refreshes the mtime of the stored recording and then inserts a row for it.
+    So right before each removal the file must still be older than
+    min_age_seconds and, given data_folder and master_db, still unreferenced.
+    """
+    files_removed = 0
+    bytes_reclaimed = 0
+    cutoff = time.time() - min_age_seconds
+    con = sqlite3.connect(master_db, timeout=5) if master_db else None
+    try:
+        for index, full_path in enumerate(orphan_files, start=1):
+            try:
+                stat = os.stat(full_path)
+                still_orphaned = stat.st_mtime <= cutoff and not (
+                    con is not None and not full_path.endswith('.part')
+                    and _is_referenced(con, data_folder, full_path))
+                if still_orphaned:
+                    os.remove(full_path)
+                    files_removed += 1
+                    bytes_reclaimed += stat.st_size
+            except (OSError, sqlite3.Error):
+                pass
+            if index % batch_size == 0:
+                if stop_event is not None and stop_event.wait(batch_pause_seconds):
+                    break
+                if stop_event is None:
+                    time.sleep(batch_pause_seconds)
+    finally:
+        if con is not None:
+            con.close()
+
+    # Folders emptied by the sweep above are picked up on the next run
+    folders_removed = 0
+    for folder in empty_folders:
+        try:
+            os.rmdir(folder)
+            folders_removed += 1
+        except OSError:
+            continue
+    return files_removed, folders_removed, bytes_reclaimed
+
+
+def _database_size(master_db):
+    size = 0
+    for suffix in ('', '-wal'):
+        try:
+            size += os.path.getsize(master_db + suffix)
+        except OSError:
+            pass
+    return size
+
+
+def enable_incremental_vacuum(con):
+    """
+    Switch a database to incremental auto-vacuum. On an existing database the
+    setting only takes effect after one full VACUUM, which is done here.
+    """
+    if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.commit()
+        con.execute("VACUUM")
+
+
+def reclaim_database_space(master_db, quiet_seconds=DEFAULT_QUIET_SECONDS, stop_event=None):
+    """
+    Release free pages in small steps while the backend stays quiet, then
+    checkpoint and truncate the WAL. Returns the bytes given back.
+    """
+    size_before = _database_size(master_db)
+    # isolation_level=None: every PRAGMA is its own short transaction
+    con = sqlite3.connect(master_db, timeout=1, isolation_level=None)
+    try:
+        if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        while con.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+            if not is_quiet(quiet_seconds) or (stop_event is not None and stop_event.is_set()):
+                break
+            con.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})").fetchall()
+        if is_quiet(quiet_seconds):
+            con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    except sqlite3.OperationalError as e:
+        # Busy database: try again on the next run
+        print(f"Maintenance: database busy, skipping vacuum ({e})")
+    finally:
+        con.close()
+    return max(0, size_before - _database_size(master_db))
+
+
+def run_once(data_folder, master_db, min_age_seconds=DEFAULT_MIN_AGE_SECONDS,
+             quiet_seconds=DEFAULT_QUIET_SECONDS, batch_size=DEFAULT_BATCH_SIZE,
+             batch_pause_seconds=DEFAULT_BATCH_PAUSE_SECONDS, stop_event=None):
+    """
+    One maintenance pass: sweep orphaned media, then reclaim database space.
+    Returns a report dict with the reclaimed bytes.
+    """
+    orphan_files, empty_folders = find_orphans(data_folder, master_db, min_age_seconds)
+    files_removed, folders_removed, file_bytes = sweep(
+        orphan_files, empty_folders, batch_size, batch_pause_seconds, stop_event,
+        data_folder, master_db, min_age_seconds
+    )
+    db_bytes = 0
+    if is_quiet(quiet_seconds):
+        db_bytes = reclaim_database_space(master_db, quiet_seconds, stop_event)
+
+    report = {
+        'files_removed': files_removed,
+        'folders_removed': folders_removed,
+        'file_bytes_reclaimed': file_bytes,
+        'db_bytes_reclaimed': db_bytes,
+    }
+    stats['runs'] += 1
+    for key, value in report.items():
+        stats[key] += value
+    stats['last_run_epoch'] = int(time.time())
+    if files_removed or folders_removed or db_bytes:
+        print(f"Maintenance: removed {files_removed} files and {folders_removed} folders, "
+              f"reclaimed {file_bytes} file bytes and {db_bytes} database bytes")
+    return report
+
+
+def _worker_loop(data_folder, master_db, interval_seconds, stop_event, options):
+    while not stop_event.wait(interval_seconds):
+        try:
+            run_once(data_folder, master_db, stop_event=stop_event, **options)
+        except Exception as e:
+            print(f"Maintenance run failed: {e}")
+
+
+def _acquire_worker_lock(lock_path):
+    # Non-blocking exclusive lock held for the life of the process, so that only
+    # one of several server processes runs maintenance. The lock is released by
+    # the OS when that process exits and another process can take over.
+    if fcntl is None:
+        return True
+    lock_file = open(lock_path, 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _held_locks.append(lock_file)
+    return True
+
+
+_held_locks = []
+
+
+def start_worker(data_folder, master_db, interval_seconds=DEFAULT_INTERVAL_SECONDS,
+                 lock_path=None, **options):
+    """
+    Start the background maintenance thread once per process.
+    With lock_path, the thread is only started if this process wins the lock,
+    so a multi-process server runs a single maintenance worker.
+    Returns the threading.Event that stops it, or None if another process owns it.
+    """
+    global _worker
+    with _worker_lock:
+        if _worker is not None:
+            return _worker[1]
+        if lock_path is not None and not _acquire_worker_lock(lock_path):
+            return None
+        stop_event = threading.Event()
+        thread = threading.Thread(
+            target=_worker_loop,
+            args=(data_folder, master_db, interval_seconds, stop_event, options),
+            name='heartai-maintenance',
+            daemon=True,
+        )
+        thread.start()
+        _worker = (thread, stop_event)
+        return stop_event
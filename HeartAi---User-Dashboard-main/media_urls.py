@@ -0,0 +1,82 @@
+# Signed, expiring URLs for recordings and spectrograms.
+# /history/<id> checks the caller's credentials once and hands out URLs like
+#   /media/objects/ab/cd/<digest>.png?expires=1790000000&signature=<hmac>
+# The media endpoint only verifies the HMAC and the expiry, without touching the
+# database, and the URL carries no credentials. Since stored files never change,
+# the responses can be cached by the browser and by a reverse proxy.
+# Expiry times are rounded up to a bucket, so the same record yields the same
+# URL for a while and repeated page renders hit the caches.
+
+import hashlib
+import hmac
+import os
+import secrets
+import tempfile
+import time
+
+import storage
+
+SECRET_FILE = '.media_secret'
+
+# Media kinds that can be served, by file extension
+MEDIA_KINDS = {
+    storage.KIND_EXTENSIONS['audio']: ('audio', 'audio/wav'),
+    storage.KIND_EXTENSIONS['image']: ('image', 'image/png'),
+}
+
+
+def load_secret(data_folder):
+    """
+    Return the signing key: HEARTAI_MEDIA_SECRET if set, otherwise a random key
+    kept in the data folder (created on first use) so that every worker process
+    and restart signs and verifies with the same key.
+    """
+    configured = os.environ.get('HEARTAI_MEDIA_SECRET')
+    if configured:
+        return configured.encode()
+    secret_path = os.path.join(data_folder, SECRET_FILE)
+    if not os.path.exists(secret_path):
+        # Write the key to a private temporary file and link it into place,
+        # so concurrent first starts agree on a single key
+        fd, tmp_path = tempfile.mkstemp(dir=data_folder, suffix='.part')
+        try:
+            with os.fdopen(fd, 'w') as secret_file:
+                secret_file.write(secrets.token_hex(32))
+            os.link(tmp_path, secret_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(secret_path) as secret_file:
+        return secret_file.read().strip().encode()
+
+
+def expiry(ttl_seconds, bucket_seconds, now=None):
+    """
+    An expiry at least ttl_seconds away, rounded up to a multiple of bucket_seconds.
+    """
+    now = time.time() if now is None else now
+    return (int(now + ttl_seconds) // bucket_seconds + 1) * bucket_seconds
+
+
+def _signature(secret, media_path, expires):
+    message = f"{media_path}\n{expires}".encode()
+    return hmac.new(secret, message, hashlib.sha256).hexdigest()
+
+
+def signed_url(secret, stored_path, kind, expires):
+    """
+    Relative URL of the given kind of file of a stored recording.
+    """
+    media_path = storage.sibling_stored_path(stored_path, kind)
+    return f"/media/{media_path}?expires={expires}&signature={_signature(secret, media_path, expires)}"
+
+
+def verify(secret, media_path, expires, signature, now=None):
+    """
+    True if the signature matches the path and expiry and the URL has not expired.
+    """
+    now = time.time() if now is None else now
+    if expires < now:
+        return False
+    return hmac.compare_digest(_signature(secret, media_path, expires), signature)
@@ -0,0 +1,369 @@
+# Prometheus-format runtime metrics for the backend.
+# Counters and histograms are kept per thread: a thread only ever writes its own
+# cell, so recording a value takes no lock. Cells are summed when /metrics is
+# scraped. When a thread ends, its cell is folded into a shared total, so the
+# number of cells stays bounded by the number of live threads. With several gunicorn workers (HEARTAI_METRICS_DIR set), each worker
+# also writes a snapshot file periodically and /metrics merges all of them.
+
+import bisect
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+
+# Latency buckets in seconds, from cache hits to full inference runs.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SNAPSHOT_INTERVAL_SECONDS = 5
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._cells = []
+        self._retired = {}
+        self._cells_lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _cell(self):
+        # The calling thread's own {labels: value} dict, created on first use
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = _CellHolder()
+            self._local.holder = holder
+            with self._cells_lock:
+                self._cells.append(holder.cell)
+            # The thread-local holder is dropped when the thread ends
+            weakref.finalize(holder, self._retire, holder.cell)
+        return holder.cell
+
+    def _retire(self, cell):
+        # Fold the cell of a finished thread into the shared total
+        with self._cells_lock:
+            self._cells = [other for other in self._cells if other is not cell]
+            self._merge_into(self._retired, cell)
+
+    def _label_values(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def _cells_snapshot(self):
+        # The live cells and a copy of the retired total, taken together so a
+        # cell retired meanwhile is never counted twice
+        with self._cells_lock:
+            retired = {}
+            self._merge_into(retired, self._retired)
+            return list(self._cells) + [retired]
+
+    def samples(self):
+        totals = {}
+        for cell in self._cells_snapshot():
+            self._merge_into(totals, cell)
+        return totals
+
+
+class _CellHolder:
+    # Weak-referenceable owner of a thread's cell
+    def __init__(self):
+        self.cell = {}
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        cell = self._cell()
+        key = self._label_values(labels)
+        cell[key] = cell.get(key, 0) + amount
+
+    def _merge_into(self, totals, cell):
+        for key, value in list(cell.items()):
+            totals[key] = totals.get(key, 0) + value
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, e.g. requests waiting for inference.
+    inc() and dec() must happen on the same thread or be balanced overall.
+    """
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class FunctionMetric(_Metric):
+    """
+    A gauge or counter whose value is read from a callback at scrape time.
+    """
+
+    def __init__(self, name, documentation, function, kind='gauge'):
+        super().__init__(name, documentation)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        return {(): self.function()}
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        cell = self._cell()
+        key = self._label_values(labels)
+        entry = cell.get(key)
+        if entry is None:
+            # Bucket counts (last one is +Inf), then sum, then count
+            entry = [0] * (len(self.buckets) + 3)
+            cell[key] = entry
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _merge_into(self, totals, cell):
+        for key, entry in list(cell.items()):
+            total = totals.setdefault(key, [0] * len(entry))
+            for index, value in enumerate(list(entry)):
+                total[index] += value
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+HTTP_REQUESTS = Counter(
+    'heartai_http_requests_total', 'HTTP requests handled.', ('route', 'method', 'status'))
+HTTP_LATENCY = Histogram(
+    'heartai_http_request_duration_seconds', 'Time spent handling HTTP requests.', ('route',))
+HTTP_RESPONSE_BYTES = Counter(
+    'heartai_http_response_bytes_total', 'Bytes sent in HTTP response bodies.', ('route',))
+INFERENCE_IN_PROGRESS = Gauge(
+    'heartai_inference_in_progress', 'Uploads currently running the inference pipeline.')
+INFERENCE_STAGE_LATENCY = Histogram(
+    'heartai_inference_stage_duration_seconds', 'Time spent in each inference pipeline stage.', ('stage',))
+SQLITE_QUERY_LATENCY = Histogram(
+    'heartai_sqlite_query_duration_seconds', 'Time spent executing SQLite statements.', ('statement',))
+SQLITE_LOCK_WAIT = Histogram(
+    'heartai_sqlite_lock_wait_seconds',
+    'Time of the first write statement of each transaction, including the wait for the SQLite write lock.')
+CACHE_LOOKUPS = Counter(
+    'heartai_cache_lookups_total', 'Cache lookups by cache and result (hit or miss).', ('cache', 'result'))
+
+
+def observe_stage_timings(timings):
+    """
+    Record the per-stage timings reported by the inference pipeline.
+    """
+    for stage, seconds in timings.items():
+        INFERENCE_STAGE_LATENCY.observe(seconds, stage=stage)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor that records statement latency, and the duration of the statement
+    that starts a write transaction. sqlite3 opens the transaction (a deferred
+    BEGIN) right before that statement, and the statement waits for the write
+    lock, so its duration is the lock wait plus its own, usually short, run
+    time. The locking mode is left as it is.
+    """
+
+    def execute(self, sql, parameters=()):
+        statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'OTHER'
+        starts_write = statement in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE') and not self.connection.in_transaction
+        if statement not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'PRAGMA'):
+            statement = 'OTHER'
+        with SQLITE_QUERY_LATENCY.time(statement=statement):
+            if not starts_write:
+                return super().execute(sql, parameters)
+            with SQLITE_LOCK_WAIT.time():
+                return super().execute(sql, parameters)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    sqlite3.connect(..., factory=InstrumentedConnection) returns connections
+    whose cursors are instrumented.
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def snapshot():
+    """
+    Current values of all metrics of this process, as a JSON-serializable dict.
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+    result = {}
+    for metric in metrics:
+        result[metric.name] = {
+            'kind': metric.kind,
+            'help': metric.documentation,
+            'labels': list(metric.label_names),
+            'buckets': list(getattr(metric, 'buckets', ())),
+            'samples': [[list(key), value] for key, value in metric.samples().items()],
+        }
+    return result
+
+
+def _merge(snapshots):
+    merged = {}
+    for metrics in snapshots:
+        for name, metric in metrics.items():
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for key, value in metric['samples']:
+                key = tuple(key)
+                if key not in target['samples']:
+                    target['samples'][key] = value
+                elif isinstance(value, list):
+                    target['samples'][key] = [a + b for a, b in zip(target['samples'][key], value)]
+                else:
+                    target['samples'][key] += value
+    return merged
+
+
+def render(snapshots):
+    """
+    Render one or more snapshots in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, metric in sorted(_merge(snapshots).items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        label_names = metric['labels']
+        for key, value in sorted(metric['samples'].items()):
+            if metric['kind'] == 'histogram':
+                cumulative = 0
+                bounds = list(metric['buckets']) + [float('inf')]
+                for bound, count in zip(bounds, value[:-2]):
+                    cumulative += count
+                    labels = _format_labels(label_names, key, [('le', _format_number(bound))])
+                    lines.append(f"{name}_bucket{labels} {cumulative}")
+                labels = _format_labels(label_names, key)
+                lines.append(f"{name}_sum{labels} {_format_number(value[-2])}")
+                lines.append(f"{name}_count{labels} {value[-1]}")
+            else:
+                lines.append(f"{name}{_format_labels(label_names, key)} {_format_number(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+# Multi-process mode --------------------------------------------------------
+
+def _metrics_dir():
+    return os.environ.get('HEARTAI_METRICS_DIR')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def write_snapshot():
+    """
+    Atomically write this process's snapshot to the shared metrics folder.
+    """
+    metrics_dir = _metrics_dir()
+    os.makedirs(metrics_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=metrics_dir, suffix='.part')
+    with os.fdopen(fd, 'w') as snapshot_file:
+        json.dump({'pid': os.getpid(), 'metrics': snapshot()}, snapshot_file)
+    os.replace(tmp_path, os.path.join(metrics_dir, f"{os.getpid()}.json"))
+
+
+def collect():
+    """
+    Snapshots to expose: this process only, or every worker in multi-process mode.
+    Counters of exited workers are kept so totals never go backwards; their
+    gauges are dropped.
+    """
+    metrics_dir = _metrics_dir()
+    if not metrics_dir:
+        return [snapshot()]
+    write_snapshot()
+    snapshots = []
+    for file_name in os.listdir(metrics_dir):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(metrics_dir, file_name)) as snapshot_file:
+                data = json.load(snapshot_file)
+        except (OSError, ValueError):
+            continue
+        metrics = data['metrics']
+        if not _pid_alive(data['pid']):
+            metrics = {name: metric for name, metric in metrics.items() if metric['kind'] != 'gauge'}
+        snapshots.append(metrics)
+    return snapshots
+
+
+def start_snapshot_writer():
+    """
+    In multi-process mode, write this process's snapshot every few seconds so
+    that a scrape served by any worker sees the others.
+    """
+    if not _metrics_dir():
+        return
+
+    def write_loop():
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL_SECONDS)
+            try:
+                write_snapshot()
+            except OSError as e:
+                print(f"Failed to write metrics snapshot: {e}")
+
+    threading.Thread(target=write_loop, name='heartai-metrics', daemon=True).start()
@@ -0,0 +1,84 @@
+# Versioned caching of history responses.
+# Every user has a history version in the history_versions table. It is bumped in
+# the same transaction as any change to the user's records (upload, notes update,
+# delete), so a response built for (user, version, parameters) stays correct
+# until the version moves on. That lets the backend answer repeated requests from
+# an in-process cache of serialized responses, and lets clients revalidate with
+# ETag / If-None-Match and get 304 Not Modified without a body.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# Part of every ETag; bump it when the JSON of the history responses changes, so
+# clients holding an ETag of the old format do not get 304 for it
+# 2: site, session_id and session_inference in /history/<id>
+RESPONSE_FORMAT = 2
+
+CREATE_TABLE_SQL = """CREATE TABLE IF NOT EXISTS history_versions (
+    username TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+)"""
+
+
+def bump_version(cur, username):
+    """
+    Mark the user's history as changed. Call inside the transaction that
+    changes the records, before it is committed.
+    """
+    cur.execute(
+        "INSERT INTO history_versions (username, version) VALUES (?, 1) "
+        "ON CONFLICT(username) DO UPDATE SET version = version + 1",
+        (username,)
+    )
+
+
+def get_version(cur, username):
+    row = cur.execute("SELECT version FROM history_versions WHERE username=?", (username,)).fetchone()
+    return row[0] if row else 0
+
+
+def make_etag(key):
+    """
+    Strong ETag for the response identified by a cache key.
+    """
+    return '"' + hashlib.sha256(repr((RESPONSE_FORMAT, key)).encode()).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match may list several ETags, or be '*'
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or ('W/' + etag) in candidates
+
+
+class ResponseCache:
+    """
+    A small thread-safe LRU of serialized response bodies. Entries are never
+    invalidated explicitly: a changed history has a new version, so its old
+    entries are simply not asked for again and age out.
+    """
+
+    def __init__(self, name, max_entries):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        metrics.CACHE_LOOKUPS.inc(cache=self.name, result='hit' if entry is not None else 'miss')
+        return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
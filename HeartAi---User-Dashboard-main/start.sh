@@ -1,5 +1,16 @@
 #!/bin/bash
 
+if [ "$1" == "production" ]; then
+    # Pre-fork WSGI server: see gunicorn.conf.py for worker, thread and
+    # TensorFlow thread settings (HEARTAI_WORKERS, HEARTAI_THREADS, ...)
+    echo "Starting gunicorn backend on port 8080"
+    exec gunicorn -c gunicorn.conf.py app:app
+fi
+
+# Create or migrate the database before the development server starts
+# (importing app does it; the model is not needed for that)
+HEARTAI_PRELOAD_MODEL=0 python3 -c "import app" || exit 1
+
 echo "Starting Flask backend on port 5000"
 # Run Flask (app.py) on port 5000 in the background
 FLASK_APP=app.py flask run --host=0.0.0.0 --port=8080
@@ -0,0 +1,307 @@
+# Content-addressed storage for uploaded recordings.
+# Every recording is named after the SHA-256 digest of its bytes and placed in a
+# two-level sharded layout (objects/ab/cd/<digest>.wav), so no directory grows
+# with the number of uploads and identical uploads share one file.
+# Derived files (spectrogram .png, inference .txt) live next to the recording.
+
+import hashlib
+import ntpath
+import os
+import posixpath
+import tempfile
+
+OBJECTS_DIR = 'objects'
+TMP_DIR = 'tmp'
+CHUNK_SIZE = 1024 * 1024
+
+# Extension of each file kind that belongs to one stored recording.
+KIND_EXTENSIONS = {
+    'audio': '.wav',
+    'image': '.png',
+    'inference': '.txt',
+}
+
+# Recognized audio containers, by the bytes they start with
+AUDIO_SIGNATURES = (
+    (0, b'RIFF', 8, b'WAVE'),
+    (0, b'fLaC', None, None),
+)
+HEADER_BYTES = 12
+
+
+def stored_path_for_digest(digest, kind='audio'):
+    """
+    Return the stored path (relative to the data folder, always '/'-separated)
+    of the given kind of file for a content digest.
+    """
+    return posixpath.join(OBJECTS_DIR, digest[:2], digest[2:4], digest + KIND_EXTENSIONS[kind])
+
+
+def is_content_addressed(stored_path):
+    """
+    True if the stored path already points into the sharded object store.
+    """
+    return normalize_stored_path(stored_path).startswith(OBJECTS_DIR + '/')
+
+
+def normalize_stored_path(stored_path):
+    """
+    Normalize a stored path from the database to a relative '/'-separated path.
+    Legacy rows may hold absolute Windows paths such as
+    'G:\\...\\data\\<uuid>\\<epoch>.wav'; those keep their last two components.
+    """
+    path = stored_path.replace('\\', '/')
+    if ntpath.isabs(stored_path) or posixpath.isabs(path):
+        path = posixpath.join(*path.split('/')[-2:])
+    return posixpath.normpath(path)
+
+
+def sibling_stored_path(stored_path, kind):
+    """
+    Return the stored path of another kind of file belonging to the same recording.
+    """
+    root, _ = posixpath.splitext(normalize_stored_path(stored_path))
+    return root + KIND_EXTENSIONS[kind]
+
+
+def resolve(data_folder, stored_path, kind='audio'):
+    """
+    Return the absolute file system path of a stored file.
+    Raises ValueError if the stored path escapes the data folder.
+    """
+    relative_path = sibling_stored_path(stored_path, kind)
+    data_folder = os.path.abspath(data_folder)
+    full_path = os.path.abspath(os.path.join(data_folder, *relative_path.split('/')))
+    if os.path.commonpath([data_folder, full_path]) != data_folder:
+        raise ValueError(f"Stored path outside of the data folder: {stored_path}")
+    return full_path
+
+
+def _open_temp_file(data_folder, mode='wb'):
+    # Temporary files are created inside the data folder so that the final
+    # os.replace is a rename on the same file system, never a copy.
+    tmp_folder = os.path.join(data_folder, TMP_DIR)
+    os.makedirs(tmp_folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_folder, suffix='.part')
+    return os.fdopen(fd, mode), tmp_path
+
+
+def commit_temp_file(data_folder, tmp_path, digest, kind='audio'):
+    """
+    Atomically move a fully written temporary file to its content-addressed location.
+    If the content is already stored the temporary file is discarded.
+    Returns the stored path.
+    """
+    stored_path = stored_path_for_digest(digest, kind)
+    full_path = resolve(data_folder, stored_path, kind)
+    if os.path.exists(full_path):
+        os.remove(tmp_path)
+        # Refresh the modification time so background cleanup treats the
+        # re-uploaded recording as new
+        os.utime(full_path)
+        return stored_path
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    os.replace(tmp_path, full_path)
+    return stored_path
+
+
+def _write_temp(data_folder, stream):
+    # Copy the stream to a temporary file in fixed-size chunks, hashing on the fly
+    sha256 = hashlib.sha256()
+    size = 0
+    tmp_file, tmp_path = _open_temp_file(data_folder)
+    try:
+        with tmp_file:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                tmp_file.write(chunk)
+                size += len(chunk)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, sha256.hexdigest(), size
+
+
+def save_stream(data_folder, stream, kind='audio'):
+    """
+    Copy a binary stream into the store in fixed-size chunks, hashing on the fly.
+    The file only appears under its final name once it is complete (write to a
+    temporary file, fsync, rename).
+    Returns (stored_path, digest, size).
+    """
+    tmp_path, digest, size = _write_temp(data_folder, stream)
+    try:
+        return commit_temp_file(data_folder, tmp_path, digest, kind), digest, size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class UploadRejected(Exception):
+    """
+    Base class of the reasons an incoming upload is refused while it streams in.
+    """
+
+
+class UploadTooLarge(UploadRejected):
+    pass
+
+
+class InvalidAudio(UploadRejected):
+    pass
+
+
+def is_audio_header(header):
+    """
+    True if the first bytes of a file look like a WAV or FLAC recording.
+    """
+    for offset, magic, second_offset, second_magic in AUDIO_SIGNATURES:
+        if header[offset:offset + len(magic)] != magic:
+            continue
+        if second_magic is None or header[second_offset:second_offset + len(second_magic)] == second_magic:
+            return True
+    return False
+
+
+class IncomingFile:
+    """
+    Writable file that receives an upload chunk by chunk while the request body
+    is parsed. The chunks go straight to a temporary file in the store, the
+    SHA-256 digest is computed on the fly, the size limit is enforced as soon as
+    it is exceeded and the audio header is checked as soon as it has arrived.
+    A rejected or abandoned upload removes its temporary file.
+    """
+
+    def __init__(self, data_folder, max_bytes=None):
+        self.data_folder = data_folder
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._header = b''
+        self._file, self.tmp_path = _open_temp_file(data_folder, 'w+b')
+        self._committed = False
+
+    def _reject(self, error):
+        self.close()
+        raise error
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self._reject(UploadTooLarge(f"Upload exceeds {self.max_bytes} bytes"))
+        if len(self._header) < HEADER_BYTES:
+            self._header += chunk[:HEADER_BYTES - len(self._header)]
+            if len(self._header) == HEADER_BYTES and not is_audio_header(self._header):
+                self._reject(InvalidAudio("Not a WAV or FLAC recording"))
+        self._sha256.update(chunk)
+        return self._file.write(chunk)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    @property
+    def digest(self):
+        return self._sha256.hexdigest()
+
+    def commit(self, kind='audio'):
+        """
+        Validate the complete upload, make it durable and move it to its
+        content-addressed location. Returns (stored_path, digest, size).
+        """
+        if not is_audio_header(self._header):
+            self._reject(InvalidAudio("Not a WAV or FLAC recording"))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        stored_path = commit_temp_file(self.data_folder, self.tmp_path, self.digest, kind)
+        self._committed = True
+        return stored_path, self.digest, self.size
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if not self._committed and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+
+def save_file(data_folder, source_path, kind='audio'):
+    """
+    Store an existing file by content. The source file is left untouched.
+    Returns (stored_path, digest, size).
+    """
+    with open(source_path, 'rb') as source:
+        return save_stream(data_folder, source, kind)
+
+
+def copy_file_to(data_folder, source_path, stored_path, kind):
+    """
+    Atomically copy a file to the given kind of file of a stored recording,
+    e.g. the spectrogram belonging to an already stored recording.
+    """
+    with open(source_path, 'rb') as source:
+        tmp_path, _, _ = _write_temp(data_folder, source)
+    full_path = resolve(data_folder, stored_path, kind)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    os.replace(tmp_path, full_path)
+
+
+def file_digest(path):
+    """
+    Return the SHA-256 hex digest of a file, read in chunks.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def remove_recording(data_folder, stored_path):
+    """
+    Remove a recording and all of its derived files. Missing files are ignored.
+    Returns the number of bytes freed.
+    """
+    freed = 0
+    for kind in KIND_EXTENSIONS:
+        full_path = resolve(data_folder, stored_path, kind)
+        try:
+            size = os.path.getsize(full_path)
+            os.remove(full_path)
+            freed += size
+        except FileNotFoundError:
+            continue
+    return freed
+
+
+def prune_empty_dirs(data_folder, stored_path):
+    """
+    Remove the now empty directories above a removed recording, stopping at the
+    data folder or the first directory that still has entries.
+    """
+    data_folder = os.path.abspath(data_folder)
+    folder = os.path.dirname(resolve(data_folder, stored_path))
+    while folder != data_folder and os.path.commonpath([data_folder, folder]) == data_folder:
+        try:
+            os.rmdir(folder)
+        except OSError:
+            break
+        folder = os.path.dirname(folder)
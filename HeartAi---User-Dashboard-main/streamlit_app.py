@@ -1,19 +1,115 @@
 # Import necessary libraries for the Streamlit web app.
-# Import the requests library for making HTTP requests.
 # Import the hashlib library for cryptographic hashing.
 # Import the datetime library for working with dates and times.
+# Import the backend client for making HTTP requests to the backend.
 
 import streamlit as st
-import requests
 import hashlib
 import datetime
-# Define the backend URL for the application.
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from backend_client import BackendClient
+# Create the backend client for the application.
 # Define a function to hash passwords for security.
 # This function will take a password as input.
 # It will then return the hashed password.
 
 
-BACKEND_URL = "http://127.0.0.1:8080"
+# One backend client (and connection pool) is shared by all sessions and kept across reruns.
+@st.cache_resource
+def get_backend():
+    return BackendClient.from_environment()
+
+backend = get_backend()
+
+# History listings and record details are cached per user for a short time, so
+# reruns caused by typing or clicking do not refetch them. Each cached call takes
+# a generation token from the session state; bumping a token after a change makes
+# the next rerun miss the cache for exactly the data that changed. st.cache_data
+# is shared by all sessions, so a token also holds an id unique to its session:
+# two tabs of one user never reach the same token for different data. Other
+# sessions of the same user see the change once the TTL has passed.
+HISTORY_CACHE_TTL_SECONDS = 60
+
+HISTORY_PAGE_SIZES = [10, 25, 50, 100]
+
+def load_history(username, password_md5, limit, offset, sort, search):
+    # One page of summary rows, and the number of matching records
+    response = backend.access_history(username, password_md5, limit=limit, offset=offset, sort=sort, search=search)
+    if response.status_code != 200:
+        return response.status_code, None, 0
+    total = int(response.headers.get("X-Total-Count", len(response.json())))
+    return response.status_code, response.json(), total
+
+def load_record_details(record_id, username, password_md5):
+    response = backend.history_details(record_id, username, password_md5)
+    return response.status_code, response.json() if response.status_code == 200 else None
+
+# _prefetched (not part of the cache key) is this session's background fetch of
+# the same call, see take_prefetched; it is awaited instead of calling the backend.
+@st.cache_data(ttl=HISTORY_CACHE_TTL_SECONDS, max_entries=256, show_spinner=False)
+def fetch_history(username, password_md5, generation, limit, offset, sort, search, _prefetched=None):
+    if _prefetched is not None:
+        return _prefetched.result()
+    return load_history(username, password_md5, limit, offset, sort, search)
+
+@st.cache_data(ttl=HISTORY_CACHE_TTL_SECONDS, max_entries=2048, show_spinner=False)
+def fetch_record_details(record_id, username, password_md5, generation, _prefetched=None):
+    if _prefetched is not None:
+        return _prefetched.result()
+    return load_record_details(record_id, username, password_md5)
+
+# Details of the records on the visible page, and the next page of the listing,
+# are fetched in the background by a small shared thread pool, so they are
+# already at hand when the user opens a record or turns the page. The pool
+# threads only call the backend. The responses are stored in st.cache_data on
+# the script thread, when the cached fetch function above misses and is handed
+# the prefetched response instead of calling the backend itself.
+PREFETCH_WORKERS = 8
+
+@st.cache_resource
+def get_prefetch_pool():
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="heartai-prefetch")
+
+def prefetch(generation, load, *args):
+    # Start load(*args) on the pool, unless this session already started it
+    # within the cache TTL: the response is then in flight or already cached.
+    key = (load.__name__, generation) + args
+    started = st.session_state.prefetches.get(key)
+    if started is not None and time.monotonic() - started[0] < HISTORY_CACHE_TTL_SECONDS:
+        return
+    st.session_state.prefetches[key] = (time.monotonic(), get_prefetch_pool().submit(load, *args))
+
+def take_prefetched(generation, load, *args):
+    # This session's prefetch of the same call if it is recent and not taken
+    # yet, for the _prefetched argument of a cached fetch function.
+    key = (load.__name__, generation) + args
+    started = st.session_state.prefetches.get(key)
+    if started is None or started[1] is None or time.monotonic() - started[0] >= HISTORY_CACHE_TTL_SECONDS:
+        return None
+    st.session_state.prefetches[key] = (started[0], None)
+    return started[1]
+
+def forget_old_prefetches():
+    now = time.monotonic()
+    for key, started in list(st.session_state.prefetches.items()):
+        if now - started[0] >= HISTORY_CACHE_TTL_SECONDS:
+            del st.session_state.prefetches[key]
+
+def history_generation():
+    return st.session_state.cache_session, st.session_state.history_generation
+
+def record_generation(record_id):
+    return st.session_state.cache_session, st.session_state.record_generations.get(record_id, 0)
+
+def invalidate_history():
+    # Refetch the history listing on the next rerun
+    st.session_state.history_generation += 1
+
+def invalidate_record(record_id):
+    # Refetch the details of this record on the next rerun
+    st.session_state.record_generations[record_id] = st.session_state.record_generations.get(record_id, 0) + 1
 
 def hash_password(password):
     # Hash the password using MD5 and return the hexadecimal digest.
@@ -47,6 +143,16 @@ def main():
         st.session_state.page = "login"
     if "refresh" not in st.session_state:
         st.session_state.refresh = False
+    # Generation tokens of the cached history listing and record details.
+    if "history_generation" not in st.session_state:
+        st.session_state.history_generation = 0
+    if "record_generations" not in st.session_state:
+        st.session_state.record_generations = {}
+    if "cache_session" not in st.session_state:
+        st.session_state.cache_session = uuid.uuid4().hex
+    # Background fetches started by this session: call -> (start time, future).
+    if "prefetches" not in st.session_state:
+        st.session_state.prefetches = {}
 # Check if the user is logged in.
 # If logged in, run the main application.
 # Otherwise, check if the current page is the login page.
@@ -100,15 +206,9 @@ def login_page():
             st.error("Please enter both username and password.")
         else:
             hashed_password = hash_password(password)
-            response = requests.post(
-                # Construct the URL for the login endpoint using the BACKEND_URL.
-                # Send a JSON payload containing the username and hashed password.
-                # The payload is sent to the backend for authentication.
-                # This sends the login request to the specified backend URL.
-
-                f"{BACKEND_URL}/login",
-                json={"username": username, "password_md5": hashed_password}
-            )
+            # Send the username and hashed password to the backend's login endpoint.
+            # The request reuses a pooled connection to the backend.
+            response = backend.login(username, hashed_password)
 
             # Check if the login request was successful (status code 200).
             # Parse the JSON response from the server.
@@ -196,10 +296,7 @@ def register_page():
             # This request attempts to create a new user account on the backend.
             # The backend will handle user creation and data persistence.
 
-            response = requests.post(
-                f"{BACKEND_URL}/createuser",
-                json={"username": username, "password_md5": hashed_password, "role": role.lower()}
-            )
+            response = backend.create_user(username, hashed_password, role.lower())
 # Check if the registration request was successful (status code 200).
 # If successful, display a success message and redirect to the login page.
 # Update the session state to reflect the page change.
@@ -270,26 +367,24 @@ def main_app():
 
         if st.button("Analyze"):
             if uploaded_file and patient_name:
-                files = {"file": (uploaded_file.name, uploaded_file.read())}
-                data = {
-                    # Include the username from the session state in the request data.
-                    # Include the hashed password from the session state.
-                    # Include the patient's name in the request data.
-                    # This section constructs the data payload for the backend request.
-
-                    "username": st.session_state.username,
-                    "password_md5": st.session_state.password_md5,
-                    "patient_name": patient_name
-                }
-                # Send a POST request to the backend's upload endpoint.
-                # Include both the file and the data payload in the request.
+                # Pass the file object itself rather than a copy of its bytes.
+                uploaded_file.seek(0)
+                # Send the file, the credentials and the patient's name to the backend's upload endpoint.
                 # Check if the upload was successful (status code 200).
                 # Parse the JSON response containing the analysis result.
 
-                response = requests.post(f"{BACKEND_URL}/upload", files=files, data=data)
+                response = backend.upload(
+                    st.session_state.username,
+                    st.session_state.password_md5,
+                    patient_name,
+                    uploaded_file.name,
+                    uploaded_file
+                )
 
                 if response.status_code == 200:
                     result = response.json()
+                    # The new analysis must show up in the history.
+                    invalidate_history()
 # Retrieve the inference message from the INFERENCE_MESSAGES dictionary.
 # Use the inference result from the response as the key.
 # Provide a default message if the inference result is not found in the dictionary.
@@ -307,6 +402,13 @@ def main_app():
                     )
                     st.success("Analysis complete!")
                     st.write("Inference Result:", inference_message)
+                elif response.status_code == 503:
+                    # The backend is saturated with analyses and asks to retry later.
+                    retry_after = response.headers.get("Retry-After", "a few")
+                    st.warning(f"The server is busy analyzing other recordings. Please try again in {retry_after} seconds.")
+                elif response.status_code in (400, 413):
+                    # The backend refused the file itself: too large, or not a WAV/FLAC recording.
+                    st.error(response.json().get("error", "The file was rejected."))
                 else:
                     # Display an error message if the file processing failed.
                     # Handle cases where neither file nor patient name was provided.
@@ -351,70 +453,114 @@ def main_app():
 
             search_query = ""
 
-        response = requests.get(
-            f"{BACKEND_URL}/accesshistory",
-            # Include authentication details in the request parameters.
-            # Send the username and hashed password for authentication.
-            # This ensures only authorized users can access the history.
-            # Check if the request to access history was successful.
-
-            params={"username": st.session_state.username, "password_md5": st.session_state.password_md5}
+        # Include authentication details in the request parameters.
+        # Send the username and hashed password for authentication.
+        # This ensures only authorized users can access the history.
+        # Check if the request to access history was successful.
+
+        # Sorting, searching and paging are done by the backend.
+        # Only one page of summary rows is fetched; details, audio and image are
+        # loaded for the one record the user selects.
+        page_size = st.selectbox("Records per page", HISTORY_PAGE_SIZES, key="history_page_size")
+        sort = "patient_name" if sort_option == "Patient Name" else "date"
+        search = search_query if st.session_state.role == "Doctor" else ""
+
+        # Go back to the first page whenever the listing itself changes.
+        listing = (page_size, sort, search)
+        if st.session_state.get("history_listing") != listing:
+            st.session_state.history_listing = listing
+            st.session_state.history_page = 0
+
+        offset = st.session_state.history_page * page_size
+        status_code, history, total = fetch_history(
+            st.session_state.username, st.session_state.password_md5, history_generation(),
+            page_size, offset, sort, search,
+            _prefetched=take_prefetched(history_generation(), load_history, st.session_state.username,
+                                        st.session_state.password_md5, page_size, offset, sort, search)
         )
 
-        if response.status_code == 200:
-            # Parse the JSON response containing the history data.
-            # If the user is a doctor and a search query is provided, filter the results.
-            # Filter the history to include only records matching the search query.
-            # This section filters and prepares the history data for display.
-
-            history = response.json()
-
-            if st.session_state.role == "Doctor" and search_query:
-                history = [record for record in history if search_query.lower() in record['patient_name'].lower()]
-# Check if the selected sort option is "Date".
-# If so, sort the history by the 'epoch' field in descending order.
-# Handle the case where the sort option is "Patient Name".
-# This section sorts the history data according to the user's selection.
-
-
-            if sort_option == "Date":
-                history.sort(key=lambda x: x['epoch'], reverse=True)
-            elif sort_option == "Patient Name":
-                # Sort the history by patient name in ascending order.
-                # Iterate through each record in the sorted history.
-                # Convert the epoch timestamp to a human-readable date and time format.
-                # This section formats the data for display to the user.
-
-                history.sort(key=lambda x: x['patient_name'])
-
+        if status_code == 200:
+            page_count = max(1, -(-total // page_size))
+            if st.session_state.history_page >= page_count:
+                # The last page emptied, e.g. after a delete.
+                st.session_state.history_page = page_count - 1
+                st.rerun()
+
+            col_previous, col_page, col_next = st.columns([1, 2, 1])
+            with col_previous:
+                if st.button("Previous", disabled=st.session_state.history_page == 0):
+                    st.session_state.history_page -= 1
+                    st.rerun()
+            with col_page:
+                st.write(f"Page {st.session_state.history_page + 1} of {page_count} ({total} records)")
+            with col_next:
+                if st.button("Next", disabled=st.session_state.history_page >= page_count - 1):
+                    st.session_state.history_page += 1
+                    st.rerun()
+
+            # Fetch the details of every record on this page concurrently, and the
+            # next page of the listing, without waiting for them here. Records
+            # fetched by an earlier rerun are skipped.
+            forget_old_prefetches()
             for record in history:
+                prefetch(
+                    record_generation(record['id']), load_record_details, record['id'],
+                    st.session_state.username, st.session_state.password_md5
+                )
+            if st.session_state.history_page < page_count - 1:
+                prefetch(
+                    history_generation(), load_history, st.session_state.username, st.session_state.password_md5,
+                    page_size, (st.session_state.history_page + 1) * page_size, sort, search
+                )
+
+            # Convert the epoch timestamps to a human-readable date and time format.
+            # List the page as lightweight summary rows to choose from.
+            records_by_id = {record['id']: record for record in history}
+
+            def record_label(record_id):
+                record = records_by_id[record_id]
                 display_date = datetime.datetime.fromtimestamp(record['epoch']).strftime('%Y-%m-%d %H:%M:%S')
-                # Create an expander for each record in the history.
-                # The expander title will display the patient name and date.
+                return f"{record['patient_name']} - {display_date}"
+
+            # Forget the selection of a record that was deleted by the previous run
+            deleted_id = st.session_state.pop("history_deleted_record", None)
+            if deleted_id is not None and st.session_state.get("history_selected_record") == deleted_id:
+                st.session_state.history_selected_record = None
+
+            record = None
+            if history:
+                selected_id = st.radio(
+                    "Select a record to open",
+                    list(records_by_id),
+                    format_func=record_label,
+                    index=None,
+                    key="history_selected_record"
+                )
+                record = records_by_id.get(selected_id)
+            else:
+                st.info("No records found.")
+
+            if record is not None:
                 # Make a GET request to the backend to retrieve detailed information.
-                # This request retrieves details for a specific record ID.
-
-                with st.expander(f"{record['patient_name']} - {display_date}"):
-
-                    details_response = requests.get(
-                        f"{BACKEND_URL}/history/{record['id']}",
-                        # Include authentication parameters in the details request.
-                        # Send the username and hashed password for authorization.
-                        # This ensures only authorized users can access detailed history.
-                        # This section adds security to the request for detailed information.
-
-                        params={
-                            "username": st.session_state.username,
-                            "password_md5": st.session_state.password_md5
-                        }
-                    # Close the request to get detailed information.
+                # This request retrieves details for the selected record only.
+
+                with st.container(border=True):
+
+                    # Include authentication parameters in the details request.
                     # Check if the request for details was successful.
                     # Parse the JSON response containing the detailed data.
                     # This section handles the response from the detailed information request.
 
-                    )
-                    if details_response.status_code == 200:
-                        details_data = details_response.json()
+                    # The page above is already shown; only this record's own fetch is awaited.
+                    with st.spinner("Loading record..."):
+                        details_status, details_data = fetch_record_details(
+                            record['id'], st.session_state.username, st.session_state.password_md5,
+                            record_generation(record['id']),
+                            _prefetched=take_prefetched(record_generation(record['id']), load_record_details,
+                                                        record['id'], st.session_state.username,
+                                                        st.session_state.password_md5)
+                        )
+                    if details_status == 200:
 
                         # Retrieve the inference message from the INFERENCE_MESSAGES dictionary.
                         # Use the inference result from the detailed data as the key.
@@ -427,19 +573,19 @@ def main_app():
                         )
                         # Display the patient's name from the detailed data.
                         # Display the inference message for the specific record.
-                        # Construct the URL to access the audio file for this record.
-                        # This URL includes authentication parameters for secure access.
+                        # The details include signed, expiring URLs of the audio file for this record.
+                        # They carry no credentials and can be cached by the browser.
 
                         st.write("Patient Name:", details_data["patient_name"])
                         st.write("Inference:", inference_message)
 
-                        audio_url = f"{BACKEND_URL}/get_audio/{record['id']}?username={st.session_state.username}&password_md5={st.session_state.password_md5}"
-                        # Construct the URL to access the image file for this record, including authentication.
+                        audio_url = backend.media_url(details_data["audio_url"])
+                        # The signed URL of the image file for this record.
                         # Display the audio file using st.audio.
                         # Display the image file using st.image.
                         # This section displays the audio and image associated with the record.
 
-                        image_url = f"{BACKEND_URL}/get_image/{record['id']}?username={st.session_state.username}&password_md5={st.session_state.password_md5}"
+                        image_url = backend.media_url(details_data["image_url"])
 
                         st.audio(audio_url)
                         st.image(image_url)
@@ -467,25 +613,19 @@ def main_app():
 # This section sends the updated notes to the backend for persistence.
 
 
-                                update_response = requests.post(
-                                    f"{BACKEND_URL}/update_notes/{record['id']}",
-                                    json={
-                                        # Include authentication details in the update request.
-                                        # Send the username and hashed password for security.
-                                        # Include the updated doctor's notes in the payload.
-                                        # This ensures only authorized users can modify notes and maintains data integrity.
-
-                                        "username": st.session_state.username,
-                                        "password_md5": st.session_state.password_md5,
-                                        "doctor_notes": doctor_notes
-                                    }
-                                # Close the JSON payload and send the update request.
+                                # Include authentication details and the updated notes in the request.
                                 # Check if the update request was successful.
                                 # Display a success message if the notes were saved.
                                 # Handle cases where the notes update failed.
 
+                                update_response = backend.update_notes(
+                                    record['id'],
+                                    st.session_state.username,
+                                    st.session_state.password_md5,
+                                    doctor_notes
                                 )
                                 if update_response.status_code == 200:
+                                    invalidate_record(record['id'])
                                     st.success("Notes saved successfully.")
                                 else:
                                     # Extract a specific error message from the response, or use a default.
@@ -520,17 +660,11 @@ def main_app():
                             # Include authentication details (username and password) in the request.
                             # This ensures only authorized users can perform deletion actions.
 
-                            delete_response = requests.post(
-                                f"{BACKEND_URL}/delete_record/{record['id']}",
-                                json={
-                                    "username": st.session_state.username,
-                                    # Include the hashed password for authentication in the JSON payload.
-                                    # Close the JSON payload and send the delete request.
-                                    # Check if the deletion was successful (status code 200).
-                                    # This section completes the request and checks for successful deletion.
-
-                                    "password_md5": st.session_state.password_md5
-                                }
+                            # Check if the deletion was successful (status code 200).
+                            # This section completes the request and checks for successful deletion.
+
+                            delete_response = backend.delete_record(
+                                record['id'], st.session_state.username, st.session_state.password_md5
                             )
                             if delete_response.status_code == 200:
                                 # Display a success message to the user.
@@ -539,6 +673,9 @@ def main_app():
                                 # Handle cases where record deletion failed.
 
                                 st.success("Record deleted successfully.")
+                                invalidate_record(record['id'])
+                                invalidate_history()
+                                st.session_state.history_deleted_record = record['id']
 
                                 st.session_state.refresh = not st.session_state.refresh
                             else:
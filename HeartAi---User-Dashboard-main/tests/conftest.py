@@ -0,0 +1,77 @@
+import os
+import sys
+import atexit
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+
+import pytest
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, APP_DIR)
+
+# app.py reads its settings when it is imported, so they are set here, before
+# any test imports it: a throwaway data folder instead of data/, no model, no
+# maintenance thread, and a small upload limit
+TEST_DATA_FOLDER = tempfile.mkdtemp(prefix='heartai-tests-')
+atexit.register(shutil.rmtree, TEST_DATA_FOLDER, True)
+os.environ['HEARTAI_DATA_FOLDER'] = TEST_DATA_FOLDER
+os.environ['HEARTAI_PRELOAD_MODEL'] = '0'
+os.environ['HEARTAI_START_MAINTENANCE'] = '0'
+os.environ['HEARTAI_MAX_UPLOAD_BYTES'] = '4096'
+
+
+def md5(text):
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+@pytest.fixture(scope='session')
+def backend():
+    import app
+    app.app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def client(backend):
+    return backend.app.test_client()
+
+
+@pytest.fixture
+def make_user(client):
+    """
+    Create a user through /createuser and return (username, password_md5).
+    """
+    created = []
+
+    def make(role='doctor'):
+        username = f"user{len(created)}-{os.urandom(4).hex()}"
+        password_md5 = md5('secret')
+        response = client.post('/createuser', json={'username': username, 'password_md5': password_md5, 'role': role})
+        assert response.status_code == 200
+        created.append(username)
+        return username, password_md5
+
+    return make
+
+
+@pytest.fixture
+def add_record(backend):
+    """
+    Insert an analysis_history row directly and bump the history version, as a
+    finished upload does, without running the model.
+    """
+    import response_cache
+
+    def add(username, patient_name='Patient', file_path='objects/00/00/0000.wav'):
+        with sqlite3.connect(backend.MASTER_DB) as con:
+            cur = con.cursor()
+            cur.execute(
+                "INSERT INTO analysis_history (username, epoch, file_path, inference, patient_name, modified_epoch) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (username, 1700000000, file_path, 'Absent', patient_name, 1700000000))
+            record_id = cur.lastrowid
+            response_cache.bump_version(cur, username)
+            return record_id
+
+    return add
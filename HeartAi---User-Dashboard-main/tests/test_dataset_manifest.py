@@ -0,0 +1,79 @@
+import wave
+from collections import defaultdict
+
+import pytest
+
+import dataset_manifest
+
+VALVES = ['AV', 'MV', 'PV', 'TV']
+
+
+def write_recording(path, seconds=0.1, sample_rate=4000):
+    with wave.open(str(path), 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(b'\x00\x00' * int(seconds * sample_rate))
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    """
+    A manifest over 12 patients, every fourth one Present, each with a
+    recording and a rendered image per valve.
+    """
+    for patient in range(12):
+        class_name = 'Present' if patient % 4 == 0 else 'Absent'
+        (tmp_path / 'dataset' / class_name).mkdir(parents=True, exist_ok=True)
+        for valve in VALVES:
+            name = f"{10000 + patient}_{valve}.wav"
+            write_recording(tmp_path / 'dataset' / name)
+            (tmp_path / 'dataset' / class_name / f"Grayscale_{name}.png").write_bytes(b'png')
+    manifest_path = str(tmp_path / 'dataset_manifest.db')
+    dataset_manifest.build(manifest_path, workers=2)
+    return manifest_path
+
+
+def folds_by_patient(manifest_path, name):
+    folds = defaultdict(set)
+    for entry in dataset_manifest.query(manifest_path, split=name):
+        folds[entry['patient_id']].add(entry['fold'])
+    return folds
+
+
+def test_manifest_indexes_recordings_with_their_labels(manifest):
+    recordings = dataset_manifest.query(manifest, kind='audio')
+    assert len(recordings) == 12 * len(VALVES)
+    assert {entry['folder'] for entry in recordings} == {'dataset'}
+    present = {entry['patient_id'] for entry in recordings if entry['label'] == 1}
+    assert present == {'10000', '10004', '10008'}
+    assert all(entry['duration'] == pytest.approx(0.1) for entry in recordings)
+
+
+def test_split_keeps_every_patient_in_one_fold(manifest):
+    assigned = dataset_manifest.split(manifest, 'default', folds=3, seed=0)
+    assert assigned == 12 * len(VALVES) * 2
+
+    folds = folds_by_patient(manifest, 'default')
+    assert len(folds) == 12
+    assert all(len(patient_folds) == 1 for patient_folds in folds.values())
+    assert {fold for patient_folds in folds.values() for fold in patient_folds} == {0, 1, 2}
+
+
+def test_split_is_stratified_and_deterministic(manifest):
+    dataset_manifest.split(manifest, 'first', folds=3, seed=7)
+    dataset_manifest.split(manifest, 'second', folds=3, seed=7)
+    assert folds_by_patient(manifest, 'first') == folds_by_patient(manifest, 'second')
+
+    # The three Present patients are spread over the three folds
+    present_folds = [fold for patient, patient_folds in folds_by_patient(manifest, 'first').items()
+                     for fold in patient_folds if patient in ('10000', '10004', '10008')]
+    assert sorted(present_folds) == [0, 1, 2]
+
+
+def test_split_folds_select_disjoint_patients(manifest):
+    dataset_manifest.split(manifest, 'default', folds=3, seed=0)
+    held_out = dataset_manifest.query(manifest, kind='audio', split='default', split_folds=[0])
+    training = dataset_manifest.query(manifest, kind='audio', split='default', split_folds=[1, 2])
+    assert held_out and training
+    assert not {entry['patient_id'] for entry in held_out} & {entry['patient_id'] for entry in training}
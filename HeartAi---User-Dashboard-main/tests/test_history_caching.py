@@ -0,0 +1,75 @@
+import sqlite3
+
+import response_cache
+
+
+def history(client, username, password_md5, etag=None, **params):
+    headers = {'If-None-Match': etag} if etag else {}
+    return client.get('/accesshistory', query_string=dict(params, username=username, password_md5=password_md5),
+                      headers=headers)
+
+
+def version(backend, username):
+    with sqlite3.connect(backend.MASTER_DB) as con:
+        return response_cache.get_version(con.cursor(), username)
+
+
+def test_unchanged_history_revalidates_with_304(client, make_user, add_record):
+    username, password_md5 = make_user()
+    add_record(username, 'Alice')
+
+    first = history(client, username, password_md5)
+    assert first.status_code == 200
+    assert [record['patient_name'] for record in first.get_json()] == ['Alice']
+    etag = first.headers['ETag']
+
+    again = history(client, username, password_md5, etag=etag)
+    assert again.status_code == 304
+    assert again.data == b''
+    assert again.headers['ETag'] == etag
+
+    # Other parameters are another response with its own ETag
+    assert history(client, username, password_md5, etag=etag, limit=1).status_code == 200
+
+
+def test_notes_update_bumps_the_version_and_the_etag(backend, client, make_user, add_record):
+    username, password_md5 = make_user('doctor')
+    record_id = add_record(username)
+    etag = history(client, username, password_md5).headers['ETag']
+    before = version(backend, username)
+
+    response = client.post(f'/update_notes/{record_id}',
+                           json={'username': username, 'password_md5': password_md5, 'doctor_notes': 'Murmur'})
+    assert response.status_code == 200
+    assert version(backend, username) == before + 1
+
+    changed = history(client, username, password_md5, etag=etag)
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_delete_bumps_the_version_and_the_etag(backend, client, make_user, add_record):
+    username, password_md5 = make_user()
+    kept = add_record(username, 'Kept')
+    deleted = add_record(username, 'Deleted')
+    etag = history(client, username, password_md5).headers['ETag']
+    before = version(backend, username)
+
+    response = client.post(f'/delete_record/{deleted}', json={'username': username, 'password_md5': password_md5})
+    assert response.status_code == 200
+    assert version(backend, username) == before + 1
+
+    changed = history(client, username, password_md5, etag=etag)
+    assert changed.status_code == 200
+    assert [record['id'] for record in changed.get_json()] == [kept]
+
+
+def test_refused_change_keeps_the_version(backend, client, make_user, add_record):
+    owner, _ = make_user()
+    record_id = add_record(owner)
+    other, other_password_md5 = make_user()
+    before = version(backend, owner)
+
+    response = client.post(f'/delete_record/{record_id}', json={'username': other, 'password_md5': other_password_md5})
+    assert response.status_code == 403
+    assert version(backend, owner) == before
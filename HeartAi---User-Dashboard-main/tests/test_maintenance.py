@@ -0,0 +1,106 @@
+import os
+import time
+import sqlite3
+
+import pytest
+
+import maintenance
+import storage
+
+OLD = time.time() - 2 * maintenance.DEFAULT_MIN_AGE_SECONDS
+
+
+@pytest.fixture
+def data_folder(tmp_path):
+    with sqlite3.connect(tmp_path / 'master.db') as con:
+        con.execute("CREATE TABLE analysis_history (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT, "
+                    "file_path TEXT NOT NULL)")
+    return tmp_path
+
+
+def store(data_folder, digest, age=OLD, kinds=('audio', 'image', 'inference')):
+    # The files of one stored recording, with their mtime set to age
+    stored_path = storage.stored_path_for_digest(digest)
+    for kind in kinds:
+        full_path = storage.resolve(str(data_folder), stored_path, kind)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as stored_file:
+            stored_file.write(b'x' * 10)
+        os.utime(full_path, (age, age))
+    return stored_path
+
+
+def reference(data_folder, stored_path):
+    with sqlite3.connect(data_folder / 'master.db') as con:
+        con.execute("INSERT INTO analysis_history (username, file_path) VALUES ('user', ?)", (stored_path,))
+
+
+def exists(data_folder, stored_path, kind='audio'):
+    return os.path.exists(storage.resolve(str(data_folder), stored_path, kind))
+
+
+def run(data_folder):
+    # Never quiet, so only the file sweep runs
+    return maintenance.run_once(str(data_folder), str(data_folder / 'master.db'), quiet_seconds=10 ** 9,
+                                batch_size=1, batch_pause_seconds=0)
+
+
+def test_referenced_recordings_are_kept_and_orphans_removed(data_folder):
+    kept = store(data_folder, 'aa' * 32)
+    reference(data_folder, kept)
+    orphan = store(data_folder, 'bb' * 32)
+
+    report = run(data_folder)
+
+    assert report['files_removed'] == 3
+    for kind in storage.KIND_EXTENSIONS:
+        assert exists(data_folder, kept, kind)
+        assert not exists(data_folder, orphan, kind)
+
+
+def test_recent_files_are_kept(data_folder):
+    recent = store(data_folder, 'cc' * 32, age=time.time())
+    assert run(data_folder)['files_removed'] == 0
+    assert exists(data_folder, recent)
+
+
+def test_legacy_absolute_paths_count_as_references(data_folder):
+    # Rows from before the object store hold absolute Windows paths of data/<uuid>/<epoch>.wav
+    os.makedirs(data_folder / 'f00d', exist_ok=True)
+    legacy_file = data_folder / 'f00d' / '1700000000.wav'
+    legacy_file.write_bytes(b'x')
+    os.utime(legacy_file, (OLD, OLD))
+    reference(data_folder, 'G:\\HeartAi\\data\\f00d\\1700000000.wav')
+
+    assert run(data_folder)['files_removed'] == 0
+    assert legacy_file.exists()
+
+
+def test_file_referenced_after_the_scan_is_kept(data_folder):
+    # A duplicate upload can reference a stored recording between the scan
+    # for orphans and the sweep; the sweep checks the database again
+    stored_path = store(data_folder, 'ee' * 32)
+    master_db = str(data_folder / 'master.db')
+    orphan_files, empty_folders = maintenance.find_orphans(str(data_folder), master_db)
+    assert len(orphan_files) == 3
+
+    reference(data_folder, stored_path)
+    files_removed, _, _ = maintenance.sweep(orphan_files, empty_folders, batch_pause_seconds=0,
+                                            data_folder=str(data_folder), master_db=master_db)
+
+    assert files_removed == 0
+    for kind in storage.KIND_EXTENSIONS:
+        assert exists(data_folder, stored_path, kind)
+
+
+def test_file_refreshed_after_the_scan_is_kept(data_folder):
+    stored_path = store(data_folder, 'ff' * 32)
+    master_db = str(data_folder / 'master.db')
+    orphan_files, empty_folders = maintenance.find_orphans(str(data_folder), master_db)
+
+    # A duplicate upload touches the stored recording before inserting its row
+    os.utime(storage.resolve(str(data_folder), stored_path), None)
+    maintenance.sweep(orphan_files, empty_folders, batch_pause_seconds=0,
+                      data_folder=str(data_folder), master_db=master_db)
+
+    assert exists(data_folder, stored_path)
@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+import media_urls
+import storage
+
+SECRET = b'test-secret'
+STORED_PATH = 'objects/ab/cd/abcd0123.wav'
+
+
+def test_signature_round_trip():
+    expires = media_urls.expiry(3600, 300, now=1700000000)
+    url = media_urls.signed_url(SECRET, STORED_PATH, 'image', expires)
+    media_path, query = url[len('/media/'):].split('?')
+    signature = query.split('signature=')[1]
+    assert media_path == 'objects/ab/cd/abcd0123.png'
+    assert media_urls.verify(SECRET, media_path, expires, signature, now=1700000000)
+
+
+def test_expiry_is_rounded_up_to_the_bucket():
+    expires = media_urls.expiry(3600, 300, now=1700000001)
+    assert expires % 300 == 0
+    assert expires >= 1700000001 + 3600
+    assert media_urls.expiry(3600, 300, now=1700000002) == expires
+
+
+def test_expired_url_is_rejected():
+    expires = 1700000000
+    signature = media_urls._signature(SECRET, 'objects/ab/cd/abcd0123.png', expires)
+    assert media_urls.verify(SECRET, 'objects/ab/cd/abcd0123.png', expires, signature, now=expires)
+    assert not media_urls.verify(SECRET, 'objects/ab/cd/abcd0123.png', expires, signature, now=expires + 1)
+
+
+@pytest.mark.parametrize('change', ['path', 'expires', 'signature', 'secret'])
+def test_tampered_url_is_rejected(change):
+    media_path = 'objects/ab/cd/abcd0123.png'
+    expires = 1700003600
+    signature = media_urls._signature(SECRET, media_path, expires)
+    secret = SECRET
+    if change == 'path':
+        media_path = 'objects/ab/cd/abcd0124.png'
+    elif change == 'expires':
+        expires += 3600
+    elif change == 'signature':
+        signature = signature[:-1] + ('0' if signature[-1] != '0' else '1')
+    else:
+        secret = b'another-secret'
+    assert not media_urls.verify(secret, media_path, expires, signature, now=1700000000)
+
+
+@pytest.fixture
+def stored_image(backend, tmp_path):
+    source = tmp_path / 'spectrogram.png'
+    source.write_bytes(b'\x89PNG\r\n\x1a\n' + b'\x00' * 64)
+    stored_path, _, _ = storage.save_file(backend.DATA_FOLDER, str(source), 'image')
+    return stored_path
+
+
+def test_media_endpoint_serves_a_valid_url(backend, client, stored_image):
+    expires = media_urls.expiry(backend.MEDIA_URL_TTL, backend.MEDIA_URL_BUCKET)
+    response = client.get(media_urls.signed_url(backend.MEDIA_SECRET, stored_image, 'image', expires))
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert 'immutable' in response.headers['Cache-Control']
+
+
+def test_media_endpoint_refuses_expired_and_tampered_urls(backend, client, stored_image):
+    expired = int(time.time()) - 1
+    response = client.get(media_urls.signed_url(backend.MEDIA_SECRET, stored_image, 'image', expired))
+    assert response.status_code == 403
+
+    expires = media_urls.expiry(backend.MEDIA_URL_TTL, backend.MEDIA_URL_BUCKET)
+    url = media_urls.signed_url(backend.MEDIA_SECRET, stored_image, 'image', expires)
+    assert client.get(url.replace(f"expires={expires}", f"expires={expires + 300}")).status_code == 403
+    assert client.get(url[:-1] + ('0' if url[-1] != '0' else '1')).status_code == 403
+    assert client.get(url.split('&signature=')[0]).status_code == 403
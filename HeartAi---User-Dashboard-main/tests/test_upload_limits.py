@@ -0,0 +1,38 @@
+import io
+import os
+
+import storage
+
+WAV_HEADER = b'RIFF\x00\x00\x00\x00WAVE'
+
+
+def temporary_files(backend):
+    tmp_dir = os.path.join(backend.DATA_FOLDER, storage.TMP_DIR)
+    return os.listdir(tmp_dir) if os.path.isdir(tmp_dir) else []
+
+
+def test_upload_over_the_limit_is_refused_with_413(backend, client, make_user):
+    username, password_md5 = make_user()
+    body = WAV_HEADER + b'\x00' * (backend.MAX_UPLOAD_BYTES + 1)
+    response = client.post('/upload', data={
+        'username': username, 'password_md5': password_md5, 'patient_name': 'Big',
+        'file': (io.BytesIO(body), 'big.wav'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 413
+    assert temporary_files(backend) == []
+
+
+def test_request_announcing_a_larger_body_is_refused_with_413(backend, client):
+    response = client.post('/upload', data=b'x' * (backend.app.config['MAX_CONTENT_LENGTH'] + 1),
+                           content_type='multipart/form-data; boundary=x')
+    assert response.status_code == 413
+
+
+def test_upload_that_is_not_audio_is_refused_with_400(backend, client, make_user):
+    username, password_md5 = make_user()
+    response = client.post('/upload', data={
+        'username': username, 'password_md5': password_md5, 'patient_name': 'Text',
+        'file': (io.BytesIO(b'definitely not a recording'), 'notes.wav'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert temporary_files(backend) == []
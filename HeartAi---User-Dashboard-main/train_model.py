@@ -1,82 +1,396 @@
 import os
+import sys
+import time
+import hashlib
+import argparse
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Dropout
-import numpy as np
-from tensorflow.keras.preprocessing.image import load_img, img_to_array  # For loading images
+
+import feature_store
+import augmentation
+import dataset_manifest
 
 # Define paths
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATASET_DIR = os.path.join(BASE_DIR, 'dataset')  # dataset folder with 'Absent' and 'Present' subfolders
 MODEL_DIR = os.path.join(BASE_DIR, 'models')
-os.makedirs(MODEL_DIR, exist_ok=True)  # Create 'models' directory if it doesn't exist
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')  # decoded images cached between epochs and runs
+
+# Default number of training epochs
+DEFAULT_EPOCHS = 20  # Adjust as needed
+
+IMAGE_SIZE = (128, 128)
+CLASS_NAMES = dataset_manifest.CLASS_NAMES  # 'Absent' is label 0, 'Present' is label 1
+
+# Training images are streamed through a tf.data pipeline instead of being
+# loaded into one NumPy array: PNGs are decoded and normalized to float32 in
+# parallel, written once to a cache file, shuffled in a bounded buffer and
+# prefetched while the model trains. Memory use no longer grows with the dataset.
 
-# Set the number of training epochs
-epochs = 20  # Adjust as needed
 
-# Function to load image files as data
-def load_image_files(directory, target_size=(128, 128)):
-    data = []
+# Function to list the image files and their labels
+def list_image_files(directory):
+    paths = []
     labels = []
-    for label, sub_dir in enumerate(['Absent', 'Present']):  # 'Absent' is label 0, 'Present' is label 1
+    for label, sub_dir in enumerate(CLASS_NAMES):
         sub_dir_path = os.path.join(directory, sub_dir)
-        print(f"Checking directory: {sub_dir_path}")  # Debug: Print directory path
         if not os.path.exists(sub_dir_path):
             print(f"Error: Directory {sub_dir_path} does not exist.")
             continue
-        for file_name in os.listdir(sub_dir_path):
-            print(f"Found file: {file_name}")  # Debug: Print each file name
-            if file_name.endswith('.png'):  # Check for .png files
-                file_path = os.path.join(sub_dir_path, file_name)
-                print(f"Loading file: {file_path}")  # Debug: Print each file path
-                try:
-                    # Load image and convert to array
-                    img = load_img(file_path, target_size=target_size, color_mode="grayscale")
-                    img_array = img_to_array(img)
-                    data.append(img_array)  # Append image array
-                    labels.append(label)  # Append corresponding label (0 for Absent, 1 for Present)
-                except Exception as e:
-                    print(f"Error loading file {file_path}: {e}")
-    
-    # Convert lists to numpy arrays
-    data = np.array(data)
-    labels = np.array(labels)
-    
-    print(f"Final data shape: {data.shape}, Labels shape: {labels.shape}")  # Debug: print the shape of data to verify
-    
-    return data, labels
-
-# Load dataset
-X_train, y_train = load_image_files(DATASET_DIR)
-
-# Check if data was loaded correctly
-if X_train.shape[0] == 0:
-    print("Error: No data was loaded. Please check the dataset directory and file format.")
-    exit()
-
-# Normalize data
-X_train = X_train / 255.0  # Scale pixel values to [0, 1]
+        class_paths = sorted(entry.path for entry in os.scandir(sub_dir_path)
+                             if entry.is_file() and entry.name.endswith('.png'))
+        print(f"Found {len(class_paths)} images in {sub_dir_path}")
+        paths.extend(class_paths)
+        labels.extend([label] * len(class_paths))
+    return paths, labels
+
+
+def cache_file_for(paths, target_size):
+    """
+    Path of the cache file for this set of images. The name depends on the file
+    names, sizes and modification times and on the image size, so a changed
+    dataset gets a new cache instead of silently reusing stale images.
+    """
+    digest = hashlib.sha256(repr(target_size).encode())
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return os.path.join(CACHE_DIR, f"images-{digest.hexdigest()[:16]}")
+
+
+def decode_image(path, label, target_size=IMAGE_SIZE):
+    # Same preprocessing as keras load_img(color_mode="grayscale", target_size=...)
+    # followed by / 255, but in float32 and inside the TensorFlow runtime
+    image = tf.io.decode_png(tf.io.read_file(path), channels=1)
+    image = tf.image.resize(image, target_size, method='nearest')
+    image = tf.cast(image, tf.float32) / 255.0
+    return image, tf.cast(label, tf.float32)
+
+
+def make_dataset(paths, labels, batch_size=32, target_size=IMAGE_SIZE, shuffle_buffer=1024,
+                 cache_path=None, seed=None, augment=None):
+    """
+    Streaming input pipeline: parallel decoding, optional cache file, shuffling
+    and prefetching. With cache_path None the images are decoded every epoch.
+    augment is an augmentation policy (see augmentation.py) applied per batch.
+    """
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+    # Shuffle the file list once, so the bounded shuffle buffer below mixes both classes
+    dataset = dataset.shuffle(len(paths), seed=seed, reshuffle_each_iteration=False)
+    dataset = dataset.map(lambda path, label: decode_image(path, label, target_size),
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    if cache_path:
+        dataset = dataset.cache(cache_path)
+    dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    if augment:
+        dataset = augmentation.augment_dataset(dataset, augment, seed)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_feature_dataset(store, positions, batch_size=32, target_size=IMAGE_SIZE, shuffle_buffer=1024, seed=None,
+                         shuffle=True, augment=None):
+    """
+    Input pipeline over recordings in a feature store (see feature_store.py). Each
+    mel dB array is read as a slice of the memory-mapped file, scaled from
+    [-top_db, 0] dB to [0, 1] and resized to the model input size.
+    """
+    labels = store.labels
+    top_db = store.config['top_db']
+
+    def read(position):
+        # A contiguous slice of the memory-mapped file, in the layout used here
+        return store.features(int(position)), np.float32(labels[int(position)])
+
+    def load(position):
+        features, label = tf.numpy_function(read, [position], (tf.float32, tf.float32))
+        features = tf.reshape(features, (store.n_mels, -1, 1))
+        image = tf.image.resize(tf.clip_by_value((features + top_db) / top_db, 0.0, 1.0), target_size)
+        return image, tf.reshape(label, ())
+
+    dataset = tf.data.Dataset.from_tensor_slices(np.asarray(positions, dtype=np.int64))
+    if shuffle:
+        # Only positions are shuffled; the arrays stay in the memory-mapped file
+        dataset = dataset.shuffle(max(1, min(shuffle_buffer, len(positions))), seed=seed,
+                                  reshuffle_each_iteration=True)
+    dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.batch(batch_size)
+    if augment:
+        dataset = augmentation.augment_dataset(dataset, dict(augment, top_db=top_db), seed)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
 
 # Define the model architecture
-model = Sequential([
-    Conv2D(32, (3, 3), activation='relu', input_shape=(128, 128, 1)),  # First convolutional layer
-    MaxPooling2D((2, 2)),  # Max pooling layer
-    Conv2D(64, (3, 3), activation='relu'),  # Second convolutional layer
-    MaxPooling2D((2, 2)),  # Max pooling layer
-    Flatten(),  # Flatten layer to convert 2D data to 1D
-    Dense(64, activation='relu'),  # Fully connected layer
-    Dropout(0.5),  # Dropout layer for regularization
-    Dense(1, activation='sigmoid')  # Output layer for binary classification
-])
-
-# Compile the model
-model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
-
-# Train the model
-history = model.fit(X_train, y_train, epochs=epochs, batch_size=32)
-
-# Save the trained model
-model.save(os.path.join(MODEL_DIR, 'heart_model.h5'))
-
-# Print final training accuracy for debugging
-print(f"Final training accuracy: {history.history['accuracy'][-1]}")
+# The defaults are the production architecture; helper_tools/sweep.py varies them
+def build_model(input_shape=IMAGE_SIZE + (1,), filters=(32, 64), dense_units=64, dropout=0.5, learning_rate=0.001):
+    model = Sequential([
+        Conv2D(filters[0], (3, 3), activation='relu', input_shape=input_shape),  # First convolutional layer
+        MaxPooling2D((2, 2)),  # Max pooling layer
+        Conv2D(filters[1], (3, 3), activation='relu'),  # Second convolutional layer
+        MaxPooling2D((2, 2)),  # Max pooling layer
+        Flatten(),  # Flatten layer to convert 2D data to 1D
+        Dense(dense_units, activation='relu'),  # Fully connected layer
+        Dropout(dropout),  # Dropout layer for regularization
+        Dense(1, activation='sigmoid', dtype='float32')  # Output layer for binary classification, kept in float32
+    ])
+    # Compile the model
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate), loss='binary_crossentropy',
+                  metrics=['accuracy'])
+    return model
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    # TensorFlow's thread pools can only be sized before the runtime starts,
+    # so this has to run before any dataset or model is created
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def cpu_supports_bfloat16():
+    """
+    True if the CPU has native bfloat16 instructions (AVX512-BF16 or AMX).
+    Elsewhere bfloat16 is emulated and slower than float32.
+    """
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            flags = cpuinfo.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+class ThroughputLogger(tf.keras.callbacks.Callback):
+    """
+    Prints the training throughput of every epoch and adds it to the logs
+    (and so to the history) as samples_per_second.
+    """
+
+    def __init__(self, samples_per_epoch):
+        super().__init__()
+        self.samples_per_epoch = samples_per_epoch
+        self.epoch_started = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_started = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = time.perf_counter() - self.epoch_started
+        samples_per_second = self.samples_per_epoch / elapsed
+        if logs is not None:
+            logs['samples_per_second'] = samples_per_second
+        print(f"Epoch {epoch + 1}: {self.samples_per_epoch} samples in {elapsed:.1f} s, "
+              f"{samples_per_second:.1f} samples/s")
+
+
+def split_validation(items, validation_split, seed=None, groups=None):
+    """
+    Split a list into (train, validation) parts, at random but reproducibly for a given seed.
+    With groups (one key per item, see dataset_manifest.group_key), whole groups are
+    held out until the validation part has its share of the items, so the files of
+    one patient never end up on both sides.
+    """
+    if not validation_split:
+        return list(items), []
+    rng = np.random.default_rng(seed)
+    validation_count = max(1, int(round(len(items) * validation_split)))
+    if groups is None:
+        order = rng.permutation(len(items))
+        return [items[i] for i in order[validation_count:]], [items[i] for i in order[:validation_count]]
+    sizes = {}
+    for group in groups:
+        sizes[group] = sizes.get(group, 0) + 1
+    keys = sorted(sizes)
+    held_out = set()
+    held_out_count = 0
+    for i in rng.permutation(len(keys)):
+        if held_out_count >= validation_count:
+            break
+        held_out.add(keys[i])
+        held_out_count += sizes[keys[i]]
+    return ([item for item, group in zip(items, groups) if group not in held_out],
+            [item for item, group in zip(items, groups) if group in held_out])
+
+
+def split_feature_positions(store, positions, validation_split, seed=None,
+                            manifest_path=dataset_manifest.MANIFEST_PATH, split=None, fold=0):
+    """
+    Split feature store positions into (train, validation). With a manifest split
+    the recordings in its fold are held out, otherwise a validation_split share
+    of the patients.
+    """
+    if split:
+        stored = set(store.sources)
+        fold_entries = dataset_manifest.query(manifest_path, kind='audio', split=split, split_folds=[fold])
+        held_out = set(store.positions([entry['path'] for entry in fold_entries if entry['path'] in stored]))
+        return ([position for position in positions if position not in held_out],
+                [position for position in positions if position in held_out])
+    sources = store.sources
+    groups = [dataset_manifest.group_key(sources[position]) for position in positions]
+    return split_validation(positions, validation_split, seed, groups)
+
+
+def train(dataset_dir=None, epochs=DEFAULT_EPOCHS, batch_size=32, shuffle_buffer=1024,
+          use_cache=True, seed=None, output_path=None, features_dir=None, validation_split=0.0,
+          patience=0, checkpoint_dir=None, mixed_precision=False, augment=None,
+          manifest_path=dataset_manifest.MANIFEST_PATH, split=None, fold=0):
+    validation_dataset = None
+    if checkpoint_dir and seed is None:
+        # A resumed run must hold out the same validation data as the interrupted one
+        seed = 0
+    if features_dir:
+        # Train on the precomputed mel features instead of the rendered images
+        store = feature_store.FeatureStore(features_dir)
+        positions = [position for position, label in enumerate(store.labels) if label >= 0]
+        if not positions:
+            print(f"Error: No labelled recordings in the feature store {features_dir}.")
+            return None
+        print(f"Training on {len(positions)} recordings from the feature store {features_dir}")
+        positions, validation_positions = split_feature_positions(store, positions, validation_split, seed,
+                                                                  manifest_path, split, fold)
+        train_count = len(positions)
+        dataset = make_feature_dataset(store, positions, batch_size, IMAGE_SIZE, shuffle_buffer, seed,
+                                       augment=augment)
+        if validation_positions:
+            validation_dataset = make_feature_dataset(store, validation_positions, batch_size, IMAGE_SIZE,
+                                                      shuffle=False)
+    else:
+        if dataset_dir:
+            paths, labels = list_image_files(dataset_dir)
+        else:
+            # The labelled images listed in the dataset manifest
+            entries = dataset_manifest.query(manifest_path, kind='image', labelled=True, split=split)
+            paths = [entry['path'] for entry in entries]
+            labels = [entry['label'] for entry in entries]
+            folds = [entry['fold'] for entry in entries] if split else None
+            print(f"Found {len(paths)} labelled images in the manifest {manifest_path}")
+
+        # Check if data was found
+        if not paths:
+            print("Error: No data was loaded. Please check the dataset directory and file format.")
+            return None
+
+        if split:
+            # Hold out one fold of the manifest split; a patient's images are all on one side
+            train_items = [(path, label) for path, label, item_fold in zip(paths, labels, folds) if item_fold != fold]
+            validation_items = [(path, label) for path, label, item_fold in zip(paths, labels, folds)
+                                if item_fold == fold]
+        else:
+            # Hold out whole patients, so none is on both sides
+            train_items, validation_items = split_validation(list(zip(paths, labels)), validation_split, seed,
+                                                             [dataset_manifest.group_key(path) for path in paths])
+        train_count = len(train_items)
+        cache_path = None
+        if use_cache:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            cache_path = cache_file_for([path for path, _ in train_items], IMAGE_SIZE)
+            print(f"Caching decoded images in {cache_path}")
+        dataset = make_dataset([path for path, _ in train_items], [label for _, label in train_items],
+                               batch_size, IMAGE_SIZE, shuffle_buffer, cache_path, seed, augment)
+        if validation_items:
+            validation_cache = cache_file_for([path for path, _ in validation_items], IMAGE_SIZE) if use_cache else None
+            validation_dataset = make_dataset([path for path, _ in validation_items],
+                                              [label for _, label in validation_items],
+                                              batch_size, IMAGE_SIZE, shuffle_buffer, validation_cache, seed)
+
+    if mixed_precision:
+        if cpu_supports_bfloat16():
+            # Compute in bfloat16, keep the weights in float32
+            tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+            print("Training with mixed_bfloat16 precision")
+        else:
+            print("This CPU has no native bfloat16 support; training in float32")
+            mixed_precision = False
+
+    model = build_model()
+
+    # Callbacks: throughput log, resumable backups, checkpoints and early stopping
+    monitor = 'val_loss' if validation_dataset is not None else 'loss'
+    callbacks = [ThroughputLogger(train_count)]
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        # Saved after every epoch; an interrupted run started again with the same
+        # checkpoint directory resumes from the last completed epoch
+        callbacks.append(tf.keras.callbacks.BackupAndRestore(os.path.join(checkpoint_dir, 'backup')))
+        callbacks.append(tf.keras.callbacks.ModelCheckpoint(
+            os.path.join(checkpoint_dir, 'best.weights.h5'), monitor=monitor, save_best_only=True,
+            save_weights_only=True))
+        callbacks.append(tf.keras.callbacks.CSVLogger(os.path.join(checkpoint_dir, 'training_log.csv'), append=True))
+    if patience:
+        callbacks.append(tf.keras.callbacks.EarlyStopping(monitor=monitor, patience=patience,
+                                                          restore_best_weights=True))
+
+    # Train the model
+    history = model.fit(dataset, validation_data=validation_dataset, epochs=epochs, callbacks=callbacks)
+
+    if mixed_precision:
+        # Save a float32 copy, so inference does not depend on bfloat16 support
+        tf.keras.mixed_precision.set_global_policy('float32')
+        trained_model = model
+        model = build_model()
+        model.set_weights(trained_model.get_weights())
+
+    # Save the trained model
+    output_path = output_path or os.path.join(MODEL_DIR, 'heart_model.h5')
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    model.save(output_path)
+
+    # Print final training accuracy for debugging
+    print(f"Final training accuracy: {history.history['accuracy'][-1]}")
+    if 'val_accuracy' in history.history:
+        print(f"Final validation accuracy: {history.history['val_accuracy'][-1]}")
+    return history
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the heart sound CNN on the spectrogram images.")
+    parser.add_argument('--manifest', default=dataset_manifest.MANIFEST_PATH,
+                        help="Dataset manifest built by helper_tools/build_manifest.py")
+    parser.add_argument('--dataset', default=None,
+                        help="Scan this folder with Absent/ and Present/ subfolders instead of using the manifest")
+    parser.add_argument('--epochs', type=int, default=DEFAULT_EPOCHS)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--shuffle-buffer', type=int, default=1024, help="Images held in the shuffle buffer")
+    parser.add_argument('--no-cache', action='store_true', help="Decode the images again in every epoch")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for a reproducible shuffle order")
+    parser.add_argument('--output', default=os.path.join(MODEL_DIR, 'heart_model.h5'))
+    parser.add_argument('--features', default=None,
+                        help="Train on a feature store built by helper_tools/build_feature_store.py")
+    parser.add_argument('--validation-split', type=float, default=None,
+                        help="Fraction of the patients held out at random for validation "
+                             "(0: train on everything, even if the manifest has a split)")
+    parser.add_argument('--split', default=None,
+                        help="Hold out a fold of this manifest split (helper_tools/separate_dataset.py) for validation "
+                             "(default: the split 'default' if the manifest has one)")
+    parser.add_argument('--fold', type=int, default=0, help="Fold of --split held out")
+    parser.add_argument('--early-stopping', type=int, default=0, metavar='PATIENCE',
+                        help="Stop after this many epochs without improvement of the validation loss")
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help="Save checkpoints here after every epoch and resume from them")
+    parser.add_argument('--intra-op-threads', type=int, default=None, help="Threads used inside one operation")
+    parser.add_argument('--inter-op-threads', type=int, default=None, help="Operations run in parallel")
+    parser.add_argument('--mixed-precision', action='store_true',
+                        help="Compute in bfloat16 on CPUs with native support")
+    parser.add_argument('--augment', nargs='?', const='', default=None, metavar='POLICY_JSON',
+                        help="Augment training batches, with the default policy or one from a JSON file")
+    args = parser.parse_args()
+    if not args.dataset and (args.split or not args.features) and not os.path.exists(args.manifest):
+        sys.exit(f"No dataset manifest at {args.manifest}. Build it with python helper_tools/build_manifest.py "
+                 f"(and split it with helper_tools/separate_dataset.py), or train on a folder with --dataset")
+    if args.split and (args.validation_split is not None or args.dataset):
+        parser.error("--split replaces --validation-split and needs the manifest")
+    if args.split is None and args.validation_split is None and not args.dataset \
+            and dataset_manifest.split_exists(args.manifest, 'default'):
+        # Validate on patients the model never saw, as separate_dataset.py laid them out
+        args.split = 'default'
+        print(f"Holding out fold {args.fold} of the manifest split 'default' (--validation-split 0 turns this off)")
+    if args.early_stopping and not (args.validation_split or args.split):
+        parser.error("--early-stopping needs a --validation-split or --split")
+
+    configure_threads(args.intra_op_threads, args.inter_op_threads)
+    train(args.dataset, args.epochs, args.batch_size, args.shuffle_buffer, not args.no_cache, args.seed, args.output,
+          args.features, args.validation_split or 0.0, args.early_stopping, args.checkpoint_dir, args.mixed_precision,
+          augmentation.load_policy(args.augment) if args.augment is not None else None, args.manifest,
+          args.split, args.fold)